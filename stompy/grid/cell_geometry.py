@@ -0,0 +1,206 @@
+"""
+Vectorized geometry for mixed triangle/quad/n-gon cells.
+
+Cells are given as a padded [Ncells,max_sides] array of node indices,
+with negative values for unused sides, as in UnstructuredGrid.cells['nodes'].
+All cells are processed together as a padded [Ncells,max_sides,2] array of
+coordinates, with masking for the unused sides, so there is no per-cell
+python loop.  The chunk argument bounds the size of the temporary
+arrays for very large grids.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+from .. import utils
+
+
+def _chunks(N,chunk):
+    if chunk is None or chunk>=N:
+        yield slice(0,N)
+    else:
+        for start in range(0,N,chunk):
+            yield slice(start,min(N,start+chunk))
+
+
+def _padded_polygons(node_xy,cell_nodes):
+    """
+    returns pnts [N,max_sides,2] relative to the first node of each cell,
+    the offset ref [N,2], the side mask [N,max_sides], the number of sides
+    [N] and the index of the next node [N,max_sides].
+    Subtracting the first node keeps the shoelace sums well-conditioned
+    for grids in large projected coordinates.
+    """
+    cell_nodes=np.asarray(cell_nodes)
+    nsides=(cell_nodes>=0).sum(axis=1)
+    side=np.arange(cell_nodes.shape[1])
+    mask=side[None,:]<nsides[:,None]
+    nxt=side[None,:]+1
+    nxt=np.where(nxt<nsides[:,None],nxt,0)
+
+    ref=node_xy[cell_nodes[:,0]]
+    pnts=node_xy[np.where(mask,cell_nodes,0)] - ref[:,None,:]
+    pnts[~mask]=0.0
+    return pnts,ref,mask,nsides,nxt
+
+
+def _shoelace(pnts,mask,nxt):
+    """ signed area and first moments of padded, relative polygons """
+    pA=pnts
+    pB=np.take_along_axis(pnts,nxt[:,:,None],axis=1)
+    cross=pA[...,0]*pB[...,1] - pB[...,0]*pA[...,1]
+    cross[~mask]=0.0
+    area=0.5*cross.sum(axis=1)
+    mx=((pA[...,0]+pB[...,0])*cross).sum(axis=1)
+    my=((pA[...,1]+pB[...,1])*cross).sum(axis=1)
+    return area,mx,my
+
+
+def _circumcenters(pnts,mask,nsides,nxt,mode):
+    if mode=='first3':
+        return utils.circumcenter(pnts[:,0],pnts[:,1],pnts[:,2])
+    elif mode=='sequential':
+        # average of the circumcenters of all consecutive triples, as
+        # in utils.poly_circumcenter
+        p1=pnts
+        p2=np.take_along_axis(pnts,nxt[:,:,None],axis=1)
+        nxt2=np.take_along_axis(nxt,nxt,axis=1)
+        p3=np.take_along_axis(pnts,nxt2[:,:,None],axis=1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            ccs=utils.circumcenter(p1,p2,p3)
+        ccs[~mask]=0.0
+        return ccs.sum(axis=1) / nsides[:,None]
+    else:
+        raise ValueError("Unknown circumcenter mode %s"%mode)
+
+
+def cells_area(node_xy,cell_nodes,chunk=None):
+    """ signed area of each cell, positive for CCW ordering """
+    N=len(cell_nodes)
+    area=np.zeros(N,np.float64)
+    for sl in _chunks(N,chunk):
+        pnts,ref,mask,nsides,nxt=_padded_polygons(node_xy,cell_nodes[sl])
+        area[sl]=_shoelace(pnts,mask,nxt)[0]
+    return area
+
+
+def cells_centroid(node_xy,cell_nodes,chunk=None):
+    """ area-weighted centroid of each cell, nan for degenerate cells """
+    return cells_geometry(node_xy,cell_nodes,chunk=chunk,center=None)[1]
+
+
+def cells_circumcenter(node_xy,cell_nodes,chunk=None,mode='first3'):
+    """
+    mode: 'first3' circumcenter of the first three nodes, 'sequential'
+    average of circumcenters of each consecutive triple of nodes.
+    """
+    N=len(cell_nodes)
+    cc=np.zeros((N,2),np.float64)
+    for sl in _chunks(N,chunk):
+        pnts,ref,mask,nsides,nxt=_padded_polygons(node_xy,cell_nodes[sl])
+        cc[sl]=_circumcenters(pnts,mask,nsides,nxt,mode) + ref
+    return cc
+
+
+def cells_geometry(node_xy,cell_nodes,chunk=None,center='first3'):
+    """
+    Compute area, centroid and circumcenter for all cells in one pass.
+
+    node_xy: [Nnodes,2] coordinates
+    cell_nodes: [Ncells,max_sides] node indices, padded with negative values.
+      Only cells with at least 3 nodes should be passed in.
+    chunk: if given, process at most this many cells at a time.
+    center: 'first3','sequential' (see cells_circumcenter), or None to skip
+      the circumcenter.
+
+    returns area [Ncells], centroid [Ncells,2], circumcenter [Ncells,2] or None
+    """
+    node_xy=np.asarray(node_xy)
+    N=len(cell_nodes)
+    area=np.zeros(N,np.float64)
+    centroid=np.zeros((N,2),np.float64)
+    if center is not None:
+        cc=np.zeros((N,2),np.float64)
+    else:
+        cc=None
+
+    for sl in _chunks(N,chunk):
+        pnts,ref,mask,nsides,nxt=_padded_polygons(node_xy,cell_nodes[sl])
+        A,mx,my=_shoelace(pnts,mask,nxt)
+        area[sl]=A
+        with np.errstate(divide='ignore',invalid='ignore'):
+            centroid[sl,0]=mx/(6*A)
+            centroid[sl,1]=my/(6*A)
+        centroid[sl]+=ref
+        if cc is not None:
+            cc[sl]=_circumcenters(pnts,mask,nsides,nxt,center) + ref
+    return area,centroid,cc
+
+
+def segments_distance(xy,p1,p2):
+    """
+    Distance from points to finite segments, elementwise.
+    xy,p1,p2: [...,2] arrays, broadcast against each other.
+    """
+    xy=np.asarray(xy,np.float64)
+    d=p2-p1
+    L2=(d**2).sum(axis=-1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        alpha=((xy-p1)*d).sum(axis=-1) / L2
+    # degenerate segments fall back to the distance to p1
+    alpha=np.where(L2>0,alpha,0.0).clip(0,1)
+    closest=p1+alpha[...,None]*d
+    return np.sqrt( ((xy-closest)**2).sum(axis=-1) )
+
+
+def cells_contain_points(node_xy,cell_nodes,xy):
+    """
+    Elementwise point-in-polygon test: does cell_nodes[i] contain xy[i]?
+    Uses the crossing number with a half-open rule, so a point exactly on
+    a shared side is assigned to only one of the two cells.
+
+    node_xy: [Nnodes,2]
+    cell_nodes: [N,max_sides] padded node indices
+    xy: [N,2] query points
+    returns [N] boolean
+    """
+    xy=np.asarray(xy,np.float64)
+    pnts,ref,mask,nsides,nxt=_padded_polygons(node_xy,cell_nodes)
+    # relative to the first node, like the polygons
+    q=xy-ref
+    pA=pnts
+    pB=np.take_along_axis(pnts,nxt[:,:,None],axis=1)
+    qx=q[:,None,0]
+    qy=q[:,None,1]
+    straddle=(pA[...,1]>qy) != (pB[...,1]>qy)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        x_cross=pA[...,0] + (qy-pA[...,1])*(pB[...,0]-pA[...,0])/(pB[...,1]-pA[...,1])
+    crossings=straddle & (qx<x_cross) & mask
+    return (crossings.sum(axis=1)%2)==1
+
+
+def cells_distance(node_xy,cell_nodes,xy):
+    """
+    Elementwise distance from xy[i] to the polygon of cell_nodes[i],
+    zero for points inside the cell.
+    """
+    xy=np.asarray(xy,np.float64)
+    pnts,ref,mask,nsides,nxt=_padded_polygons(node_xy,cell_nodes)
+    pB=np.take_along_axis(pnts,nxt[:,:,None],axis=1)
+    d=segments_distance((xy-ref)[:,None,:],pnts,pB)
+    d[~mask]=np.inf
+    d=d.min(axis=1)
+    inside=cells_contain_points(node_xy,cell_nodes,xy)
+    d[inside]=0.0
+    return d
+
+
+def cells_bounds(node_xy,cell_nodes):
+    """
+    returns [N,4] bounding boxes of cells, ordered xmin,xmax,ymin,ymax
+    """
+    cell_nodes=np.asarray(cell_nodes)
+    mask=cell_nodes>=0
+    pnts=np.asarray(node_xy)[np.where(mask,cell_nodes,cell_nodes[:,:1])]
+    return np.c_[pnts[...,0].min(axis=1),pnts[...,0].max(axis=1),
+                 pnts[...,1].min(axis=1),pnts[...,1].max(axis=1)]
@@ -0,0 +1,577 @@
+"""
+Spatial indices over the finite geometry of grid edges and cells.
+
+Unlike the point indices on node locations and cell centers, these
+index the bounding box of each element, and answer queries using the
+true distance to the segment or polygon.  The index subscribes to the
+grid's edit notifications, so it stays in sync through add/delete/modify
+of nodes, edges and cells, including undo via revert().
+
+Rtree is used for single-point queries when available.  Otherwise a plain
+numpy array of bounding boxes is scanned, which is O(N) per query but still
+vectorized.  Batched point queries use a uniform binning of the boxes.
+"""
+from __future__ import print_function
+
+import logging
+import numpy as np
+
+from . import cell_geometry, topology
+
+log=logging.getLogger(__name__)
+
+try:
+    from rtree.index import Rtree
+except ImportError:
+    Rtree=None
+
+
+def points_intersecting(geom,xy):
+    """
+    Vectorized geom.intersects(Point(xy[i])) for an [N,2] array.
+    """
+    import shapely
+    xy=np.asarray(xy,np.float64).reshape([-1,2])
+    if hasattr(shapely,'intersects_xy'): # shapely >= 2.0
+        return shapely.intersects_xy(geom,xy[:,0],xy[:,1])
+
+    from shapely import vectorized
+    sel=vectorized.contains(geom,xy[:,0],xy[:,1])
+    # vectorized.touches is not prepared, and very slow for large
+    # geometries.  Instead check the remaining points against the
+    # linework directly.
+    rest=np.nonzero(~sel)[0]
+    segs=geometry_segments(geom)
+    if len(rest) and len(segs):
+        bins=BoxBins(np.c_[segs[:,:,0].min(axis=1),segs[:,:,0].max(axis=1),
+                           segs[:,:,1].min(axis=1),segs[:,:,1].max(axis=1)])
+        p,seg=bins.query_points(xy[rest])
+        a=segs[seg,0]
+        b=segs[seg,1]
+        q=xy[rest[p]]
+        on_line=( (b[:,0]-a[:,0])*(q[:,1]-a[:,1])
+                  - (b[:,1]-a[:,1])*(q[:,0]-a[:,0]) )==0.0
+        sel[rest[p[on_line]]]=True
+    return sel
+
+
+def points_contained(geom,xy):
+    """
+    Vectorized geom.contains(Point(xy[i])) for an [N,2] array.
+    """
+    import shapely
+    xy=np.asarray(xy,np.float64).reshape([-1,2])
+    if hasattr(shapely,'contains_xy'): # shapely >= 2.0
+        return shapely.contains_xy(geom,xy[:,0],xy[:,1])
+    from shapely import vectorized
+    return vectorized.contains(geom,xy[:,0],xy[:,1])
+
+
+def geometry_linework(geom):
+    """
+    Coordinate arrays for the rings, lines and points making up a shapely
+    geometry.
+    """
+    if hasattr(geom,'geoms'): # multi-part and collections
+        return [coords for part in geom.geoms for coords in geometry_linework(part)]
+    if geom.is_empty:
+        return []
+    if geom.geom_type=='Polygon':
+        rings=[geom.exterior]+list(geom.interiors)
+        return [np.asarray(r.coords) for r in rings]
+    return [np.asarray(geom.coords)]
+
+
+def geometry_segments(geom,max_len=None):
+    """
+    [N,2,2] segments of the linework of geom, with isolated points as
+    zero-length segments.  With max_len, longer segments are split into
+    pieces no longer than max_len.
+    """
+    segs=[]
+    for coords in geometry_linework(geom):
+        coords=coords[:,:2]
+        if len(coords)==1:
+            coords=np.concatenate([coords,coords])
+        a=coords[:-1]
+        b=coords[1:]
+        if max_len:
+            L=np.sqrt(((b-a)**2).sum(axis=1))
+            npieces=np.maximum(1,np.ceil(L/max_len)).astype(np.int64)
+            seg=np.repeat(np.arange(len(a)),npieces)
+            k=np.arange(npieces.sum()) - np.repeat(np.cumsum(npieces)-npieces,npieces)
+            f0=(k/npieces[seg])[:,None]
+            f1=((k+1)/npieces[seg])[:,None]
+            a,b=a[seg]+f0*(b[seg]-a[seg]), a[seg]+f1*(b[seg]-a[seg])
+        segs.append(np.stack([a,b],axis=1))
+    if segs:
+        return np.concatenate(segs)
+    return np.zeros((0,2,2),np.float64)
+
+
+def geometry_segment_boxes(geom,max_len=None):
+    """ [N,4] xxyy boxes around geometry_segments(geom,max_len) """
+    segs=geometry_segments(geom,max_len=max_len)
+    return np.c_[segs[:,:,0].min(axis=1),segs[:,:,0].max(axis=1),
+                 segs[:,:,1].min(axis=1),segs[:,:,1].max(axis=1)]
+
+
+class BoxBins(object):
+    """
+    Static uniform binning of a set of xxyy boxes, for batched overlap
+    queries.  Bins are about the size of a typical box, capped so that
+    there are at most a few bins per box.  Each box is listed in every bin
+    it overlaps.
+    """
+    def __init__(self,boxes,ids=None):
+        """
+        boxes: [N,4] xxyy
+        ids: optional [N] labels for the boxes, defaults to arange(N)
+        """
+        b=self.boxes=np.asarray(boxes,np.float64).reshape([-1,4])
+        if ids is None:
+            ids=np.arange(len(b))
+        self.ids=np.asarray(ids)
+        N=max(1,len(b))
+
+        if len(b):
+            x0,x1=b[:,0].min(),b[:,1].max()
+            y0,y1=b[:,2].min(),b[:,3].max()
+        else:
+            x0=x1=y0=y1=0.0
+        min_size=np.sqrt( max((x1-x0)*(y1-y0),1e-300) / (4*N) )
+        self.x0=x0
+        self.y0=y0
+        self.dx=max(np.median(b[:,1]-b[:,0]) if len(b) else 0,min_size,1e-300)
+        self.dy=max(np.median(b[:,3]-b[:,2]) if len(b) else 0,min_size,1e-300)
+        self.nx=int((x1-x0)/self.dx)+1
+        self.ny=int((y1-y0)/self.dy)+1
+
+        owner,bins=self._box_bins(b)
+        self.offsets,self.indices=topology.csr_from_pairs(bins,owner,self.nx*self.ny)
+
+    def _box_bins(self,boxes):
+        """
+        returns owner,bins: for each bin overlapped by boxes[owner], ignoring
+        the parts of boxes beyond the extent of the bins.
+        """
+        nx,ny=self.nx,self.ny
+        with np.errstate(invalid='ignore'):
+            i0=np.floor((boxes[:,0]-self.x0)/self.dx)
+            i1=np.floor((boxes[:,1]-self.x0)/self.dx)
+            j0=np.floor((boxes[:,2]-self.y0)/self.dy)
+            j1=np.floor((boxes[:,3]-self.y0)/self.dy)
+            sel=(i1>=0)&(i0<nx)&(j1>=0)&(j0<ny)
+        owner=np.nonzero(sel)[0]
+        i0=i0[sel].clip(0,nx-1).astype(np.int64)
+        i1=i1[sel].clip(0,nx-1).astype(np.int64)
+        j0=j0[sel].clip(0,ny-1).astype(np.int64)
+        j1=j1[sel].clip(0,ny-1).astype(np.int64)
+
+        nbx=i1-i0+1
+        nb=nbx*(j1-j0+1)
+        k=np.arange(nb.sum()) - np.repeat(np.cumsum(nb)-nb,nb)
+        nbx=np.repeat(nbx,nb)
+        bins=( (np.repeat(j0,nb)+k//nbx)*nx
+               + np.repeat(i0,nb)+k%nbx )
+        return np.repeat(owner,nb),bins
+
+    def query_boxes(self,boxes):
+        """
+        boxes: [N,4] xxyy query boxes
+        returns box_idx,ids arrays for each overlapping pair, sorted by
+        box and then id.
+        """
+        boxes=np.asarray(boxes,np.float64).reshape([-1,4])
+        owner,bin_idx=self._box_bins(boxes)
+        offsets=self.offsets
+        counts=offsets[bin_idx+1]-offsets[bin_idx]
+        q=np.repeat(owner,counts)
+        k=np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts,counts)
+        elt=self.indices[np.repeat(offsets[bin_idx],counts)+k].astype(np.int64)
+
+        a=boxes[q]
+        b=self.boxes[elt]
+        hit=( (b[:,0]<=a[:,1])&(a[:,0]<=b[:,1])
+              &(b[:,2]<=a[:,3])&(a[:,2]<=b[:,3]) )
+        q=q[hit]
+        elt=elt[hit]
+        # a box spanning several bins finds some boxes more than once
+        N=max(1,len(self.boxes))
+        keys=np.unique(q*N+elt)
+        return keys//N,self.ids[keys%N]
+
+    def query_points(self,xy):
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        return self.query_boxes(xy[:,[0,0,1,1]])
+
+
+class ElementIndex(object):
+    """
+    Base class for edge and cell indices.  Subclasses define which
+    grid elements are indexed, their bounding boxes and their exact
+    distance to a point, and which grid methods to listen to.
+
+    Boxes are in xxyy order: xmin,xmax,ymin,ymax, matching the
+    interleaved=False convention of the Rtree point indices.
+    """
+    # grid method name => name of the handler method
+    listeners={}
+
+    def __init__(self,grid,use_rtree=None,boxes=None):
+        """
+        use_rtree: None to use rtree if it is installed, False to force
+        the numpy implementation, True to require rtree.
+        boxes: optional precomputed [element_count(),4] boxes, i.e. as saved
+        with the grid.  Rows for invalid elements are ignored.
+        """
+        self.grid=grid
+        if use_rtree is None:
+            use_rtree=Rtree is not None
+        elif use_rtree and Rtree is None:
+            raise ImportError("rtree is not available")
+        self.use_rtree=use_rtree
+        self.rebuild(boxes=boxes)
+        self.subscribe()
+
+    # Subclass interface
+    def element_count(self):
+        raise NotImplementedError()
+    def element_valid(self):
+        """ [element_count()] boolean, elements to include """
+        raise NotImplementedError()
+    def element_bounds(self,ids):
+        """ [len(ids),4] xxyy boxes """
+        raise NotImplementedError()
+    def element_distance(self,ids,xy):
+        """ [len(ids)] distances from the point xy """
+        raise NotImplementedError()
+    def element_points(self,ids):
+        """ [len(ids),2] a point on each element """
+        raise NotImplementedError()
+    def element_geometries(self,ids):
+        """ list of shapely geometries """
+        raise NotImplementedError()
+
+    # Maintenance
+    def rebuild(self,boxes=None):
+        N=self.element_count()
+        self.valid=np.asarray(self.element_valid(),np.bool_).copy()
+        if boxes is not None:
+            # adopt writable (e.g. copy-on-write mapped) boxes without a copy
+            if not boxes.flags.writeable:
+                boxes=boxes.copy()
+            self.boxes=boxes
+            self.boxes[~self.valid]=np.nan
+        else:
+            self.boxes=np.full((N,4),np.nan)
+            ids=np.nonzero(self.valid)[0]
+            if len(ids):
+                self.boxes[ids]=self.element_bounds(ids)
+
+        self._rtree=None
+        self._bins=None
+
+    def rtree(self):
+        """
+        The Rtree over the element boxes, or None when using the numpy
+        implementation.  Built on first use, since batched point queries
+        only need the binned boxes.
+        """
+        if self.use_rtree and self._rtree is None:
+            ids=np.nonzero(self.valid)[0]
+            if len(ids):
+                stream=((int(i),tuple(self.boxes[i]),None) for i in ids)
+                self._rtree=Rtree(stream,interleaved=False)
+            else:
+                self._rtree=Rtree(interleaved=False)
+        return self._rtree
+
+    def subscribe(self):
+        for func_name,handler in self.listeners.items():
+            self.grid.subscribe_after(func_name,getattr(self,handler))
+
+    def unsubscribe(self):
+        """ stop following grid edits.  the index is stale afterwards. """
+        for func_name,handler in self.listeners.items():
+            self.grid.unsubscribe_after(func_name,getattr(self,handler))
+
+    def _grow(self,N):
+        if N<=len(self.valid):
+            return
+        newN=max(N,2*len(self.valid))
+        valid=np.zeros(newN,np.bool_)
+        valid[:len(self.valid)]=self.valid
+        boxes=np.full((newN,4),np.nan)
+        boxes[:len(self.boxes)]=self.boxes
+        self.valid=valid
+        self.boxes=boxes
+
+    def insert(self,i):
+        i=int(i)
+        if i<len(self.valid) and self.valid[i]:
+            self.delete(i)
+        self._grow(i+1)
+        box=self.element_bounds(np.array([i]))[0]
+        self.boxes[i]=box
+        self.valid[i]=True
+        self._bins=None
+        if self._rtree is not None:
+            self._rtree.insert(i,tuple(box))
+
+    def delete(self,i):
+        i=int(i)
+        if i>=len(self.valid) or not self.valid[i]:
+            return
+        if self._rtree is not None:
+            self._rtree.delete(i,tuple(self.boxes[i]))
+        self.valid[i]=False
+        self.boxes[i]=np.nan
+        self._bins=None
+
+    def insert_many(self,ids):
+        """ add a batch of new elements, i.e. from add_edges/add_cells """
+        ids=np.asarray(ids,np.int64)
+        if len(ids)==0:
+            return
+        self._grow(ids.max()+1)
+        boxes=self.element_bounds(ids)
+        if self._rtree is not None:
+            if len(ids)>0.1*self.valid.sum():
+                self._rtree=None # cheaper to rebuild on demand
+            else:
+                for i,box in zip(ids,boxes):
+                    if self.valid[i]:
+                        self._rtree.delete(int(i),tuple(self.boxes[i]))
+                    self._rtree.insert(int(i),tuple(box))
+        self.boxes[ids]=boxes
+        self.valid[ids]=True
+        self._bins=None
+
+    def update(self,ids):
+        for i in ids:
+            self.delete(i)
+            self.insert(i)
+
+    # Queries
+    def query_bbox(self,xxyy,exact=False):
+        """
+        Elements whose bounding boxes overlap the box xxyy=[xmin,xmax,ymin,ymax].
+        exact: further restrict to elements whose geometry intersects the box.
+        returns an array of element ids, sorted.
+        """
+        xxyy=[float(v) for v in xxyy]
+        rtree=self.rtree()
+        if rtree is not None:
+            hits=np.array(sorted(rtree.intersection(xxyy)),np.int64)
+        else:
+            b=self.boxes
+            with np.errstate(invalid='ignore'):
+                sel=( self.valid
+                      & (b[:,0]<=xxyy[1]) & (b[:,1]>=xxyy[0])
+                      & (b[:,2]<=xxyy[3]) & (b[:,3]>=xxyy[2]) )
+            hits=np.nonzero(sel)[0]
+        if exact and len(hits):
+            hits=hits[self.element_intersects_box(hits,xxyy)]
+        return hits
+
+    def element_intersects_box(self,ids,xxyy):
+        from shapely import geometry
+        box=geometry.box(xxyy[0],xxyy[2],xxyy[1],xxyy[3])
+        return np.array([box.intersects(g) for g in self.element_geometries(ids)],
+                        np.bool_)
+
+    def _point_bins(self):
+        """ BoxBins over the current element boxes, or False if empty """
+        if self._bins is None:
+            ids=np.nonzero(self.valid)[0]
+            if len(ids)==0:
+                self._bins=False
+            else:
+                self._bins=BoxBins(self.boxes[ids],ids=ids)
+        return self._bins
+
+    def bin_size(self):
+        """ (dx,dy) of the bins used for batched queries, or None if empty """
+        bins=self._point_bins()
+        if bins is False:
+            return None
+        return bins.dx,bins.dy
+
+    def query_boxes(self,boxes):
+        """
+        Batched bounding box search: all pairs of query box and element
+        where the boxes overlap.
+
+        boxes: [N,4] xxyy query boxes
+        returns box_idx,elt_idx arrays, sorted by box and then element.
+        """
+        bins=self._point_bins()
+        if bins is False:
+            return (np.zeros(0,np.int64),np.zeros(0,np.int64))
+        return bins.query_boxes(boxes)
+
+    def query_points(self,xy):
+        """
+        Batched candidate search: all pairs of point and element where the
+        point falls within the element's bounding box.
+
+        xy: [N,2] points
+        returns pnt_idx,elt_idx arrays, sorted by point and then element.
+        """
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        return self.query_boxes(xy[:,[0,0,1,1]])
+
+    def select_intersecting(self,geom,chunk=10000):
+        """
+        Bulk test of elements against a shapely geometry.
+        returns [element_count()] boolean mask, True for valid elements
+        which intersect geom.
+
+        Only elements whose boxes overlap the linework of geom (polygon
+        rings, lines, points) are tested exactly, with a prepared geometry,
+        chunk elements at a time.  Any other element is entirely inside
+        or outside of geom, and is classified by testing a single vertex.
+        """
+        from shapely import prepared
+        N=self.element_count()
+        sel=np.zeros(N,np.bool_)
+        ids=np.nonzero(self.valid[:N])[0]
+        size=self.bin_size()
+        if len(ids)==0 or size is None:
+            return sel
+
+        seg_boxes=geometry_segment_boxes(geom,max_len=min(size))
+        near=np.unique(self.query_boxes(seg_boxes)[1])
+        far=np.setdiff1d(ids,near,assume_unique=True)
+
+        if len(far):
+            xy=self.element_points(far)
+            gx0,gy0,gx1,gy1=geom.bounds
+            in_bounds=( (xy[:,0]>=gx0)&(xy[:,0]<=gx1)
+                        &(xy[:,1]>=gy0)&(xy[:,1]<=gy1) )
+            for start in range(0,len(far),chunk):
+                sl=slice(start,start+chunk)
+                sub=np.nonzero(in_bounds[sl])[0]
+                if len(sub):
+                    # no far element touches the linework, so contains
+                    # is enough
+                    sel[far[sl][sub]]=points_contained(geom,xy[sl][sub])
+
+        prep=prepared.prep(geom)
+        for start in range(0,len(near),chunk):
+            sub=near[start:start+chunk]
+            sel[sub]=[prep.intersects(g) for g in self.element_geometries(sub)]
+        return sel
+
+    def _nearest_boxes(self,xy,count):
+        rtree=self.rtree()
+        if rtree is not None:
+            hits=list(rtree.nearest((xy[0],xy[0],xy[1],xy[1]),count))
+            return np.array(hits,np.int64)
+        ids=np.nonzero(self.valid)[0]
+        if len(ids)<=count:
+            return ids
+        b=self.boxes[ids]
+        dx=np.maximum(0,np.maximum(b[:,0]-xy[0],xy[0]-b[:,1]))
+        dy=np.maximum(0,np.maximum(b[:,2]-xy[1],xy[1]-b[:,3]))
+        d2=dx**2+dy**2
+        return ids[np.argpartition(d2,count-1)[:count]]
+
+    def nearest(self,xy,count=1):
+        """
+        The count elements nearest to xy by true distance, ordered by
+        increasing distance.  Fewer are returned when the index does
+        not hold count elements.
+        """
+        xy=np.asarray(xy,np.float64)
+        cands=self._nearest_boxes(xy,count)
+        if len(cands)==0:
+            return cands
+        dists=self.element_distance(cands,xy)
+        if len(cands)>=count:
+            # every element at least as close as the count'th candidate
+            # has a box overlapping this square
+            r=np.sort(dists)[count-1]
+            cands=self.query_bbox([xy[0]-r,xy[0]+r,xy[1]-r,xy[1]+r])
+            dists=self.element_distance(cands,xy)
+        order=np.argsort(dists,kind='mergesort')[:count]
+        return cands[order]
+
+
+class EdgeIndex(ElementIndex):
+    """ Index of edges as finite segments """
+    listeners={'add_edge':'on_add',
+               'add_edges':'on_add_many',
+               'delete_edge':'on_delete',
+               'modify_edge':'on_modify',
+               'modify_node':'on_modify_node'}
+
+    def element_count(self):
+        return self.grid.Nedges()
+    def element_valid(self):
+        return ~self.grid.edges['deleted']
+    def element_bounds(self,ids):
+        pnts=self.grid.nodes['x'][self.grid.edges['nodes'][ids]]
+        return np.c_[pnts[:,:,0].min(axis=1),pnts[:,:,0].max(axis=1),
+                     pnts[:,:,1].min(axis=1),pnts[:,:,1].max(axis=1)]
+    def element_distance(self,ids,xy):
+        pnts=self.grid.nodes['x'][self.grid.edges['nodes'][ids]]
+        return cell_geometry.segments_distance(xy,pnts[:,0],pnts[:,1])
+    def element_points(self,ids):
+        return self.grid.nodes['x'][self.grid.edges['nodes'][ids,0]]
+    def element_geometries(self,ids):
+        from shapely import geometry
+        return [geometry.LineString(self.grid.nodes['x'][self.grid.edges['nodes'][j]])
+                for j in ids]
+
+    def on_add(self,grid,func_name,return_value=None,**kwargs):
+        self.insert(return_value)
+    def on_add_many(self,grid,func_name,*args,**kwargs):
+        self.insert_many(kwargs['return_value'])
+    def on_delete(self,grid,func_name,j,**kwargs):
+        self.delete(j)
+    def on_modify(self,grid,func_name,j,**kwargs):
+        if 'nodes' in kwargs:
+            self.update([j])
+    def on_modify_node(self,grid,func_name,n,**kwargs):
+        if 'x' in kwargs:
+            self.update(grid.node_to_edges(n))
+
+
+class CellIndex(ElementIndex):
+    """ Index of cells as polygons """
+    listeners={'add_cell':'on_add',
+               'add_cells':'on_add_many',
+               'delete_cell':'on_delete',
+               'modify_cell':'on_modify',
+               'modify_node':'on_modify_node'}
+
+    def element_count(self):
+        return self.grid.Ncells()
+    def element_valid(self):
+        return ~self.grid.cells['deleted']
+    def element_bounds(self,ids):
+        return cell_geometry.cells_bounds(self.grid.nodes['x'],
+                                          self.grid.cells['nodes'][ids])
+    def element_distance(self,ids,xy):
+        xys=np.broadcast_to(xy,(len(ids),2))
+        return cell_geometry.cells_distance(self.grid.nodes['x'],
+                                            self.grid.cells['nodes'][ids],xys)
+    def element_points(self,ids):
+        return self.grid.nodes['x'][self.grid.cells['nodes'][ids,0]]
+    def element_geometries(self,ids):
+        return [self.grid.cell_polygon(c) for c in ids]
+
+    def on_add(self,grid,func_name,return_value=None,**kwargs):
+        self.insert(return_value)
+    def on_add_many(self,grid,func_name,*args,**kwargs):
+        self.insert_many(kwargs['return_value'])
+    def on_delete(self,grid,func_name,i,**kwargs):
+        self.delete(i)
+    def on_modify(self,grid,func_name,c,**kwargs):
+        if 'nodes' in kwargs:
+            self.update([c])
+    def on_modify_node(self,grid,func_name,n,**kwargs):
+        if 'x' in kwargs:
+            self.update(grid.node_to_cells(n))
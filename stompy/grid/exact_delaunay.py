@@ -2,6 +2,7 @@
 # uses robust_predicates for in-circle tests, follows
 # the algorithm of CGAL to the extent possible.
 import logging
+import math
 import pdb
 logger = logging.getLogger()
 
@@ -11,8 +12,9 @@ import matplotlib.pyplot as plt
 
 # do these work in py2?
 from ..spatial import robust_predicates
-from . import unstructured_grid
-from ..utils import circular_pairs
+from . import unstructured_grid, topology
+from .. import utils
+from ..utils import circular_pairs, circumcenter
 
 if six.PY3:
     def cmp(a,b):
@@ -98,6 +100,7 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         n=super(Triangulation,self).add_node(**kwargs)
 
         self.tri_insert(n,loc)
+        self.hint_insert(n)
         return n
 
     def modify_node(self,n,_brute_force=False,**kwargs):
@@ -187,7 +190,9 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
 
             if shortcut:
                 # short cut should work:
+                self.hint_remove(n)
                 retval=super(Triangulation,self).modify_node(n,**kwargs)
+                self.hint_insert(n)
                 self.restore_delaunay(n)
                 # when refining the above tests, uncomment this to increase
                 # the amount of validation
@@ -235,12 +240,94 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
             self.edges[j]['cells'][:]=self.INF_CELL
         return j
 
+    # Starting cells for locate() come from a coarse spatial hash,
+    # mapping square buckets to a node recently inserted in that bucket.
+    # The walk then starts from a cell adjacent to that node.  Buckets
+    # are sized for a few nodes each, and the hash is rebuilt as the
+    # number of nodes grows.  Set to False to always start from the first
+    # valid cell.
+    start_hint=True
+    hint_search_rings=2 # how far to look for a non-empty bucket
+    _hint_buckets=None
+    _hint_size=None
+    _hint_count=0 # nodes inserted since the hash was built
+    _hint_limit=0 # rebuild when _hint_count exceeds this
+    _hint_last=None # most recently inserted node
+
+    def _hint_key(self,x):
+        return (int(math.floor(x[0]/self._hint_size)),
+                int(math.floor(x[1]/self._hint_size)))
+
+    def hint_rebuild(self):
+        """ (re)build the spatial hash used by choose_start_cell """
+        valid=np.nonzero(~self.nodes['deleted'])[0]
+        self._hint_buckets={}
+        self._hint_count=0
+        self._hint_limit=max(16,3*len(valid))
+        if len(valid)==0:
+            self._hint_size=1.0
+            return
+        xy=self.nodes['x'][valid]
+        extent=xy.max(axis=0)-xy.min(axis=0)
+        area=extent[0]*extent[1]
+        if area<=0:
+            area=max(extent.max(),1e-12)**2
+        # about 4 nodes per bucket
+        self._hint_size=math.sqrt(4*area/len(valid))
+        keys=np.floor(xy/self._hint_size).astype(np.int64)
+        for (kx,ky),n in zip(keys.tolist(),valid.tolist()):
+            self._hint_buckets[(kx,ky)]=n
+
+    def hint_insert(self,n):
+        self._hint_last=n
+        if self._hint_buckets is None:
+            return
+        self._hint_count+=1
+        if self._hint_count>self._hint_limit:
+            self._hint_buckets=None # rebuilt on the next lookup
+            return
+        self._hint_buckets[self._hint_key(self.nodes['x'][n])]=n
+
+    def hint_remove(self,n):
+        if self._hint_last==n:
+            self._hint_last=None
+        if self._hint_buckets is None:
+            return
+        key=self._hint_key(self.nodes['x'][n])
+        if self._hint_buckets.get(key,None)==n:
+            del self._hint_buckets[key]
+
+    def hint_node(self,t):
+        """ a valid node near t, or None """
+        if self._hint_buckets is None:
+            self.hint_rebuild()
+        kx,ky=self._hint_key(t)
+        buckets=self._hint_buckets
+        for r in range(self.hint_search_rings+1):
+            for dx in range(-r,r+1):
+                for dy in range(-r,r+1):
+                    if max(abs(dx),abs(dy))<r:
+                        continue # interior of the ring, already checked
+                    n=buckets.get( (kx+dx,ky+dy), None)
+                    if n is not None and not self.nodes['deleted'][n]:
+                        return n
+        n=self._hint_last
+        if n is not None and n<self.Nnodes() and not self.nodes['deleted'][n]:
+            return n
+        return None
+
     def choose_start_cell(self,t=None):
         """ choose a starting cell for trying to locate where a new vertex
         should go.  May return INF_CELL if there are no valid cells.
-        t: can specify a target point which may be used with a spatial index
-        to speed up the query.
+        t: target point.  If given, and start_hint is set, the start is
+        a cell adjacent to a nearby node from the spatial hash.
         """
+        if t is not None and self.start_hint:
+            n=self.hint_node(t)
+            if n is not None:
+                for c in self.node_to_cells(n):
+                    if not self.cells['deleted'][c]:
+                        return c
         c=0
         try:
             while self.cells['deleted'][c]: 
@@ -306,6 +393,7 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
 
         return snbrs
         
+    locate_steps=0 # count of cells visited by locate(), for benchmarking
     def locate(self,t,c=None):
         """ t: [x,y] point to locate
         c: starting cell, if known
@@ -353,6 +441,7 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
 
 
         while True:
+            self.locate_steps+=1
             if c==self.INF_CELL:
                 #       // c must contain t in its interior
                 #       lt = OUTSIDE_CONVEX_HULL;
@@ -736,6 +825,7 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         """
         assert n>=0
 
+        self.hint_remove(n)
         N=self.Nnodes_valid()
         if N==1:
             super(Triangulation,self).delete_node(n)
@@ -924,61 +1014,90 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
 
     # Make a check for the delaunay criterion:
     def check_global_delaunay(self):
+        """
+        Check every valid node against the circumcircle of every valid cell.
+        returns a list of (cell,node) where the node is strictly inside the
+        circumcircle.  Candidate pairs are found with a KD-tree on a padded
+        floating point circumradius, and tested with incircle_array.
+        """
         bad_checks=[] # [ (cell,node),...]
-        for c in self.valid_cell_iter():
-            nodes=self.cells['nodes'][c]
-            pnts=self.nodes['x'][nodes]
-
-            # brute force - check them all.
-            for n in self.valid_node_iter():
-                if n in nodes:
-                    continue
-                t=self.nodes['x'][n]
-                check=robust_predicates.incircle(pnts[0],pnts[1],pnts[2],t)
-                if check>0:
-                    # how do we check for constraints here?
-                    # maybe more edge-centric?
-                    # tests of a cell on one side of an edge against a node on the
-                    # other is reflexive.
-                    # 
-                    
-                    # could go through the edges of c, 
-                    msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
-                                                                                    nodes[0],nodes[1],nodes[2])
-                    self.log.error(msg)
-                    bad_checks.append( (c,n) )
+        cells=np.nonzero(~self.cells['deleted'])[0]
+        nodes=np.nonzero(~self.nodes['deleted'])[0]
+        if len(cells)==0:
+            return bad_checks
+        cell_nodes=self.cells['nodes'][cells]
+        pnts=self.nodes['x'][cell_nodes]
+
+        if spatial is not None:
+            with np.errstate(divide='ignore',invalid='ignore'):
+                cc=circumcenter(pnts[:,0],pnts[:,1],pnts[:,2])
+            rad=utils.mag(cc-pnts[:,0])
+            # pad generously - exact tests sort out the candidates
+            scale=np.abs(pnts).max()
+            rad=rad*(1+1e-6) + 1e-9*scale
+            bad=~np.isfinite(rad)
+            cc[bad]=0.0
+            rad[bad]=np.inf
+            kdt=spatial.cKDTree(self.nodes['x'][nodes])
+            hits=kdt.query_ball_point(cc,rad)
+            counts=np.array([len(h) for h in hits])
+            ci=np.repeat(np.arange(len(cells)),counts)
+            ni=nodes[np.concatenate([h for h in hits if len(h)]).astype(np.int64)] if counts.sum() else np.zeros(0,np.int64)
+        else:
+            ci=np.repeat(np.arange(len(cells)),len(nodes))
+            ni=np.tile(nodes,len(cells))
+
+        # nodes of the cell itself are on the circle
+        own=np.any(cell_nodes[ci]==ni[:,None],axis=1)
+        ci=ci[~own]
+        ni=ni[~own]
+        check=robust_predicates.incircle_array(pnts[ci,0],pnts[ci,1],pnts[ci,2],
+                                               self.nodes['x'][ni])
+        for i in np.nonzero(check>0)[0]:
+            c=cells[ci[i]]
+            n=ni[i]
+            nodes_c=cell_nodes[ci[i]]
+            msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
+                                                                            nodes_c[0],nodes_c[1],nodes_c[2])
+            self.log.error(msg)
+            bad_checks.append( (c,n) )
         return bad_checks
-    
+
+    def local_delaunay_failures(self):
+        """
+        returns edges which are not locally Delaunay, i.e. the opposite node
+        of one cell is inside the circumcircle of the other.  Constrained
+        edges are skipped.
+        returns js,c,n: arrays of edge, cell and the offending node.
+        """
+        e2c=self.edges['cells'] # always maintained by the triangulation
+        sel=( (~self.edges['deleted']) & (~self.edges['constrained'])
+              & np.all(e2c>=0,axis=1) )
+        js=np.nonzero(sel)[0]
+        # always check the smaller index
+        c=e2c[js].min(axis=1)
+        c_opp=e2c[js].max(axis=1)
+        opp_nodes=self.cells['nodes'][c_opp]
+        en=self.edges['nodes'][js]
+        mask=(opp_nodes!=en[:,:1]) & (opp_nodes!=en[:,1:])
+        n=opp_nodes[np.arange(len(js)),np.argmax(mask,axis=1)]
+        pnts=self.nodes['x'][self.cells['nodes'][c]]
+        check=robust_predicates.incircle_array(pnts[:,0],pnts[:,1],pnts[:,2],
+                                               self.nodes['x'][n])
+        bad=check>0
+        return js[bad],c[bad],n[bad]
+
     def check_local_delaunay(self):
         """ Check both sides of each edge - can deal with constrained edges.
         """
         bad_checks=[] # [ (cell,node),...]
-        for j in self.valid_edge_iter():
-            if self.edges['constrained'][j]:
-                continue
-            c1,c2 = self.edge_to_cells(j)
-            if c1<0 or c2<0:
-                continue
-            # always check the smaller index -
-            # might help with caching later on.
-            c=min(c1,c2)
-            c_opp=max(c1,c2)
-            
+        for j,c,n in zip(*self.local_delaunay_failures()):
             nodes=self.cells['nodes'][c]
-            pnts=self.nodes['x'][nodes]
-
-            # brute force - check them all.
-            for n in self.cell_to_nodes(c_opp):
-                if n in nodes:
-                    continue
-                t=self.nodes['x'][n]
-                check=robust_predicates.incircle(pnts[0],pnts[1],pnts[2],t)
-                if check>0:
-                    msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
-                                                                                    nodes[0],nodes[1],nodes[2])
-                    self.log.error(msg)
-                    bad_checks.append( (c,n) )
-                    raise Exception('fail')
+            msg="Node %d is inside the circumcircle of cell %d (%d,%d,%d)"%(n,c,
+                                                                            nodes[0],nodes[1],nodes[2])
+            self.log.error(msg)
+            bad_checks.append( (c,n) )
+            raise Exception('fail')
         return bad_checks
 
     def check_orientations(self):
@@ -986,12 +1105,11 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         Checks all cells for proper CCW orientation,
         return a list of cell indexes of failures.
         """
-        bad_cells=[]
-        for c in self.valid_cell_iter():
-            node_xy=self.nodes['x'][self.cells['nodes'][c]]
-            if robust_predicates.orientation(*node_xy) <= 0:
-                bad_cells.append(c)
-        return bad_cells
+        cells=np.nonzero(~self.cells['deleted'])[0]
+        pnts=self.nodes['x'][self.cells['nodes'][cells]]
+        ccw=robust_predicates.orientation_array(pnts[:,0],pnts[:,1],pnts[:,2])
+        return list(cells[ccw<=0])
+
     def check_convex_hull(self):
         # find an edge on the convex hull, walk the hull and check
         # all consecutive orientations
@@ -1788,6 +1906,39 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
         self.fill_hole( left_nodes )
         self.fill_hole( right_nodes )
 
+    def add_constraints(self,nodes):
+        """
+        Bulk version of add_constraint.
+        nodes: [N,2] node pairs.
+
+        Pairs which are already edges of the triangulation are flagged in
+        one pass.  The rest are inserted one at a time, in spatially sorted
+        order so that consecutive insertions work on nearby cells.  Errors
+        are raised as in add_constraint, and leave earlier constraints in
+        place.
+        """
+        nodes=np.asarray(nodes,np.int64).reshape([-1,2])
+        if len(nodes)==0:
+            return
+        js=topology.match_edges(self.edges['nodes'],nodes[:,0],nodes[:,1],
+                                Nnodes=self.Nnodes(),
+                                valid=~self.edges['deleted'])
+        present=js>=0
+        assert not np.any(self.edges['constrained'][js[present]])
+        assert len(np.unique(js[present]))==present.sum(),"Duplicate constraints"
+        self.edges['constrained'][js[present]]=True
+
+        rest=nodes[~present]
+        if len(rest)==0:
+            return
+        mids=self.nodes['x'][rest].mean(axis=1)
+        # coarse buckets, ~4 constraints each, in serpentine row order
+        size=np.sqrt(4*np.prod(np.ptp(mids,axis=0).clip(1e-10,np.inf))/len(rest))
+        ij=np.floor((mids-mids.min(axis=0))/size).astype(np.int64)
+        ij[ij[:,1]%2==1,0]*=-1
+        for nA,nB in rest[np.lexsort( (ij[:,0],ij[:,1]) )]:
+            self.add_constraint(nA,nB)
+
     def remove_constraint(self,nA=None,nB=None,j=None):
         """ Assumes that there exists a constraint between nodes
         nA and nB (or that the edge given by j is constrained).
@@ -1818,49 +1969,65 @@ class Triangulation(unstructured_grid.UnstructuredGrid):
     def bulk_init_slow(self,points):
         raise Exception("No - it's really slow.  Don't do this.")
     
-    def bulk_init(self,points): # ExactDelaunay
+    def bulk_init(self,points,validate=True): # ExactDelaunay
+        """
+        Initialize from points using scipy's (floating point) Delaunay
+        triangulation.
+        validate: check orientations with the exact predicates, and flip
+          any edges which are not locally Delaunay by the exact test.
+        """
         if spatial is None:
             return self.bulk_init_slow(points)
         
         sdt = spatial.Delaunay(points)
 
         self.nodes=np.zeros( len(points), self.node_dtype)
-        self.cells=np.zeros( sdt.vertices.shape[0], self.cell_dtype)
+        self.cells=np.zeros( sdt.simplices.shape[0], self.cell_dtype)
 
         self.nodes['x']=points
-        self.cells['nodes']=sdt.vertices
-
-        # looks like it's CGAL style:
-        # neighbor[1] shares nodes[0] and nodes[2]
-        # vertices are CCW
-
-        for c in range(self.Ncells()):
-            for i,(a,b) in enumerate(circular_pairs(self.cells['nodes'][c])):
-                # first time - that would be i=0, and the first two nodes.
-                # but for neighbors, it's indexed by the opposite node.  so the edge
-                # connected the nodes[0]--nodes[1] corresponds with neighbor 2.
-                c_nbr=sdt.neighbors[c,(i+2)%3]
-
-                # c_nbr==-1 on convex hull.
-                # only worry about cases where c is larger.
-                if c<c_nbr:
-                    continue
-
-                if c_nbr<0:
-                    c_nbr=self.INF_CELL
-
-                j=self.add_edge(nodes=[a,b],
-                                cells=[c,c_nbr])
-                # and record in the cell, too
-                self.cells['edges'][c,i]=j
-                if c_nbr!=self.INF_CELL:
-                    nbr_nodes=self.cells['nodes'][c_nbr]
-                    for i_nbr in [0,1,2]:
-                        if nbr_nodes[i_nbr]==b and nbr_nodes[(i_nbr+1)%3]==a:
-                            self.cells['edges'][c_nbr,i_nbr]=j
-                            break
-                    else:
-                        assert False
+        self.cells['nodes']=sdt.simplices
+
+        # qhull simplices are CCW, so the first cell to reference an
+        # edge is on its left, as in add_edge(cells=[left,right])
+        edge_nodes,edge_cells,cell_edges=topology.edges_from_cells(self.cells['nodes'],
+                                                                   Nnodes=self.Nnodes())
+        edge_cells[edge_cells<0]=self.INF_CELL
+        self.edges=np.zeros( len(edge_nodes), self.edge_dtype)
+        self.edges['nodes']=edge_nodes
+        self.edges['cells']=edge_cells
+        self.cells['edges']=cell_edges
+        self.refresh_metadata()
+        self._hint_buckets=None
+
+        if validate:
+            self.bulk_init_validate()
+
+    def bulk_init_validate(self,max_rounds=100):
+        bad=self.check_orientations()
+        if len(bad):
+            raise ValueError("bulk_init: %d cells are degenerate or CW"%len(bad))
+        # Lawson flips, for edges where floating point got it wrong
+        for it in range(max_rounds):
+            js=self.local_delaunay_failures()[0]
+            if len(js)==0:
+                break
+            self.log.info("bulk_init: flipping %d edges"%len(js))
+            for j in js:
+                # earlier flips may have fixed this edge
+                if len(self.local_delaunay_failures_edge(j)):
+                    self.flip_edge(j)
+        else:
+            raise Exception("bulk_init: edge flips did not converge")
+
+    def local_delaunay_failures_edge(self,j):
+        c1,c2=self.edges['cells'][j]
+        if c1<0 or c2<0 or self.edges['constrained'][j]:
+            return []
+        n=[n for n in self.cells['nodes'][c2] if n not in self.edges['nodes'][j]][0]
+        pnts=self.nodes['x'][self.cells['nodes'][c1]]
+        if robust_predicates.incircle(pnts[0],pnts[1],pnts[2],self.nodes['x'][n])>0:
+            return [(c1,n)]
+        return []
 
             
 # Issues:
@@ -6,6 +6,7 @@ Largely a port of paver.py.
 """
 from __future__ import print_function
 import math
+import heapq
 import numpy as np
 from collections import defaultdict
 
@@ -19,7 +20,8 @@ from shapely import geometry
 
 from . import (unstructured_grid,
                exact_delaunay,
-               shadow_cdt)
+               shadow_cdt,
+               telemetry)
 
 from .. import utils
 
@@ -56,6 +58,36 @@ def circumcenter_py(p1,p2,p3):
              (b2*(p1x-p2x)-b1*(p1x-p3x))/dd + ref[1] ]
 
 
+def cost_cc_and_scale_batch(A,B,C,local_length):
+    """
+    Vectorized version of the 'cc_py' cost in AdvancingTriangles.cost_function.
+    A,B,C: [N,2] triangles, CCW, where C is the node being relaxed.
+    local_length: [N] target edge length.
+    returns [N] cost for each triangle.  The cost for a node is the sum over
+    its triangles.
+    """
+    # circumcenter, as in circumcenter_py, relative to A
+    p2=B-A
+    p3=C-A
+    dd=2.0*(p2[:,0]*p3[:,1] - p3[:,0]*p2[:,1])
+    dd=np.maximum(dd,1e-40)
+    b1=-(p2**2).sum(axis=1)
+    b2=-(p3**2).sum(axis=1)
+    cc=A + np.c_[ (-b1*p3[:,1]+b2*p2[:,1])/dd,
+                  (-b2*p2[:,0]+b1*p3[:,0])/dd ]
+
+    cost=np.zeros(len(A))
+    scale_cost=np.zeros(len(A))
+    for P,Q in [(A,B),(B,C),(C,A)]:
+        PQ=Q-P
+        mag=np.sqrt( (PQ**2).sum(axis=1) )
+        delta=cc-P
+        left=(PQ[:,0]*delta[:,1] - PQ[:,1]*delta[:,0])/mag
+        cost+=np.exp(np.minimum(100,-4.*left/mag))
+        scale_cost+=(mag-local_length)**2
+    return 50*cost + scale_cost/local_length**2
+
+
 # from numba import jit, int32, float64
 # @jit(nopython=True)
 # @jit
@@ -1232,6 +1264,129 @@ class QuadSite(FrontSite):
         return self.resample_status
 
         
+class SiteQueue(object):
+    """
+    Priority queue of front sites, updated incrementally as the grid
+    is edited.
+
+    Sites are identified by the half-edge which the subclass of AdvancingFront
+    uses to construct them (see front_halfedge_mask and site_for_halfedge).
+    Only metrics are stored; Site objects are created when a site is taken
+    from the queue.  Grid modifications mark the affected nodes dirty, and
+    the half-edges near dirty nodes are re-scored on the next call to best().
+    Stale heap entries are discarded lazily, so each step costs O(log n)
+    plus the local re-scoring.  Since reverting to a checkpoint goes through
+    the same grid methods, the queue also follows checkpoint/revert.
+
+    Direct writes to the grid arrays are not seen - call invalidate() or
+    touch_nodes() after such changes.
+    """
+    # grid methods which change topology or geometry, and how to find
+    # the affected nodes.
+    after_events=['add_edge','add_edges','add_cell','add_cells',
+                  'modify_node','modify_edge','modify_cell']
+    before_events=['delete_edge','delete_cell','modify_edge','modify_cell']
+
+    # name of the index argument for events which are not add_*
+    index_args={'delete_edge':'j','delete_cell':'i','modify_edge':'j',
+                'modify_cell':'c','modify_node':'n'}
+
+    def __init__(self,af):
+        self.af=af
+        self.grid=af.grid
+        self.stale=True
+        self.heap=[]
+        self.entries={} # (j,orient) => entry currently in heap
+        self.dirty=set() # nodes
+        for func_name in self.after_events:
+            self.grid.subscribe_after(func_name,self.on_after)
+        for func_name in self.before_events:
+            self.grid.subscribe_before(func_name,self.on_before)
+
+    def invalidate(self):
+        """ force a full rescan on the next call to best() """
+        self.stale=True
+
+    def touch_nodes(self,nodes):
+        """ nodes whose neighborhood has changed """
+        if not self.stale:
+            self.dirty.update(nodes)
+
+    def event_nodes(self,func_name,idx):
+        if func_name=='modify_node':
+            return [idx]
+        if 'edge' in func_name:
+            nodes=self.grid.edges['nodes'][idx]
+        else:
+            nodes=self.grid.cells['nodes'][idx]
+        nodes=np.asarray(nodes).ravel()
+        return nodes[nodes>=0]
+
+    def on_before(self,grid,func_name,*a,**k):
+        idx=a[0] if a else k[self.index_args[func_name]]
+        self.touch_nodes(self.event_nodes(func_name,idx))
+
+    def on_after(self,grid,func_name,*a,**k):
+        if func_name.startswith('add_'):
+            idx=k['return_value']
+        else:
+            idx=a[0] if a else k[self.index_args[func_name]]
+        self.touch_nodes(self.event_nodes(func_name,idx))
+
+    def push(self,j,orient):
+        key=(j,orient)
+        g=self.grid
+        if j<g.Nedges() and self.af.front_halfedge_mask([j])[0,orient]:
+            site=self.af.site_for_halfedge(j,orient)
+            entry=(site.metric(),j,orient)
+            self.entries[key]=entry
+            heapq.heappush(self.heap,entry)
+        else:
+            self.entries.pop(key,None)
+
+    def rebuild(self):
+        J,Orient=np.nonzero(self.af.front_halfedge_mask())
+        self.heap=[ (self.af.site_for_halfedge(j,orient).metric(),j,orient)
+                    for j,orient in zip(J,Orient) ]
+        heapq.heapify(self.heap)
+        self.entries={ (e[1],e[2]):e for e in self.heap }
+        self.dirty=set()
+        self.stale=False
+
+    def flush(self):
+        g=self.grid
+        # sites involve a node, its neighbors and the next node
+        # around, so rescore half-edges within one ring of dirty nodes
+        nodes=set()
+        for n in self.dirty:
+            if n<g.Nnodes() and not g.nodes['deleted'][n]:
+                nodes.add(n)
+                nodes.update(g.node_to_nodes(n))
+        self.dirty=set()
+        edges=set()
+        for n in nodes:
+            edges.update(g.node_to_edges(n))
+        for j in edges:
+            self.push(j,0)
+            self.push(j,1)
+
+    def best(self):
+        """ returns the lowest metric site, or None if the front is closed """
+        if self.stale:
+            self.rebuild()
+        elif self.dirty:
+            self.flush()
+        while self.heap:
+            metric,j,orient=entry=self.heap[0]
+            if self.entries.get( (j,orient) ) is entry:
+                # edges may have been deleted, or truncated by a revert
+                if j<self.grid.Nedges() and self.af.front_halfedge_mask([j])[0,orient]:
+                    return self.af.site_for_halfedge(j,orient)
+                del self.entries[(j,orient)]
+            heapq.heappop(self.heap)
+        return None
+
+
 class AdvancingFront(object):
     """
     Implementation of advancing front
@@ -1258,6 +1413,7 @@ class AdvancingFront(object):
         if grid is None:
             grid=unstructured_grid.UnstructuredGrid()
         self.grid = self.instrument_grid(grid)
+        self.site_queue=SiteQueue(self)
 
         self.curves=[]
 
@@ -1387,10 +1543,28 @@ class AdvancingFront(object):
                                     oring=curve_i+1,
                                     ring_sign=1 )
 
-    def enumerate_sites(self):
+    def front_halfedge_mask(self,js=slice(None)):
+        """
+        [N,2] boolean, for each edge in js and each side, whether that
+        half-edge defines a site.
+        """
         raise Exception("Implement in subclass")
 
+    def site_for_halfedge(self,j,orient):
+        raise Exception("Implement in subclass")
+
+    def enumerate_sites(self):
+        J,Orient=np.nonzero(self.front_halfedge_mask())
+        return [self.site_for_halfedge(j,orient)
+                for j,orient in zip(J,Orient)]
+
+    # choose sites from site_queue, rather than scoring all sites
+    # on each step.
+    incremental_sites=True
+
     def choose_site(self):
+        if self.incremental_sites:
+            return self.site_queue.best()
         sites=self.enumerate_sites()
         if len(sites):
             scores=[ site.metric()
@@ -1741,6 +1915,13 @@ class AdvancingFront(object):
         fn=self.cost_function(n)
         return (fn and fn(self.grid.nodes['x'][n]))
 
+    # 'fmin': relax nodes one at a time with scipy's fmin.
+    # 'batch': relax independent sets of FREE nodes together, with
+    #   vectorized Newton steps.  Requires batch_cost_function() from the
+    #   subclass, otherwise falls back to 'fmin'.
+    relax_method='fmin'
+    relax_iterations=20
+
     def optimize_nodes(self,nodes,max_levels=3,cost_thresh=2):
         """
         iterate over the given set of nodes, optimizing each location,
@@ -1750,10 +1931,13 @@ class AdvancingFront(object):
         max_cost=0
 
         for level in range(max_levels):
-            for n in nodes:
-                # relax_node can return 0 if there was no cost
-                # function to optimize
-                max_cost=max(max_cost,self.relax_node(n) or 0.0)
+            if self.relax_method=='batch':
+                max_cost=max(max_cost,self.relax_nodes_batch(nodes))
+            else:
+                for n in nodes:
+                    # relax_node can return 0 if there was no cost
+                    # function to optimize
+                    max_cost=max(max_cost,self.relax_node(n) or 0.0)
             if max_cost <= cost_thresh:
                 break
             if level==0:
@@ -1832,6 +2016,128 @@ class AdvancingFront(object):
             self.log.info("Relaxation caused intersection, reverting")
             return cost(x0)
         
+    def independent_sets(self,nodes):
+        """
+        Greedy coloring of nodes, such that no two nodes of the same color
+        share a cell.  The cost for a node depends only on the nodes of its
+        cells, so nodes of one color can be relaxed simultaneously.
+        returns a list of lists of nodes.
+        """
+        colors={}
+        sets=[]
+        for n in nodes:
+            taken=set()
+            for c in self.grid.node_to_cells(n):
+                for nbr in self.grid.cell_to_nodes(c):
+                    if nbr in colors:
+                        taken.add(colors[nbr])
+            color=0
+            while color in taken:
+                color+=1
+            colors[n]=color
+            if color==len(sets):
+                sets.append([])
+            sets[color].append(n)
+        return sets
+
+    def batch_cost_function(self,nodes):
+        """
+        Return a function taking [len(nodes),2] locations and returning the
+        [len(nodes)] costs, each evaluated as in cost_function(n) with the
+        other nodes held in place.  None if not supported.
+        """
+        return None
+
+    def relax_nodes_batch(self,nodes):
+        """
+        Batched equivalent of calling relax_node on each of nodes.  FREE
+        nodes are relaxed together, one independent set at a time.  SLIDE
+        nodes go through relax_slide_node.  Returns the maximum cost.
+        """
+        max_cost=0.0
+        free=[]
+        for n in nodes:
+            if self.grid.nodes['fixed'][n]==self.FREE:
+                free.append(n)
+            else:
+                max_cost=max(max_cost,self.relax_node(n) or 0.0)
+        for group in self.independent_sets(free):
+            max_cost=max(max_cost,self.relax_free_nodes(group))
+        return max_cost
+
+    def relax_free_nodes(self,nodes):
+        """
+        Simultaneously relax FREE nodes, none of which share a cell.
+        Takes damped Newton steps with a diagonal Hessian from central
+        differences, falling back to gradient steps where the curvature is
+        not positive.  Each node keeps its own step size and stops on its
+        own.  The moves are then applied one at a time, reverting any that
+        intersect constraints in the CDT.  Returns the maximum final cost.
+        """
+        nodes=np.asarray(nodes)
+        cost=self.batch_cost_function(nodes)
+        if cost is None:
+            return max([self.relax_free_node(n) or 0.0 for n in nodes]+[0.0])
+
+        X0=self.grid.nodes['x'][nodes].copy()
+        L=np.asarray(self.scale(X0),np.float64)*np.ones(len(nodes))
+        h=1e-4*L
+        X=X0.copy()
+        f=cost(X)
+        active=np.ones(len(nodes),np.bool_)
+
+        for it in range(self.relax_iterations):
+            if not np.any(active):
+                break
+            grad=np.zeros_like(X)
+            hess=np.zeros_like(X)
+            for dim in [0,1]:
+                dX=np.zeros_like(X)
+                dX[:,dim]=h
+                f_plus=cost(X+dX)
+                f_minus=cost(X-dX)
+                grad[:,dim]=(f_plus-f_minus)/(2*h)
+                hess[:,dim]=(f_plus-2*f+f_minus)/h**2
+            newton=np.all(hess>0,axis=1)
+            step=np.where(newton[:,None],-grad/np.where(hess>0,hess,1.0),-grad)
+            # limit each step to a fraction of the local scale
+            mag=utils.mag(step)
+            limit=0.25*L
+            step*=np.where(mag>limit,limit/np.where(mag>0,mag,1.0),1.0)[:,None]
+            step[~active]=0.0
+
+            # per-node backtracking
+            alpha=np.ones(len(nodes))
+            accepted=np.zeros(len(nodes),np.bool_)
+            for bt in range(8):
+                trial=~accepted & active
+                if not np.any(trial):
+                    break
+                X_trial=X+(alpha*trial)[:,None]*step
+                f_trial=cost(X_trial)
+                better=trial & (f_trial<f)
+                X[better]=X_trial[better]
+                f[better]=f_trial[better]
+                accepted|=better
+                alpha[trial & ~better]*=0.5
+            moved=utils.mag(alpha[:,None]*step)
+            active&=accepted & (moved>1e-4*L)
+
+        max_cost=0.0
+        for i,n in enumerate(nodes):
+            if np.all(X[i]==X0[i]):
+                max_cost=max(max_cost,f[i])
+                continue
+            cp=self.grid.checkpoint()
+            try:
+                self.grid.modify_node(n,x=X[i])
+                max_cost=max(max_cost,f[i])
+            except self.cdt.IntersectingConstraints as exc:
+                self.grid.revert(cp)
+                self.log.info("Relaxation caused intersection, reverting")
+                max_cost=max(max_cost,cost(X0)[i])
+        return max_cost
+
     def relax_slide_node(self,n):
         cost_free=self.cost_function(n)
         if cost_free is None:
@@ -1846,6 +2152,11 @@ class AdvancingFront(object):
         local_length=self.scale( x0 )
 
         slide_limits=self.find_slide_limits(n,3*local_length)
+        if self.curves[ring].closed:
+            # the limits may be shifted by a period relative to f0,
+            # otherwise the slide goes the long way around the ring
+            L=self.curves[ring].total_distance()
+            f0=slide_limits[0] + (f0-slide_limits[0])%L
 
         # used to just be f, but I think it's more appropriate to
         # be f[0]
@@ -2080,23 +2391,54 @@ class AdvancingFront(object):
         self.grid.modify_node(n,x=curve(new_f),ring_f=new_f)
 
     loop_count=0
-    def loop(self,count=0):
-        while 1:
-            site=self.choose_site()
-            if site is None:
-                break
-            if not self.advance_at_site(site):
-                self.log.error("Failed to advance. Exiting loop early")
-                return False
-            count-=1
-            self.loop_count+=1
-            if count==0:
-                break
+    # per-step timings, see telemetry.Telemetry.  The null default
+    # records nothing.
+    telemetry=telemetry.null
+
+    def loop(self,count=0,telemetry=None):
+        """
+        Advance the front until it is complete, or for count steps if
+        nonzero.  Returns False if a step failed.
+        telemetry: a telemetry.Telemetry to record per-step timings in,
+          which is kept as self.telemetry.
+        """
+        if telemetry is not None:
+            self.telemetry=telemetry
+        tel=self.telemetry
+        if tel.enabled:
+            self.instrument_telemetry(tel)
+        try:
+            while 1:
+                tel.start_step()
+                with tel.timer('site'):
+                    site=self.choose_site()
+                if site is None:
+                    tel.discard_step() # finished, not a step
+                    break
+                if not self.advance_at_site(site):
+                    self.log.error("Failed to advance. Exiting loop early")
+                    return False
+                tel.end_step()
+                count-=1
+                self.loop_count+=1
+                if count==0:
+                    break
+        finally:
+            tel.end_step()
+            tel.uninstrument()
         return True
-            
+
+    def instrument_telemetry(self,tel):
+        """ time the CDT updates and grid reverts during loop() """
+        tel.instrument(self.cdt,['add_node','modify_node','delete_node',
+                                 'add_constraint','remove_constraint'],'cdt')
+        tel.instrument(self.grid,['revert'],'revert')
+
     def advance_at_site(self,site):
+        tel=self.telemetry
         # This can modify site! May also fail.
-        resampled_success = self.resample_neighbors(site)
+        with tel.timer('resample'):
+            resampled_success = self.resample_neighbors(site)
         
         actions=site.actions()
         metrics=[a.metric(site) for a in actions]
@@ -2105,8 +2447,10 @@ class AdvancingFront(object):
             try:
                 cp=self.grid.checkpoint()
                 self.log.info("Chose strategy %s"%( actions[best] ) )
-                edits=actions[best].execute(site)
-                opt_edits=self.optimize_edits(edits)
+                with tel.timer('strategy'):
+                    edits=actions[best].execute(site)
+                with tel.timer('optimize'):
+                    opt_edits=self.optimize_edits(edits)
                 
                 failures=self.check_edits(opt_edits)
                 if len(failures['cells'])>0:
@@ -2117,10 +2461,12 @@ class AdvancingFront(object):
                 # arguably, this should be caught lower down, and rethrown
                 # as a StrategyFailed.
                 self.log.error("Intersecting constraints - rolling back")
+                tel.count('fail_'+actions[best].__class__.__name__)
                 self.grid.revert(cp)
                 continue
             except StrategyFailed as exc:
                 self.log.error("Strategy failed - rolling back")
+                tel.count('fail_'+actions[best].__class__.__name__)
                 self.grid.revert(cp)
                 continue
             break
@@ -2165,25 +2511,19 @@ class AdvancingTriangles(AdvancingFront):
     def set_edge_scale(self,scale):
         self.scale=scale
 
-    def enumerate_sites(self):
-        sites=[]
-        # FIX: This doesn't scale!
-        valid=(self.grid.edges['cells'][:,:]==self.grid.UNMESHED) 
-        J,Orient = np.nonzero(valid)
-
-        for j,orient in zip(J,Orient):
-            if self.grid.edges['deleted'][j]:
-                continue
-            he=self.grid.halfedge(j,orient)
-            he_nxt=he.fwd()
-            a=he.node_rev()
-            b=he.node_fwd()
-            bb=he_nxt.node_rev()
-            c=he_nxt.node_fwd()
-            assert b==bb
+    def front_halfedge_mask(self,js=slice(None)):
+        return ( (self.grid.edges['cells'][js,:]==self.grid.UNMESHED)
+                 & (~self.grid.edges['deleted'][js])[:,None] )
 
-            sites.append( TriangleSite(self,nodes=[a,b,c]) )
-        return sites
+    def site_for_halfedge(self,j,orient):
+        he=self.grid.halfedge(j,orient)
+        he_nxt=he.fwd()
+        a=he.node_rev()
+        b=he.node_fwd()
+        bb=he_nxt.node_rev()
+        c=he_nxt.node_fwd()
+        assert b==bb
+        return TriangleSite(self,nodes=[a,b,c])
 
     def check_edits(self,edits):
         """
@@ -2316,6 +2656,31 @@ class AdvancingTriangles(AdvancingFront):
         else:
             assert False
 
+    def batch_cost_function(self,nodes):
+        if self.cost_method!='cc_py':
+            return None
+        # one row per (node,cell), with A,B the other nodes of the cell in
+        # CCW order, as in cost_function
+        rows=[]
+        AB=[]
+        for i,n in enumerate(nodes):
+            for c in self.grid.node_to_cells(n):
+                cn=self.grid.cell_to_nodes(c)
+                k=list(cn).index(n)
+                rows.append(i)
+                AB.append( [cn[(k+1)%3],cn[(k+2)%3]] )
+        rows=np.array(rows,np.int64)
+        AB=np.array(AB,np.int64).reshape([-1,2])
+        A=self.grid.nodes['x'][AB[:,0]]
+        B=self.grid.nodes['x'][AB[:,1]]
+        local_length=np.asarray(self.scale(self.grid.nodes['x'][nodes]),np.float64)
+        local_length=(local_length*np.ones(len(nodes)))[rows]
+
+        def cost(X):
+            per_cell=cost_cc_and_scale_batch(A,B,X[rows],local_length)
+            return np.bincount(rows,weights=per_cell,minlength=len(nodes))
+        return cost
+
 
 #### 
 
@@ -2393,6 +2758,7 @@ class AdvancingQuads(AdvancingFront):
                 self.grid.nodes['fixed'][n]=self.RIGID
 
         # and mark the internal edges as unmeshed:
+        self.site_queue.invalidate()
         for na,nb in utils.circular_pairs(pc):
             j=self.grid.nodes_to_edge([na,nb])
             if self.grid.edges['nodes'][j,0]==na:
@@ -2421,25 +2787,19 @@ class AdvancingQuads(AdvancingFront):
             
     def orient_quad_edge(self,j,orient):
         self.grid.edges['para'][j]=orient
+        self.site_queue.touch_nodes(self.grid.edges['nodes'][j])
 
-    def enumerate_sites(self):
-        sites=[]
-        # FIX: This doesn't scale!
-        valid=(self.grid.edges['cells'][:,:]==self.grid.UNMESHED)& (self.grid.edges['para']!=0)[:,None]
-        J,Orient = np.nonzero(valid)
-
-        for j,orient in zip(J,Orient):
-            if self.grid.edges['deleted'][j]:
-                continue
-            he=self.grid.halfedge(j,orient)
-            he_nxt=he.fwd()
-            a=he.rev().node_rev()
-            b=he.node_rev()
-            c=he.node_fwd()
-            d=he.fwd().node_fwd()
+    def front_halfedge_mask(self,js=slice(None)):
+        return ( (self.grid.edges['cells'][js,:]==self.grid.UNMESHED)
+                 & (~self.grid.edges['deleted'][js] & (self.grid.edges['para'][js]!=0))[:,None] )
 
-            sites.append( QuadSite(self,nodes=[a,b,c,d]) )
-        return sites
+    def site_for_halfedge(self,j,orient):
+        he=self.grid.halfedge(j,orient)
+        a=he.rev().node_rev()
+        b=he.node_rev()
+        c=he.node_fwd()
+        d=he.fwd().node_fwd()
+        return QuadSite(self,nodes=[a,b,c,d])
 
     def cost_function(self,n):
         local_para = self.para_scale
@@ -2531,12 +2891,16 @@ class DTNode(object):
     def try_child(self,i):
         assert False # implemented by subclass
         
-    def best_child(self,count=0,cb=None):
+    def best_child(self,count=0,cb=None,search=None):
         """
         Try all, (or up to count) children, 
         use the best one based on post scores.
         If no children succeeded, return False, otherwise True
+        search: optional DTSearch for bounded look-ahead, in which case
+        count is ignored.
         """
+        if search is not None:
+            return search.best_child(self,cb=cb)
         if count:
             count=min(count,len(self.options))
         else:
@@ -2599,9 +2963,10 @@ class DTChooseSite(DTNode):
         self.active_child=i
         return True
     
-    def best_child(self,count=0,cb=None):
+    def best_child(self,count=0,cb=None,search=None):
         """
-        For choosing a site, prior is same as posterior
+        For choosing a site, prior is same as posterior, so the search
+        is not used.
         """
         if count:
             count=min(count,len(self.options))
@@ -2663,3 +3028,169 @@ class DTChooseStrategy(DTNode):
                         for n in nodes] )
         self.child_post[i]=cost
         return True
+
+
+class DTSearch(object):
+    """
+    Bounded look-ahead when choosing a strategy in the decision tree.
+
+    Each of the beam_width best children by prior is tried, and scored by
+    its posterior cost plus discount times the best score found by
+    continuing from the first site of the resulting state, down to depth
+    levels in total.  After scoring, the grid is reverted and the winner
+    is replayed.  depth=1 is the same as DTNode.best_child(count=beam_width).
+
+    Scores are cached by a signature of the strategy, the remaining depth
+    and the coordinates of the site nodes and their neighbors, so states
+    seen again in a later decision are not recomputed.  This is
+    approximate, as the outcome of a strategy can depend on the grid
+    beyond that neighborhood.
+
+    time_budget: seconds per decision.  Once exceeded, no further
+    look-ahead is started, and the remaining children are skipped as
+    soon as one has succeeded.
+
+    stats counts decisions, children tried, cache hits and misses,
+    timeouts, and how often the choice differs from the best prior
+    ('changed_prior') or from the best posterior without look-ahead
+    ('changed_greedy').
+
+    Usage:
+      search=DTSearch(beam_width=3,depth=2)
+      af.current=af.root=DTChooseSite(af)
+      search.loop(af)
+    """
+    # added to the score of a child when none of its own children succeed
+    fail_penalty=1e6
+
+    def __init__(self,beam_width=3,depth=2,time_budget=None,
+                 discount=1.0,cache_size=10000):
+        self.beam_width=beam_width
+        self.depth=depth
+        self.time_budget=time_budget
+        self.discount=discount
+        self.cache_size=cache_size
+        self.cache={}
+        self.stats=defaultdict(int)
+        self.deadline=None
+
+    def expired(self):
+        return (self.deadline is not None) and (time.time()>self.deadline)
+
+    def signature(self,node,i,depth):
+        g=node.af.grid
+        site_nodes=getattr(node.site,'abc',None)
+        if site_nodes is None:
+            site_nodes=node.site.abcd
+        nbrs=set(site_nodes)
+        for n in site_nodes:
+            nbrs.update(g.node_to_nodes(n))
+        nbrs=sorted(nbrs)
+        strategy=node.options[node.child_order[i]]
+        return (strategy.__class__.__name__,depth,
+                tuple(site_nodes),tuple(nbrs),
+                g.nodes['x'][nbrs].tobytes())
+
+    def score_children(self,node,depth):
+        """
+        node: DTChooseStrategy, with af state at node.
+        returns list of (child index, score, posterior) for children
+        which succeeded, and leaves af state at node.
+        """
+        results=[]
+        for i in range(min(self.beam_width,len(node.options))):
+            if self.expired() and results:
+                self.stats['timeouts']+=1
+                break
+            key=self.signature(node,i,depth)
+            if key in self.cache:
+                self.stats['cache_hits']+=1
+                if self.cache[key] is not None:
+                    results.append( (i,)+self.cache[key] )
+                continue
+            self.stats['cache_misses']+=1
+            self.stats['children']+=1
+            if not node.try_child(i):
+                self.stats['failed']+=1
+                self.remember(key,None)
+                continue
+            post=node.child_post[i]
+            score=post
+            if depth>1 and self.expired():
+                self.stats['timeouts']+=1
+                if results:
+                    # would not be comparable with the children already scored
+                    node.revert_to_here()
+                    break
+            elif depth>1:
+                score+=self.discount*self.future(node.children[i],depth-1)
+            node.revert_to_here()
+            if not self.expired():
+                self.remember(key,(score,post))
+            results.append( (i,score,post) )
+        return results
+
+    def future(self,site_node,depth):
+        """
+        site_node: DTChooseSite, with af state at site_node.  Best score
+        of the first site, which leaves af state somewhere below site_node.
+        """
+        if not site_node.options:
+            return 0.0 # front is complete
+        site_node.try_child(0)
+        results=self.score_children(site_node.children[0],depth)
+        if not results:
+            return self.fail_penalty
+        return min(score for i,score,post in results)
+
+    def remember(self,key,value):
+        if len(self.cache)>=self.cache_size:
+            self.cache.clear()
+        self.cache[key]=value
+
+    def best_child(self,node,cb=None):
+        """
+        Choose and apply a child of node, using look-ahead for
+        DTChooseStrategy nodes.  Returns True on success.
+        """
+        if not isinstance(node,DTChooseStrategy):
+            return node.best_child(cb=cb)
+
+        if self.time_budget is not None:
+            self.deadline=time.time()+self.time_budget
+        try:
+            results=self.score_children(node,self.depth)
+        finally:
+            self.deadline=None
+        self.stats['decisions']+=1
+        if not results:
+            return False
+
+        best=min(results,key=lambda r: r[1])[0]
+        greedy=min(results,key=lambda r: r[2])[0]
+        if best!=0:
+            self.stats['changed_prior']+=1
+        if best!=greedy:
+            self.stats['changed_greedy']+=1
+
+        if not node.try_child(best):
+            # the cached result was stale
+            self.stats['failed']+=1
+            return node.best_child(cb=cb)
+        if cb: cb()
+        return True
+
+    def loop(self,af,count=0):
+        """
+        Advance af.current until the front is complete, or for count
+        decisions if nonzero.  Returns False if a decision failed.
+        """
+        while 1:
+            if not af.current.children:
+                break
+            if not self.best_child(af.current):
+                return False
+            count-=1
+            if count==0:
+                break
+        return True
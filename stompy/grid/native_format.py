@@ -0,0 +1,181 @@
+"""
+Compact binary container for UnstructuredGrid.
+
+The file holds the raw nodes, edges and cells structured arrays, including
+any extra fields, plus optional precomputed blocks (node adjacency, element
+bounding boxes).  Layout:
+
+  magic     8 bytes, b'STOMPYUG'
+  version   uint16, little endian
+  hlen      uint32, little endian, length of the header
+  header    python literal dict, as in the .npy format, padded with spaces
+  blocks    raw array data, each starting on an ALIGN byte boundary
+
+The header lists each block by name, with its numpy dtype descr, shape and
+byte offset.  Since blocks are stored exactly as they are in memory, a file
+can be opened with numpy.memmap and the grid arrays used without copying.
+With mmap_mode='c' (the default), pages are read on demand and shared
+between processes opening the same file, until a process modifies them.
+"""
+from __future__ import print_function
+
+import ast
+import struct
+import logging
+
+import numpy as np
+
+from . import topology, element_index
+
+log=logging.getLogger(__name__)
+
+MAGIC=b'STOMPYUG'
+FORMAT_VERSION=1
+ALIGN=64
+
+# optional blocks
+ADJACENCY_BLOCKS=['node_to_edges','node_to_cells']
+
+
+def _aligned(n):
+    return ALIGN*((n+ALIGN-1)//ALIGN)
+
+
+def _header_bytes(header):
+    """ encode header, padded so that the first block is aligned """
+    text=repr(header).encode('ascii')
+    prefix=len(MAGIC)+2+4
+    hlen=_aligned(prefix+len(text)+1) - prefix
+    return text + b' '*(hlen-len(text)-1) + b'\n'
+
+
+def grid_blocks(g,adjacency=True,indices=False):
+    """
+    The arrays to write for grid g, as a list of (name,array).
+    adjacency: include node_to_edges and node_to_cells in CSR form.
+    indices: include edge and cell bounding boxes for the element indices.
+    """
+    blocks=[('nodes',g.nodes),
+            ('edges',g.edges),
+            ('cells',g.cells)]
+    if adjacency:
+        for name in ADJACENCY_BLOCKS:
+            offsets,idxs=getattr(g,name+'_csr')()
+            blocks.append( (name+'.offsets',offsets.astype(np.int64)) )
+            blocks.append( (name+'.indices',idxs.astype(np.int32)) )
+    if indices:
+        blocks.append( ('edge_boxes',g.edge_index().boxes[:g.Nedges()]) )
+        blocks.append( ('cell_boxes',g.cell_index().boxes[:g.Ncells()]) )
+    return blocks
+
+
+def write_grid(g,fn,adjacency=True,indices=False):
+    """
+    Write grid g to fn.  See grid_blocks() for the options.
+    """
+    blocks=[(name,np.ascontiguousarray(arr)) for name,arr in grid_blocks(g,adjacency,indices)]
+
+    header={'version':FORMAT_VERSION,
+            'max_sides':int(g.max_sides),
+            'grid_class':g.__class__.__name__,
+            'blocks':[]}
+
+    # Offsets depend on the header length, which depends on the offsets.
+    # Iterate until the padded header length is stable.
+    hlen=0
+    while 1:
+        offset=len(MAGIC)+2+4+hlen
+        header['blocks']=[]
+        for name,arr in blocks:
+            offset=_aligned(offset)
+            header['blocks'].append( {'name':name,
+                                      'descr':np.lib.format.dtype_to_descr(arr.dtype),
+                                      'shape':arr.shape,
+                                      'offset':offset} )
+            offset+=arr.nbytes
+        text=_header_bytes(header)
+        if len(text)==hlen:
+            break
+        hlen=len(text)
+
+    with open(fn,'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('<HI',FORMAT_VERSION,len(text)))
+        fp.write(text)
+        for (name,arr),info in zip(blocks,header['blocks']):
+            fp.write(b'\0'*(info['offset']-fp.tell()))
+            arr.tofile(fp)
+
+
+def read_header(fn):
+    with open(fn,'rb') as fp:
+        magic=fp.read(len(MAGIC))
+        if magic!=MAGIC:
+            raise ValueError("%s is not a native grid file"%fn)
+        version,hlen=struct.unpack('<HI',fp.read(6))
+        if version>FORMAT_VERSION:
+            raise ValueError("%s has format version %d, newer than supported (%d)"%
+                             (fn,version,FORMAT_VERSION))
+        header=ast.literal_eval(fp.read(hlen).decode('ascii'))
+    return header
+
+
+def read_blocks(fn,mmap_mode='c'):
+    """
+    returns header, and a dict of name => array.
+    mmap_mode: 'r' read-only memory map, 'c' copy-on-write memory map,
+    None to read into memory.
+    """
+    header=read_header(fn)
+    result={}
+    mm=None
+    if mmap_mode is not None:
+        mm=np.memmap(fn,dtype=np.uint8,mode=mmap_mode)
+
+    with open(fn,'rb') as fp:
+        for info in header['blocks']:
+            dtype=np.lib.format.descr_to_dtype(info['descr'])
+            shape=tuple(info['shape'])
+            count=int(np.prod(shape))
+            if count==0:
+                arr=np.zeros(shape,dtype)
+            elif mm is not None:
+                arr=np.ndarray(shape,dtype=dtype,buffer=mm,offset=info['offset'])
+            else:
+                fp.seek(info['offset'])
+                arr=np.fromfile(fp,dtype=dtype,count=count).reshape(shape)
+            result[info['name']]=arr
+    return header,result
+
+
+def read_grid(fn,mmap_mode='c',grid_class=None):
+    """
+    Load a grid written by write_grid.
+    mmap_mode: see read_blocks.  With 'r' the grid arrays are read-only, and
+      any modification of the grid, including caching of cell centers and
+      areas, will fail.
+    grid_class: class to instantiate, defaulting to UnstructuredGrid.
+    """
+    if grid_class is None:
+        from .unstructured_grid import UnstructuredGrid as grid_class
+
+    header,blocks=read_blocks(fn,mmap_mode=mmap_mode)
+
+    g=grid_class(max_sides=header['max_sides'])
+    # adopt the stored dtypes, which include any extra fields
+    for name in ['nodes','edges','cells']:
+        arr=blocks[name]
+        setattr(g,name[:-1]+'_dtype',arr.dtype.descr)
+        setattr(g,name,arr)
+    g.refresh_metadata()
+
+    for name in ADJACENCY_BLOCKS:
+        if name+'.offsets' in blocks:
+            adj=topology.Adjacency.from_csr(blocks[name+'.offsets'],
+                                            blocks[name+'.indices'])
+            setattr(g,'_'+name,adj)
+    if 'edge_boxes' in blocks:
+        g._edge_index=element_index.EdgeIndex(g,boxes=blocks['edge_boxes'])
+    if 'cell_boxes' in blocks:
+        g._cell_index=element_index.CellIndex(g,boxes=blocks['cell_boxes'])
+    return g
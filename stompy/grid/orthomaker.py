@@ -267,9 +267,9 @@ class OrthoMaker(trigrid.TriGrid):
         if len(self.cells) > 0:
             angles = self.tri_angles(subset)
             if subset is not None:
-                return subset[find( angles.max(axis=1) > self.max_angle )]
+                return subset[nonzero( angles.max(axis=1) > self.max_angle )[0]]
             else:
-                return find( angles.max(axis=1) > self.max_angle )
+                return nonzero( angles.max(axis=1) > self.max_angle )[0]
         else:
             return array([],int32)
     
@@ -410,7 +410,7 @@ class OrthoMaker(trigrid.TriGrid):
 
         ### Test 2: is the node with the bad angle an internal node with
         ##    4 cells?
-        bad_node = self.cells[bad_cell,find(angles > self.max_angle)[0] ]
+        bad_node = self.cells[bad_cell,nonzero(angles > self.max_angle)[0][0] ]
         
         bad_nodes_cells = self.pnt2cells(bad_node)
         total_angle = self.boundary_angle(bad_node)
@@ -501,8 +501,8 @@ class OrthoMaker(trigrid.TriGrid):
         # cells, this would be where, but I think all of the interesting
         # stuff is in the edges.
 
-        cellA_edges = find( any(self.edges[:,3:]==cellA,axis=1) )
-        cellB_edges = find( any(self.edges[:,3:]==cellB,axis=1) )
+        cellA_edges = nonzero( any(self.edges[:,3:]==cellA,axis=1) )[0]
+        cellB_edges = nonzero( any(self.edges[:,3:]==cellB,axis=1) )[0]
 
         common_edge = intersect1d(cellA_edges,cellB_edges)
         dead_node_edges = self.pnt2edges(dead_node)
@@ -524,7 +524,7 @@ class OrthoMaker(trigrid.TriGrid):
 
         # this should create one edge that now has new_cell_id on
         # both sides, which is the edge we want to delete outright
-        dead_edge = find( all(self.edges[:,3:]==new_cell_id,axis=1) )[0]
+        dead_edge = nonzero( all(self.edges[:,3:]==new_cell_id,axis=1) )[0][0]
 
         edges_to_merge = setdiff1d( dead_node_edges, [dead_edge] )
         self.edges[dead_edge,:] = -1
@@ -618,7 +618,7 @@ class OrthoMaker(trigrid.TriGrid):
         # plot edges:
         edge_list = array([],int32)
         for c in c_list:
-            edge_list = concatenate( (edge_list,find(any(self.edges[:,3:]==c,axis=1))) )
+            edge_list = concatenate( (edge_list,nonzero(any(self.edges[:,3:]==c,axis=1))[0]) )
 
         for e in unique(edge_list):
             if self.edges[e,4] < 0:
@@ -1045,7 +1045,7 @@ class OrthoMaker(trigrid.TriGrid):
         for nbr_cell in self.pnt2cells(free_node):
             # rotate the node list so the free node is first
             nodes = self.cells[nbr_cell]
-            bring_to_front = find(nodes==free_node)[0]
+            bring_to_front = nonzero(nodes==free_node)[0][0]
 
             nodes = nodes[ (arange(3)+bring_to_front)%3 ]
             # now nodes[0] is our free node...
@@ -1178,7 +1178,7 @@ class OrthoMaker(trigrid.TriGrid):
             # rotate the node list so the free node is first
             nbr_cell = nbr_cells[i]
             nodes = self.cells[nbr_cell]
-            bring_to_front = find(nodes==free_node)[0]
+            bring_to_front = nonzero(nodes==free_node)[0][0]
             nodes = nodes[ (arange(3)+bring_to_front)%3 ]
             # now nodes[0] is our free node...
 
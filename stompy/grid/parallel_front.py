@@ -0,0 +1,234 @@
+"""
+Parallel advancing-front generation over multiple regions.
+
+The domain is split into regions along cut lines, either given or chosen
+to give regions of roughly equal area.  Every boundary, including the
+seams along the cuts, is discretized once up front, so regions on either
+side of a seam share exactly the same seam nodes.  Seam nodes and edges
+are RIGID, while the rest of each region's boundary is paved as usual.
+Each region is paved in its own process, and the grids are merged by
+matching the shared seam nodes.
+
+Disconnected parts of a MultiPolygon are separate regions even with no
+cuts.
+
+Usage:
+  pf=ParallelFront(poly,scale=field.ConstantField(50),n_regions=4)
+  g=pf.execute()
+"""
+from __future__ import print_function
+
+import logging
+import multiprocessing
+
+import numpy as np
+from scipy import optimize as opt
+from shapely import geometry, ops
+from shapely.geometry import polygon as shp_polygon
+
+from . import unstructured_grid, front
+from ..spatial import linestring_utils
+from .. import utils
+
+log=logging.getLogger(__name__)
+
+
+def as_polygon(poly):
+    """
+    poly: shapely Polygon or MultiPolygon, or a list of rings where
+    the first is the exterior and the rest are islands.
+    """
+    if isinstance(poly,(geometry.Polygon,geometry.MultiPolygon)):
+        return poly
+    rings=[np.asarray(r) for r in poly]
+    return geometry.Polygon(rings[0],rings[1:])
+
+
+def choose_cuts(poly,n_regions):
+    """
+    Straight cut lines across the longer dimension of poly's bounds,
+    placed so that the n_regions strips have equal area.
+    returns a list of LineStrings.
+    """
+    xmin,ymin,xmax,ymax=poly.bounds
+    pad=0.01*max(xmax-xmin,ymax-ymin)
+    horizontal=(xmax-xmin)>=(ymax-ymin)
+    total=poly.area
+
+    def area_below(c):
+        if horizontal:
+            box=geometry.box(xmin-pad,ymin-pad,c,ymax+pad)
+        else:
+            box=geometry.box(xmin-pad,ymin-pad,xmax+pad,c)
+        return poly.intersection(box).area
+
+    lo,hi=(xmin,xmax) if horizontal else (ymin,ymax)
+    cuts=[]
+    for k in range(1,n_regions):
+        target=total*k/float(n_regions)
+        c=opt.brentq(lambda c: area_below(c)-target,lo,hi,xtol=1e-6*(hi-lo))
+        if horizontal:
+            cuts.append(geometry.LineString([[c,ymin-pad],[c,ymax+pad]]))
+        else:
+            cuts.append(geometry.LineString([[xmin-pad,c],[xmax+pad,c]]))
+    return cuts
+
+
+def _line_parts(geom):
+    if geom.is_empty:
+        return []
+    if geom.geom_type=='LineString':
+        return [geom]
+    if hasattr(geom,'geoms'):
+        return [part for g in geom.geoms for part in _line_parts(g)]
+    return [] # points from a cut grazing the boundary
+
+
+def split_regions(poly,cuts,scale):
+    """
+    Discretize the boundaries of poly and the cut lines with the given
+    scale, and split poly into regions along the cuts.
+
+    returns a list of regions, each a list of rings (exterior first,
+    islands after), each ring a tuple (points [N,2], seam [N]) where
+    seam[i] is True if the segment points[i]--points[i+1] lies on a cut.
+    Exteriors are CCW, islands CW.
+    """
+    boundary=_line_parts(poly.boundary)
+    seams=[part for cut in cuts
+           for part in _line_parts(cut.intersection(poly))]
+
+    # node all of the linework at intersections, then discretize each
+    # piece once so that neighboring regions see the same points.
+    noded=_line_parts(ops.unary_union(boundary+seams))
+    tol=1e-9*max(poly.bounds[2]-poly.bounds[0],
+                 poly.bounds[3]-poly.bounds[1])
+    poly_bdry=poly.boundary
+    dense=[]
+    seam_pnts=set()
+    for line in noded:
+        pnts=linestring_utils.upsample_linearring(np.array(line.coords),scale,closed_ring=0)
+        dense.append(geometry.LineString(pnts))
+        mid=line.interpolate(0.5,normalized=True)
+        if poly_bdry.distance(mid)>tol:
+            seam_pnts.update( tuple(p) for p in pnts )
+
+    regions=[]
+    for piece in ops.polygonize(dense):
+        if not poly.contains(piece.representative_point()):
+            continue
+        piece=shp_polygon.orient(piece,1.0)
+        rings=[]
+        for ring in [piece.exterior]+list(piece.interiors):
+            pnts=np.array(ring.coords)[:-1]
+            nxt=np.roll(pnts,-1,axis=0)
+            seam=np.zeros(len(pnts),np.bool_)
+            for i in range(len(pnts)):
+                if (tuple(pnts[i]) in seam_pnts) and (tuple(nxt[i]) in seam_pnts):
+                    mid=geometry.Point(0.5*(pnts[i]+nxt[i]))
+                    seam[i]=poly_bdry.distance(mid)>tol
+            rings.append( (pnts,seam) )
+        regions.append(rings)
+    return regions
+
+
+def pave_region(rings,scale,front_class=front.AdvancingTriangles,count=0):
+    """
+    Pave a single region from split_regions.  Module-level so that it
+    can run in a worker process.
+    count: passed to loop(), 0 to pave until finished.
+    returns (success,grid), where grid is a plain UnstructuredGrid copy.
+    """
+    af=front_class()
+    af.set_edge_scale(scale)
+    g=af.grid
+
+    for ring_i,(pnts,seam) in enumerate(rings):
+        nodes=np.array([g.add_node(x=p) for p in pnts])
+        for a,b in utils.circular_pairs(nodes):
+            g.add_edge(nodes=[a,b],
+                       cells=[g.UNMESHED,g.UNDEFINED])
+        af.add_curve(nodes=nodes,interior=(ring_i>0))
+
+        nxt=np.roll(nodes,-1)
+        for i in np.nonzero(seam)[0]:
+            g.nodes['fixed'][ [nodes[i],nxt[i]] ]=af.RIGID
+            g.edges['fixed'][g.nodes_to_edge([nodes[i],nxt[i]])]=af.RIGID
+    af.site_queue.invalidate()
+
+    success=af.loop(count=count)
+    if not success:
+        log.error("Region with %d boundary nodes failed to pave"%
+                  sum(len(r[0]) for r in rings))
+    return success,g.copy()
+
+
+def _pave_region_args(args):
+    return pave_region(*args)
+
+
+class ParallelFront(object):
+    """
+    Split a domain into regions, pave the regions in parallel, and
+    merge the results.
+    """
+    front_class=front.AdvancingTriangles
+
+    def __init__(self,poly,scale,cuts=None,n_regions=None,
+                 processes=None,tolerance=0.0,count=0):
+        """
+        poly: domain, see as_polygon()
+        scale: edge scale field, as for AdvancingTriangles.set_edge_scale.
+          Must be picklable when processes!=1.
+        cuts: list of LineStrings to split along.  If None and n_regions
+          is given, cuts are chosen with choose_cuts().
+        processes: number of worker processes.  None uses the number of
+          cores, 1 paves the regions serially in this process.
+        tolerance: distance for merging seam nodes, see
+          UnstructuredGrid.merge_grids.
+        count: limit on the number of steps in each region, mostly for
+          testing.  0 for no limit.
+        """
+        self.poly=as_polygon(poly)
+        self.scale=scale
+        if cuts is None:
+            cuts=choose_cuts(self.poly,n_regions) if n_regions else []
+        self.cuts=cuts
+        self.processes=processes
+        self.tolerance=tolerance
+        self.count=count
+        self.regions=None
+        self.results=None
+
+    def split(self):
+        self.regions=split_regions(self.poly,self.cuts,self.scale)
+        log.info("Split domain into %d regions"%len(self.regions))
+        return self.regions
+
+    def pave(self):
+        tasks=[ (rings,self.scale,self.front_class,self.count)
+                for rings in self.regions ]
+        if self.processes==1 or len(tasks)<2:
+            self.results=[_pave_region_args(t) for t in tasks]
+        else:
+            pool=multiprocessing.Pool(self.processes)
+            try:
+                self.results=pool.map(_pave_region_args,tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return self.results
+
+    def merge(self):
+        grids=[g for success,g in self.results]
+        return unstructured_grid.UnstructuredGrid.merge_grids(grids,
+                                                               tolerance=self.tolerance)
+
+    def execute(self):
+        """
+        Split, pave and merge.  Regions which fail to pave are logged,
+        and included in the result as far as they got.
+        """
+        self.split()
+        self.pave()
+        return self.merge()
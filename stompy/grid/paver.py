@@ -51,6 +51,7 @@ def my_fmin(f,x0,args=(),xtol=1e-4,disp=0):
 
 from . import trigrid
 from . import orthomaker as om
+from . import telemetry
 
 from .trigrid import rot,ensure_ccw,ensure_cw,is_ccw
 
@@ -83,6 +84,14 @@ class CIter(object):
     def __str__(self):
         return "[%d-%d-%d]"%(self.prv.data,self.data,self.nxt.data)
 
+    # CIters are keys in the priority queues, which break ties in the
+    # metric by comparing keys.  py2 fell back to comparing ids, py3
+    # refuses, so order by node instead.  Equality stays identity.
+    def __lt__(self,other):
+        return self.data < other.data
+    def __le__(self,other):
+        return self.data <= other.data
+
     ### Pickle API
     # really we want the clist to exist, and then we just need to pick
     # the right CIter out of the clist.
@@ -1160,6 +1169,12 @@ class Paving(paving_base,OptimizeGridMixin):
         d['click_handler_id'] = None
         d['showing_history'] = None
         d['index'] = None
+
+        # timing wrappers from an active telemetry
+        d.pop('telemetry',None)
+        for obj,meth_name in getattr(self.telemetry,'wrapped',[]):
+            if obj is self:
+                d.pop(meth_name,None)
         
         return d
     def __setstate__(self,d):
@@ -4120,6 +4135,7 @@ class Paving(paving_base,OptimizeGridMixin):
                 all_okay = 0
 
             if not all_okay:
+                self.telemetry.count('fail_'+strategy)
                 if self.verbose > 2:
                     # sometimes this will fail because things are in an
                     # inconsistent state.
@@ -5246,23 +5262,44 @@ class Paving(paving_base,OptimizeGridMixin):
             
         return self.save_stride_fmt%d
 
-    def pave_all(self,plot_stride=None,n_steps=None,save_stride=None):
+    # per-step timings, see telemetry.Telemetry.  The null default
+    # records nothing.
+    telemetry = telemetry.null
+
+    def pave_all(self,plot_stride=None,n_steps=None,save_stride=None,telemetry=None):
+        """
+        telemetry: a telemetry.Telemetry to record per-step timings in,
+          which is kept as self.telemetry.
+        """
+        if telemetry is not None:
+            self.telemetry = telemetry
+        tel = self.telemetry
+        if tel.enabled:
+            self.instrument_telemetry(tel)
+
         if n_steps is None:
             self.init_stats()
-        while 1: 
-            if n_steps and self.step >= n_steps:
-                break
-            if not self.choose_and_fill():
-                break
-            if plot_stride and self.step%plot_stride == 0:
-                self.plot()
-                draw()
-            if save_stride and self.step%save_stride == 0:
-                fn = self.save_stride_filename()
-                print("Saving current state to %s"%fn)
-                self.write_complete(fn)
-                print("Done with save")
-                
+        try:
+            while 1: 
+                if n_steps and self.step >= n_steps:
+                    break
+                tel.start_step()
+                if not self.choose_and_fill():
+                    tel.discard_step() # nothing left to pave
+                    break
+                tel.end_step()
+                if plot_stride and self.step%plot_stride == 0:
+                    self.plot()
+                    draw()
+                if save_stride and self.step%save_stride == 0:
+                    fn = self.save_stride_filename()
+                    print("Saving current state to %s"%fn)
+                    self.write_complete(fn)
+                    print("Done with save")
+        finally:
+            tel.end_step()
+            tel.uninstrument()
+
 
         if n_steps is None:
             self.finish_stats()
@@ -5273,6 +5310,16 @@ class Paving(paving_base,OptimizeGridMixin):
         if len(self.unpaved) == 0:
             print("Done!")
 
+    def instrument_telemetry(self,tel):
+        """ time the phases of each step during pave_all() """
+        tel.instrument(self,['elt_smallest_internal_angle'],'site')
+        tel.instrument(self,['resample_neighbors'],'resample')
+        tel.instrument(self,['fill'],'strategy')
+        tel.instrument(self,['safe_relax_one'],'optimize')
+        tel.instrument(self,['dt_insert','dt_remove','dt_update',
+                             'dt_add_edge','dt_remove_edge'],'cdt')
+        tel.instrument(self,['revert'],'revert')
+
     def renumber(self):
         # copy edge data - make a hash based on the sorted node indices
         tmp_edge_data = {}
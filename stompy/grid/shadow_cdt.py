@@ -16,6 +16,21 @@ log=logging.getLogger(__name__)
 
 from . import exact_delaunay
 
+def add_constraints_or_none(cdt,nodes):
+    """ add a constraint for each [a,b] row of nodes, or if any of them
+    fails, remove the ones already added and re-raise.  Used for bulk
+    add_edges, so a rejected batch leaves the CDT as it was.
+    """
+    added=[]
+    try:
+        for a,b in np.asarray(nodes).reshape([-1,2]):
+            cdt.add_constraint(a,b)
+            added.append( (a,b) )
+    except Exception:
+        for a,b in added[::-1]:
+            cdt.remove_constraint(a,b)
+        raise
+
 class ShadowCDT(exact_delaunay.Triangulation):
     """ Tracks modifications to an unstructured grid and
     maintains a shadow representation with a constrained Delaunay
@@ -30,10 +45,12 @@ class ShadowCDT(exact_delaunay.Triangulation):
 
         g.subscribe_before('add_node',self.before_add_node)
         g.subscribe_after('add_node',self.after_add_node)
+        g.subscribe_after('add_nodes',self.after_add_nodes)
         g.subscribe_before('modify_node',self.before_modify_node)
         g.subscribe_before('delete_node',self.before_delete_node)
         
         g.subscribe_before('add_edge',self.before_add_edge)
+        g.subscribe_before('add_edges',self.before_add_edges)
         g.subscribe_before('delete_edge',self.before_delete_edge)
         g.subscribe_before('modify_edge',self.before_modify_edge)
 
@@ -46,18 +63,25 @@ class ShadowCDT(exact_delaunay.Triangulation):
         points=g.nodes['x'][n_valid]
         self.bulk_init(points)
 
-        pidxs=np.arange(g.Nnodes())[n_valid]
-        self.nodes['g_n']=pidxs
-
-        for n in range(self.Nnodes()):
-            gn=self.nodes['g_n'][n]
-            self.nodemap_g_to_local[gn]=n
+        pidxs=np.nonzero(n_valid)[0]
+        if len(pidxs)<g.Nnodes():
+            # incremental updates assume local indices match g, so
+            # leave deleted nodes in the same slots
+            nodes=np.zeros(g.Nnodes(),self.node_dtype)
+            nodes['deleted']=True
+            nodes[pidxs]=self.nodes
+            self.edges['nodes']=pidxs[self.edges['nodes']]
+            self.cells['nodes']=pidxs[self.cells['nodes']]
+            self.nodes=nodes
+            self.refresh_metadata()
+        self.nodes['g_n']=np.arange(g.Nnodes())
+
+        self.nodemap_g_to_local=dict(zip(pidxs,pidxs))
 
         # Edges:
-        for ji,j in enumerate(g.valid_edge_iter()):
-            if ji%5000==0:
-                log.info("Edges: %d/%d"%(ji,g.Nedges()))
-            self.before_add_edge(g,'add_edge',nodes=g.edges['nodes'][j])
+        js=np.nonzero(~g.edges['deleted'])[0]
+        log.info("Edges: %d"%len(js))
+        self.add_constraints(g.edges['nodes'][js])
 
     def before_add_node(self,g,func_name,**k):
         pass # no checks quite yet
@@ -68,6 +92,9 @@ class ShadowCDT(exact_delaunay.Triangulation):
         # as long as there aren't Steiner vertices and the like, then
         # it's safe to force node index here to match the parent
         self.nodemap_g_to_local[n]=self.add_node(x=k['x'],g_n=n,_index=n)
+    def after_add_nodes(self,g,func_name,return_value,**k):
+        for n in return_value:
+            self.nodemap_g_to_local[n]=self.add_node(x=g.nodes['x'][n],g_n=n,_index=n)
     def before_modify_node(self,g,func_name,n,**k):
         if 'x' in k:
             my_n=self.nodemap_g_to_local[n]
@@ -78,6 +105,8 @@ class ShadowCDT(exact_delaunay.Triangulation):
     def before_add_edge(self,g,func_name,**k):
         nodes=k['nodes']
         self.add_constraint(nodes[0],nodes[1])
+    def before_add_edges(self,g,func_name,nodes,**k):
+        add_constraints_or_none(self,nodes)
     def before_modify_edge(self,g,func_name,j,**k):
         if 'nodes' not in k:
             return
@@ -134,20 +163,24 @@ class ShadowCGALCDT(object):
         
         g.subscribe_before('add_node',self.before_add_node)
         g.subscribe_after('add_node',self.after_add_node)
+        g.subscribe_after('add_nodes',self.after_add_nodes)
         g.subscribe_before('modify_node',self.before_modify_node)
         g.subscribe_before('delete_node',self.before_delete_node)
         
         g.subscribe_before('add_edge',self.before_add_edge)
+        g.subscribe_before('add_edges',self.before_add_edges)
         g.subscribe_before('delete_edge',self.before_delete_edge)
         g.subscribe_before('modify_edge',self.before_modify_edge)
         
     def uninstrument_grid(self,g):
         g.unsubscribe_before('add_node',self.before_add_node)
         g.unsubscribe_after('add_node',self.after_add_node)
+        g.unsubscribe_after('add_nodes',self.after_add_nodes)
         g.unsubscribe_before('modify_node',self.before_modify_node)
         g.unsubscribe_before('delete_node',self.before_delete_node)
         
         g.unsubscribe_before('add_edge',self.before_add_edge)
+        g.unsubscribe_before('add_edges',self.before_add_edges)
         g.unsubscribe_before('delete_edge',self.before_delete_edge)
         g.unsubscribe_before('modify_edge',self.before_modify_edge)
         
@@ -385,6 +418,9 @@ class ShadowCGALCDT(object):
         n=return_value
         # re: _index
         self.dt_insert(n)
+    def after_add_nodes(self,g,func_name,return_value,**k):
+        for n in return_value:
+            self.dt_insert(n)
         
     def dt_insert(self,n,x=None):
         """
@@ -490,6 +526,8 @@ class ShadowCGALCDT(object):
     def before_add_edge(self,g,func_name,**k):
         nodes=k['nodes']
         self.add_constraint(nodes[0],nodes[1])
+    def before_add_edges(self,g,func_name,nodes,**k):
+        add_constraints_or_none(self,nodes)
 
     def before_modify_edge(self,g,func_name,j,**k):
         if 'nodes' not in k:
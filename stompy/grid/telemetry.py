@@ -0,0 +1,189 @@
+"""
+Per-step timings and counters for grid generation.
+
+A Telemetry object collects one row per step of a generation loop,
+e.g. AdvancingFront.loop() or Paving.pave_all().  Each row holds
+wall-clock times for named phases, counts of events such as strategy
+failures, and the time and number of calls for any instrumented
+methods (e.g. the CDT updates, or grid reverts).  Times are inclusive,
+so cdt_time is also part of strategy_time when the CDT is updated
+during a strategy.
+
+The table can be summarized, or written to CSV:
+
+  tel=telemetry.Telemetry()
+  af.loop(telemetry=tel)
+  print(tel.summary())
+  tel.to_csv('steps.csv')
+
+When telemetry is not requested, the generation code uses the shared
+`null` object, whose methods do nothing.
+"""
+from __future__ import print_function
+
+import csv
+import time
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+log=logging.getLogger(__name__)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        return False
+
+_null_timer=_NullTimer()
+
+
+class NullTelemetry(object):
+    """ Same interface as Telemetry, but records nothing """
+    enabled=False
+    def start_step(self):
+        pass
+    def end_step(self):
+        pass
+    def discard_step(self):
+        pass
+    def timer(self,name):
+        return _null_timer
+    def count(self,name,n=1):
+        pass
+    def instrument(self,obj,methods,name):
+        pass
+    def uninstrument(self):
+        pass
+
+null=NullTelemetry()
+
+
+class _Timer(object):
+    def __init__(self,tel,name):
+        self.tel=tel
+        self.name=name
+    def __enter__(self):
+        self.t0=time.time()
+        return self
+    def __exit__(self,*exc):
+        self.tel.count(self.name+'_time',time.time()-self.t0)
+        return False
+
+
+class Telemetry(object):
+    enabled=True
+
+    def __init__(self,log_steps=False):
+        """
+        log_steps: if True, each completed row is also logged at INFO
+        level as key=value pairs.
+        """
+        self.log_steps=log_steps
+        self.rows=[]
+        self.current=None
+        self.t_step=None
+        self.wrapped=[] # (obj,method name) installed by instrument()
+
+    def start_step(self):
+        if self.current is not None:
+            self.end_step()
+        self.current=defaultdict(float)
+        self.current['step']=len(self.rows)
+        self.t_step=time.time()
+
+    def end_step(self):
+        if self.current is None:
+            return
+        self.current['step_time']=time.time()-self.t_step
+        row=dict(self.current)
+        self.rows.append(row)
+        self.current=None
+        if self.log_steps:
+            log.info(" ".join("%s=%s"%(k,row[k]) for k in sorted(row)))
+
+    def discard_step(self):
+        """ drop the current step without recording a row, i.e. when the
+        loop finds there is nothing left to do """
+        self.current=None
+
+    def timer(self,name):
+        """ context manager adding elapsed time to name+'_time' """
+        return _Timer(self,name)
+
+    def count(self,name,n=1):
+        """ add n to the current step's value for name.  Ignored between steps """
+        if self.current is not None:
+            self.current[name]+=n
+
+    def instrument(self,obj,methods,name):
+        """
+        Record time and number of calls for the given methods of obj, as
+        name+'_time' and name+'_calls'.  Calls made from within another
+        instrumented call with the same name are not counted twice.
+        The wrappers are instance attributes, removed by uninstrument().
+        """
+        active=[0]
+        def wrap(meth):
+            def wrapper(*a,**k):
+                if active[0]:
+                    return meth(*a,**k)
+                active[0]+=1
+                t0=time.time()
+                try:
+                    return meth(*a,**k)
+                finally:
+                    active[0]-=1
+                    self.count(name+'_time',time.time()-t0)
+                    self.count(name+'_calls')
+            return wrapper
+
+        for meth_name in methods:
+            meth=getattr(obj,meth_name,None)
+            if meth is None:
+                continue
+            setattr(obj,meth_name,wrap(meth))
+            self.wrapped.append( (obj,meth_name) )
+
+    def uninstrument(self):
+        for obj,meth_name in self.wrapped[::-1]:
+            try:
+                delattr(obj,meth_name)
+            except AttributeError:
+                pass
+        self.wrapped=[]
+
+    def columns(self):
+        cols=set()
+        for row in self.rows:
+            cols.update(row.keys())
+        cols.discard('step')
+        return ['step']+sorted(cols)
+
+    def table(self):
+        """ returns a structured array with one row per step, missing values 0 """
+        cols=self.columns()
+        dtype=[('step',np.int64)] + [ (c,np.float64) for c in cols[1:] ]
+        result=np.zeros(len(self.rows),dtype)
+        for i,row in enumerate(self.rows):
+            for k,v in row.items():
+                result[k][i]=v
+        return result
+
+    def to_csv(self,fn):
+        cols=self.columns()
+        with open(fn,'wt') as fp:
+            writer=csv.writer(fp)
+            writer.writerow(cols)
+            for row in self.rows:
+                writer.writerow([row.get(c,0) for c in cols])
+
+    def summary(self):
+        """ totals over all steps for each column, plus the number of steps """
+        totals={}
+        for c in self.columns()[1:]:
+            totals[c]=sum(row.get(c,0) for row in self.rows)
+        totals['steps']=len(self.rows)
+        return totals
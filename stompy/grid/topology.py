@@ -0,0 +1,422 @@
+"""
+Array-based construction of grid topology.
+
+These functions derive edges, edge-to-cell and node-to-element
+adjacency from the basic cell/edge node arrays using sorting and
+unique passes, rather than looping over cells in python.  They
+operate on plain numpy arrays, and return plain numpy arrays,
+so that UnstructuredGrid and the various readers can use them
+without creating any intermediate grid state.
+
+Adjacency is returned in compressed sparse row (CSR) form:
+offsets is [N+1], and the neighbors of element i are
+indices[offsets[i]:offsets[i+1]].
+"""
+from __future__ import print_function
+
+import numpy as np
+
+UNDEFINED=-1
+
+
+def cell_sides(cell_nodes):
+    """
+    cell_nodes: [Ncells,max_sides] node indices, padded with negative
+    values.
+    returns [Ncells] number of valid nodes per cell.  Assumes that
+    valid nodes are packed at the start of each row.
+    """
+    return (cell_nodes>=0).sum(axis=1)
+
+
+def cell_halfedges(cell_nodes,valid=None):
+    """
+    Enumerate the directed sides of all cells.
+
+    cell_nodes: [Ncells,max_sides] node indices, padded with negative values.
+    valid: optional [Ncells] boolean, cells to include.
+
+    returns c,i,a,b: each [Nhalfedges], in cell-major order, such that side i
+    of cell c runs from node a to node b.
+    """
+    cell_nodes=np.asarray(cell_nodes)
+    Nc,max_sides=cell_nodes.shape
+    nsides=cell_sides(cell_nodes)
+    side=np.arange(max_sides)
+    nxt=side[None,:]+1
+    nxt=np.where(nxt<nsides[:,None],nxt,0)
+
+    sel=side[None,:]<nsides[:,None]
+    if valid is not None:
+        sel=sel & np.asarray(valid)[:,None]
+
+    b=np.take_along_axis(cell_nodes,nxt,axis=1)
+    c=np.broadcast_to(np.arange(Nc)[:,None],sel.shape)
+    i=np.broadcast_to(side[None,:],sel.shape)
+
+    return c[sel],i[sel],cell_nodes[sel],b[sel]
+
+
+def pair_keys(a,b,Nnodes):
+    """ undirected int64 key for each pair of node indices """
+    a=np.asarray(a,np.int64)
+    b=np.asarray(b,np.int64)
+    return np.minimum(a,b)*Nnodes + np.maximum(a,b)
+
+
+def edges_from_cells(cell_nodes,Nnodes=None):
+    """
+    Derive the unique edges of a set of cells.
+
+    cell_nodes: [Ncells,max_sides] node indices, padded with negative values.
+
+    returns edge_nodes [Nedges,2], edge_cells [Nedges,2], cell_edges [Ncells,max_sides]
+
+    Edges are numbered in the order they are first encountered, traversing cells
+    in order and the sides of each cell in order.  Edge orientation follows the
+    first cell to reference it, so that cell is on the left (edge_cells[:,0]) and
+    any second cell is on the right.  Boundary edges have edge_cells[:,1]==-1.
+    """
+    cell_nodes=np.asarray(cell_nodes)
+    if Nnodes is None:
+        Nnodes=max(1,cell_nodes.max()+1) if cell_nodes.size else 1
+
+    c,i,a,b=cell_halfedges(cell_nodes)
+    cell_edges=np.full(cell_nodes.shape,UNDEFINED,np.int32)
+
+    if len(c)==0:
+        return (np.zeros((0,2),np.int32),
+                np.zeros((0,2),np.int32),
+                cell_edges)
+
+    keys=pair_keys(a,b,Nnodes)
+    ukeys,first,inverse=np.unique(keys,return_index=True,return_inverse=True)
+    # np.unique orders by key - renumber by first appearance instead
+    order=np.argsort(first,kind='mergesort')
+    rank=np.empty(len(order),np.int32)
+    rank[order]=np.arange(len(order))
+    j=rank[inverse.ravel()]
+
+    edge_nodes=np.zeros((len(ukeys),2),np.int32)
+    edge_cells=np.full((len(ukeys),2),UNDEFINED,np.int32)
+    first=first[order]
+    edge_nodes[:,0]=a[first]
+    edge_nodes[:,1]=b[first]
+    edge_cells[:,0]=c[first]
+
+    # every other reference is the cell on the right.
+    second=np.ones(len(c),np.bool_)
+    second[first]=False
+    edge_cells[j[second],1]=c[second]
+
+    cell_edges[c,i]=j
+    return edge_nodes,edge_cells,cell_edges
+
+
+def match_edges(edge_nodes,a,b,Nnodes=None,valid=None):
+    """
+    Vectorized lookup of edges by their nodes, in either orientation.
+
+    edge_nodes: [Nedges,2] existing edges
+    a,b: arrays of node indices to look up
+    valid: optional [Nedges] boolean mask of edges eligible for matching.
+
+    returns [N] edge indices, -1 where no edge matched.  When duplicate edges
+    exist, the lowest index is returned.
+    """
+    edge_nodes=np.asarray(edge_nodes)
+    a=np.asarray(a)
+    b=np.asarray(b)
+    if Nnodes is None:
+        Nnodes=1+max(edge_nodes.max() if edge_nodes.size else 0,
+                     a.max() if a.size else 0,
+                     b.max() if b.size else 0)
+
+    if valid is None:
+        js=np.arange(len(edge_nodes))
+    else:
+        js=np.nonzero(valid)[0]
+    result=np.full(len(a),-1,np.int32)
+    if len(js)==0 or len(a)==0:
+        return result
+
+    ekeys=pair_keys(edge_nodes[js,0],edge_nodes[js,1],Nnodes)
+    order=np.argsort(ekeys,kind='mergesort')
+    ekeys=ekeys[order]
+    js=js[order]
+
+    qkeys=pair_keys(a,b,Nnodes)
+    pos=np.searchsorted(ekeys,qkeys).clip(0,len(ekeys)-1)
+    hit=ekeys[pos]==qkeys
+    result[hit]=js[pos[hit]]
+    return result
+
+
+def first_duplicate(rows):
+    """
+    rows: [N,k] integer array.
+    returns [N] index of the first row with identical contents, so that
+    rows without duplicates map to themselves.
+    """
+    rows=np.ascontiguousarray(rows)
+    if len(rows)==0:
+        return np.zeros(0,np.int64)
+    _,first,inverse=np.unique(rows,axis=0,return_index=True,return_inverse=True)
+    return first[inverse.ravel()]
+
+
+def coincident_points(xy,tolerance=0.0,valid=None):
+    """
+    Group points which coincide, within tolerance.
+    xy: [N,2] coordinates
+    tolerance: 0.0 for exact matches, otherwise points closer than this
+      are grouped, transitively.
+    valid: optional [N] boolean, points to consider.
+
+    returns [N] index of the lowest numbered point in the group of each
+    point.  Points which are not in a group, or not valid, map to
+    themselves.
+    """
+    xy=np.asarray(xy)
+    N=len(xy)
+    result=np.arange(N)
+    ids=np.arange(N) if valid is None else np.nonzero(valid)[0]
+    if len(ids)<2:
+        return result
+
+    if tolerance>0:
+        from scipy.spatial import cKDTree
+        from scipy import sparse
+        from scipy.sparse import csgraph
+        pairs=cKDTree(xy[ids]).query_pairs(tolerance,output_type='ndarray')
+        if len(pairs)==0:
+            return result
+        adj=sparse.coo_matrix( (np.ones(len(pairs)),(pairs[:,0],pairs[:,1])),
+                               shape=(len(ids),len(ids)) )
+        ncomp,labels=csgraph.connected_components(adj,directed=False)
+        rep=np.full(ncomp,N,np.int64)
+        np.minimum.at(rep,labels,ids)
+        result[ids]=rep[labels]
+    else:
+        # adding 0.0 makes -0.0 and 0.0 identical
+        result[ids]=ids[first_duplicate(xy[ids]+0.0)]
+    return result
+
+
+def csr_from_pairs(rows,cols,Nrows):
+    """
+    Group cols by rows.
+
+    returns offsets [Nrows+1], indices, such that the cols for row r are
+    indices[offsets[r]:offsets[r+1]], in their original relative order.
+    """
+    rows=np.asarray(rows)
+    cols=np.asarray(cols)
+    order=np.argsort(rows,kind='mergesort')
+    counts=np.bincount(rows,minlength=Nrows)
+    offsets=np.zeros(Nrows+1,np.int64)
+    np.cumsum(counts,out=offsets[1:])
+    return offsets,cols[order].astype(np.int32)
+
+
+def node_to_edges_csr(edge_nodes,Nnodes,valid=None):
+    """
+    edge_nodes: [Nedges,2]
+    valid: optional [Nedges] boolean, edges to include.
+    returns offsets,indices giving the edges of each node, in increasing
+    edge order.
+    """
+    edge_nodes=np.asarray(edge_nodes)
+    js=np.arange(len(edge_nodes))
+    if valid is not None:
+        js=js[valid]
+    rows=edge_nodes[js].ravel()
+    cols=np.repeat(js,2)
+    return csr_from_pairs(rows,cols,Nnodes)
+
+
+def node_to_cells_csr(cell_nodes,Nnodes,valid=None):
+    """
+    cell_nodes: [Ncells,max_sides], padded with negative values.
+    valid: optional [Ncells] boolean, cells to include.
+    returns offsets,indices giving the cells of each node, in increasing
+    cell order.
+    """
+    cell_nodes=np.asarray(cell_nodes)
+    sel=cell_nodes>=0
+    if valid is not None:
+        sel=sel & np.asarray(valid)[:,None]
+    cs=np.broadcast_to(np.arange(len(cell_nodes))[:,None],cell_nodes.shape)
+    return csr_from_pairs(cell_nodes[sel],cs[sel],Nnodes)
+
+
+class Adjacency(object):
+    """
+    Compact, editable one-to-many adjacency, e.g. node to edges.
+
+    Storage is CSR-like, but each row gets a slot with some slack beyond
+    its current count, so that insertions are usually done in place.
+    A row which outgrows its slot is moved to the end of the data array
+    with twice the capacity, and the data array is compacted when more
+    than half of it has been abandoned this way.  This keeps add/remove
+    O(1) amortized while the whole structure stays as a few flat arrays.
+
+    Rows are created on demand, so any non-negative row index is valid.
+    Indexing returns a python list copy of the row, which is the fastest
+    form for the scalar topology queries.  Modifications go through
+    add(), remove() and clear().
+    """
+    def __init__(self,offsets=None,indices=None,slack=2):
+        if offsets is None:
+            offsets=np.zeros(1,np.int64)
+            indices=np.zeros(0,np.int32)
+        self.slack=slack
+        self._layout(np.asarray(offsets),np.asarray(indices))
+
+    def _layout(self,offsets,indices):
+        counts=np.diff(offsets).astype(np.int32)
+        capacity=counts+self.slack
+        start=np.zeros(len(counts),np.int64)
+        np.cumsum(capacity[:-1],out=start[1:])
+        size=int(capacity.sum())
+
+        data=np.full(max(size,1),-1,np.int32)
+        rows=np.repeat(np.arange(len(counts)),counts)
+        pos=start[rows] + np.arange(len(indices)) - offsets[:-1][rows]
+        data[pos]=indices
+
+        self.start=start
+        self.count=counts
+        self.capacity=capacity.astype(np.int32)
+        self.data=data
+        self.end=size # first unallocated entry of data
+        self.abandoned=0 # number of entries in data no longer owned by a row
+
+    @classmethod
+    def from_csr(cls,offsets,indices,slack=2):
+        """
+        Wrap existing CSR arrays without copying indices, i.e. from a memory
+        mapped file.  Rows start with no slack, and indices is only copied
+        if it is read-only and gets modified.
+        """
+        self=cls.__new__(cls)
+        self.slack=slack
+        offsets=np.asarray(offsets)
+        self.start=offsets[:-1].astype(np.int64)
+        self.count=np.diff(offsets).astype(np.int32)
+        self.capacity=self.count.copy()
+        self.data=np.asarray(indices)
+        self.end=len(self.data)
+        self.abandoned=0
+        return self
+
+    def _writable(self):
+        if not self.data.flags.writeable:
+            self.data=self.data.copy()
+
+    def Nrows(self):
+        return len(self.count)
+
+    def _ensure_row(self,i):
+        N=len(self.count)
+        if i<N:
+            return
+        newN=max(i+1,2*N)
+        for attr in ['start','count','capacity']:
+            old=getattr(self,attr)
+            new=np.zeros(newN,old.dtype)
+            new[:N]=old
+            setattr(self,attr,new)
+
+    def __getitem__(self,i):
+        # scalar arithmetic on numpy integers is slow, and this is
+        # called very often.
+        i=int(i)
+        if i>=len(self.count):
+            return []
+        s=int(self.start[i])
+        return self.data[s:s+int(self.count[i])].tolist()
+
+    def row(self,i):
+        """ array copy of row i """
+        if i>=len(self.count):
+            return np.zeros(0,np.int32)
+        s=self.start[i]
+        return self.data[s:s+self.count[i]].copy()
+
+    def degree(self,i):
+        if i>=len(self.count):
+            return 0
+        return int(self.count[i])
+
+    def add(self,i,v):
+        self._writable()
+        self._ensure_row(i)
+        k=self.count[i]
+        if k==self.capacity[i]:
+            self._relocate(i,max(2*k,self.slack,1))
+        self.data[self.start[i]+k]=v
+        self.count[i]=k+1
+
+    def remove(self,i,v):
+        """ remove the first occurrence of v from row i, preserving order
+        of the remaining entries. Raises ValueError if v is not present.
+        """
+        k=self.degree(i)
+        s=self.start[i] if k else 0
+        hits=np.nonzero(self.data[s:s+k]==v)[0]
+        if len(hits)==0:
+            raise ValueError("%s not in row %s"%(v,i))
+        self._writable()
+        p=s+hits[0]
+        self.data[p:s+k-1]=self.data[p+1:s+k]
+        self.data[s+k-1]=-1
+        self.count[i]=k-1
+
+    def clear(self,i):
+        if i<len(self.count):
+            self._writable()
+            s=self.start[i]
+            self.data[s:s+self.count[i]]=-1
+            self.count[i]=0
+
+    def _relocate(self,i,cap):
+        if self.end+cap > len(self.data):
+            if self.abandoned > len(self.data)//2:
+                self.compact()
+            if self.end+cap > len(self.data):
+                new_data=np.full(max(2*len(self.data),self.end+cap),-1,np.int32)
+                new_data[:self.end]=self.data[:self.end]
+                self.data=new_data
+        s=self.start[i]
+        k=self.count[i]
+        self.data[self.end:self.end+k]=self.data[s:s+k]
+        self.data[s:s+k]=-1
+        self.abandoned+=self.capacity[i]
+        self.start[i]=self.end
+        self.capacity[i]=cap
+        self.end+=cap
+
+    def to_csr(self,Nrows=None):
+        """
+        returns offsets,indices for the current contents, optionally
+        padded or truncated to Nrows rows.
+        """
+        count=self.count
+        start=self.start
+        if Nrows is not None:
+            if Nrows>len(count):
+                count=np.concatenate([count,np.zeros(Nrows-len(count),count.dtype)])
+                start=np.concatenate([start,np.zeros(Nrows-len(start),start.dtype)])
+            else:
+                count=count[:Nrows]
+                start=start[:Nrows]
+        offsets=np.zeros(len(count)+1,np.int64)
+        np.cumsum(count,out=offsets[1:])
+        rows=np.repeat(np.arange(len(count)),count)
+        pos=start[rows] + np.arange(offsets[-1]) - offsets[:-1][rows]
+        return offsets,self.data[pos]
+
+    def compact(self):
+        offsets,indices=self.to_csr()
+        self._layout(offsets,indices)
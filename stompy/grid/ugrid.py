@@ -223,8 +223,15 @@ class Ugrid(object):
         node_xy = np.array( [nc.variables[node_x_name][...],
                              nc.variables[node_y_name][...]]).T
         faces = nc.variables[mesh.face_node_connectivity][...]
-        edges = nc.variables[mesh.edge_node_connectivity][...] # [N,2]
-        ug = unstructured_grid.UnstructuredGrid(points=node_xy,cells=faces,edges=edges)
+        if skip_edges or not hasattr(mesh,'edge_node_connectivity'):
+            ug = unstructured_grid.UnstructuredGrid(points=node_xy,cells=faces)
+            ug.make_edges_from_cells()
+        else:
+            edges = nc.variables[mesh.edge_node_connectivity][...] # [N,2]
+            ug = unstructured_grid.UnstructuredGrid(points=node_xy,cells=faces,edges=edges)
+            # bulk topology is cheap - better than leaving it UNKNOWN
+            ug.update_cell_edges()
+            ug.edge_to_cells(recalc=True)
         
         return ug
 
@@ -5,7 +5,7 @@ from __future__ import print_function
 #  common methods for manipulating unstructured grids, specifically mixed quad/tri
 #  grids from FISH-PTM and UnTRIM
 
-import sys,os,types
+import sys,os,types,math
 import logging
  
 try:
@@ -55,11 +55,7 @@ except ImportError:
 
     
 from .. import undoer
-
-try:
-    from .. import priority_queue as pq
-except ImportError:
-    pq = 'NO priority queue found!'
+from . import topology, cell_geometry, element_index, native_format
 
 
 class GridException(Exception):
@@ -205,6 +201,18 @@ class Listenable(object):
         if callback in self.__pre_listeners[func_name]:
             self.__pre_listeners[func_name].remove(callback)
         
+    def has_listeners(self,ignore=()):
+        """ True if any callbacks are subscribed, before or after any method,
+        other than methods bound to one of the objects in ignore.
+        """
+        for listeners in [self.__post_listeners,self.__pre_listeners]:
+            for callbacks in listeners.values():
+                for callback in callbacks:
+                    owner=getattr(callback,'__self__',None)
+                    if not any(owner is obj for obj in ignore):
+                        return True
+        return False
+
     def fire_after(self,func_name,*a,**k):
         for func in self.__post_listeners[func_name]:
             func(self,func_name,*a,**k)
@@ -267,6 +275,15 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     xxyy = np.array([0,0,1,1])
     xyxy = np.array([0,1,0,1])
 
+    # undo methods which the op history stores compactly, see undoer.OpHistory
+    undo_ops={'unadd_node':('index',None),
+              'unadd_edge':('index',None),
+              'unadd_cell':('index',None),
+              'undelete_node':('record',None),
+              'undelete_edge':('record',None),
+              'undelete_cell':('record',None),
+              'modify_node':('fields','nodes')}
+
     # Define the data stored for each point
     # some of these are dependent on other aspects of the geometry, and should be 
     # set to nan if they become stale.
@@ -425,6 +442,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
          THIS IS NEW -- old code used a QDataset, but that is being phased out.
         fields: 'auto' [new] populate additional node,edge and cell fields
         based on matching dimensions.
+        skip_edges: ignore edges in the file, and derive them from the cells.
+        This is also the fallback when the mesh has no edge_node_connectivity.
+        In this case edge fields in the file are not loaded.
         """
         if isinstance(nc,str):
             # nc=qnc.QDataset(nc)
@@ -480,9 +500,19 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             return idxs
 
         faces = process_as_index(mesh.face_node_connectivity)
-        edges = process_as_index(mesh.edge_node_connectivity) # [N,2]
+        if skip_edges or ('edge_node_connectivity' not in mesh.attrs):
+            edges = None
+        else:
+            edges = process_as_index(mesh.edge_node_connectivity) # [N,2]
 
-        ug = UnstructuredGrid(points=node_xy,cells=faces,edges=edges)
+        if edges is None:
+            ug = UnstructuredGrid(points=node_xy,cells=faces)
+            ug.make_edges_from_cells()
+        else:
+            ug = UnstructuredGrid(points=node_xy,cells=faces,edges=edges)
+            # bulk topology is cheap - better than leaving it UNKNOWN
+            ug.update_cell_edges()
+            ug.edge_to_cells(recalc=True)
 
         if fields=='auto':
             # doing this after the fact is inefficient, but a useful
@@ -491,6 +521,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                                           ('edge_dimension',ug.edges,ug.add_edge_field),
                                           ('face_dimension',ug.cells,ug.add_cell_field)]:
                 dim_name=mesh.attrs.get(dim_attr,None)
+                if dim_attr=='edge_dimension' and edges is None:
+                    continue # edges were not taken from the file
                 if dim_name:
                     for vname in nc.data_vars:
                         # At this point, only scalar values
@@ -708,11 +740,13 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
     def update_cell_edges(self):
         """ from edges['nodes'] and cells['nodes'], set cells['edges']
+        Sides without a matching edge are left as UNDEFINED.
         """
-        self.cells['edges'] = -1
-        for c in range(self.Ncells()):
-            for i,(a,b) in enumerate(circular_pairs(self.cell_to_nodes(c))):
-                self.cells['edges'][c,i] = self.nodes_to_edge(a,b)
+        self.cells['edges'] = self.UNDEFINED
+        c,i,a,b=topology.cell_halfedges(self.cells['nodes'])
+        self.cells['edges'][c,i]=topology.match_edges(self.edges['nodes'],a,b,
+                                                      Nnodes=self.Nnodes(),
+                                                      valid=~self.edges['deleted'])
 
     def update_cell_nodes(self):
         """ from edges['nodes'] and cells['edges'], set cells['nodes']
@@ -838,24 +872,116 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         for n in np.nonzero(~used)[0]:
             self.delete_node(n)
 
-    def merge_duplicate_nodes(self):
-        """ Match up nodes based on *exact* coordinates.
-        When two nodes share the same coordinates, attempt
-        to merge them.  This can get dicey!
+    def merge_duplicate_nodes(self,tolerance=0.0):
+        """ Match up nodes based on coordinates, and merge nodes which
+        coincide.  With the default tolerance of 0.0 coordinates must match
+        exactly, otherwise nodes within tolerance are merged, transitively.
+        The lowest numbered node of each group is kept.
+
+        Edges which become duplicates are merged, keeping the lowest
+        numbered edge, as are cells with the same set of nodes.  Edges whose
+        endpoints are merged are deleted, and cells which lose a side are
+        reduced, or deleted if they degenerate (see remap_nodes).
+
+        Normally this is a bulk operation with array indexing over the whole
+        grid, see remap_nodes.  While a checkpoint is active, or anything
+        besides the grid's own indices is subscribed, nodes are instead
+        merged one at a time with merge_nodes(), which can be undone and
+        fires events, but fails for nodes sharing a cell or an edge.
 
         Returns a dict mapping the deleted nodes with the node they
         were merged with.
         """
-        merges={}
-        xys={}
-        for n in self.valid_node_iter():
-            k=tuple(self.nodes['x'][n])
-            if k in xys:
-                merges[n]=xys[k]
-                self.merge_nodes(xys[k],n)
+        node_map=topology.coincident_points(self.nodes['x'],tolerance=tolerance,
+                                            valid=~self.nodes['deleted'])
+        merged=np.nonzero(node_map!=np.arange(self.Nnodes()))[0]
+        if len(merged)==0:
+            return {}
+        if self.state=='recording' or self.has_listeners(ignore=self.internal_listeners()):
+            for n in merged:
+                self.merge_nodes(node_map[n],n)
+        else:
+            self.remap_nodes(node_map)
+        return dict(zip(merged.tolist(),node_map[merged].tolist()))
+
+    def internal_listeners(self):
+        """ objects whose methods the grid subscribes for its own caches,
+        i.e. the element indices and graphs, which bulk operations can
+        just drop.
+        """
+        return [obj for obj in [self,self._edge_index,self._cell_index]
+                if obj is not None]
+
+    def remap_nodes(self,node_map):
+        """
+        Bulk update of connectivity after replacing node n with node_map[n],
+        i.e. for merging coincident nodes.  Nodes which are mapped elsewhere
+        are deleted, duplicate edges and cells are merged, and edges['cells']
+        and cells['edges'] are recalculated.
+
+        Edges collapsed to a single node are deleted.  Repeated nodes in a
+        cell are dropped, and a cell left with fewer than 3 distinct nodes,
+        or pinched into visiting a node twice, is deleted.
+
+        Not recorded for undo, and no events are fired.  The grid's own
+        element indices and graph caches are dropped, but any other
+        subscriber, or an active checkpoint, is a GridException.
+        """
+        if self.state=='recording':
+            raise GridException("remap_nodes cannot be undone - commit() first")
+        if self.has_listeners(ignore=self.internal_listeners()):
+            raise GridException("remap_nodes fires no events, but the grid has listeners")
+        self.refresh_metadata() # unsubscribes the element indices and graphs
+
+        node_map=np.asarray(node_map)
+        replaced=node_map!=np.arange(self.Nnodes())
+
+        valid_e=~self.edges['deleted']
+        valid_c=~self.cells['deleted']
+
+        self.edges['nodes'][valid_e]=node_map[self.edges['nodes'][valid_e]]
+        collapsed=valid_e & (self.edges['nodes'][:,0]==self.edges['nodes'][:,1])
+        self.edges['deleted'][collapsed]=True
+        valid_e&=~collapsed
+
+        cn=self.cells['nodes']
+        sel=valid_c[:,None]&(cn>=0)
+        touched=np.any(sel & replaced[np.where(cn>=0,cn,0)],axis=1)
+        cn[sel]=node_map[cn[sel]]
+
+        # degenerate cells: drop repeated consecutive nodes, delete what
+        # is left if it's not a simple polygon
+        for c in np.nonzero(touched)[0]:
+            nodes=cn[c][cn[c]>=0]
+            nodes=nodes[ nodes!=np.roll(nodes,1) ]
+            if len(nodes)<3 or len(np.unique(nodes))<len(nodes):
+                self.cells['deleted'][c]=True
+                valid_c[c]=False
             else:
-                xys[k]=n
-        return merges
+                cn[c,:]=self.UNDEFINED
+                cn[c,:len(nodes)]=nodes
+        self.cells['_center'][touched]=np.nan
+        self.cells['_area'][touched]=np.nan
+
+        # duplicate cells: same set of nodes
+        cids=np.nonzero(valid_c)[0]
+        keys=np.sort(cn[cids],axis=1)
+        dup=cids[topology.first_duplicate(keys)]!=cids
+        self.cells['deleted'][cids[dup]]=True
+
+        # duplicate edges: same pair of nodes
+        jids=np.nonzero(valid_e)[0]
+        keys=np.sort(self.edges['nodes'][jids],axis=1)
+        first=jids[topology.first_duplicate(keys)]
+        self.edges['deleted'][jids[first!=jids]]=True
+
+        self.nodes['deleted'][replaced]=True
+
+        self.update_cell_edges()
+        self.edge_to_cells(recalc=True)
+        self.refresh_metadata()
+        self._node_index=None
+        self._cell_center_index=None
 
     def renumber_cells_ordering(self): 
         """ return cell indices in the order they should appear, and
@@ -889,6 +1015,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         self.edges['cells'] = cell_map[self.edges['cells']]
         self._cell_center_index=None
+        self.drop_element_indices()
+        self.drop_graphs()
 
     def renumber_edges_ordering(self):
         Nactive = sum(~self.edges['deleted'])
@@ -912,15 +1040,26 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         edge_map[-Nneg:] = np.arange(-Nneg,0)
 
         self.cells['edges'] = edge_map[self.cells['edges']]
+        self.drop_element_indices()
+        self.drop_graphs()
 
-    def add_grid(self,ugB,merge_nodes=None):
+    def add_grid(self,ugB,merge_nodes=None,tolerance=None):
         """
         Add the nodes, edges, and cells from another grid to this grid.
         Copies fields with common names, any other fields are dropped from ugB.
-        Assumes (for the moment) that max_sides is compatible. 
+        ugB cells may not have more sides than self.max_sides.
 
         merge_nodes: [ (self_node,ugB_node), ... ]
           Nodes which overlap and will be mapped instead of added.
+        tolerance: if given, nodes of ugB within this distance of a node of
+          self are also merged, with matching done by a KD-tree.  0.0 merges
+          only exactly coincident nodes.
+
+        Edges and cells of ugB which duplicate existing ones are mapped to
+        the existing elements.  Elements are added in bulk, so listeners
+        see add_nodes/add_edges/add_cells events.
+        returns node_map,edge_map,cell_map, arrays mapping ugB indices
+        to self indices, -1 for deleted elements of ugB.
         """
         node_map=np.zeros( ugB.Nnodes(), 'i4')-1
         edge_map=np.zeros( ugB.Nedges(), 'i4')-1
@@ -930,78 +1069,134 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             for my_node,B_node in merge_nodes:
                 node_map[B_node]=my_node
 
-        def bad_fields(Adata,Bdata): # field froms B which get dropped
-            A_fields =Adata.dtype.names
-            B_fields =Bdata.dtype.names
-
-            B_bad=[f for f in B_fields
-                   if (f=='deleted') or (f not in A_fields)]
-            return B_bad
-
-        B_bad=bad_fields(self.nodes,ugB.nodes)
-
-        for n in ugB.valid_node_iter():
-            if node_map[n]>=0:
-                continue # must be part of merge_nodes
-            kwargs=rec_to_dict(ugB.nodes[n])
-            for f in B_bad:
-                del kwargs[f]
-
-            node_map[n]=self.add_node(**kwargs)
-
-        B_bad=bad_fields(self.edges,ugB.edges)
-        # Easier to let add_cell fix this up
-        B_bad.append('cells')
+        def common_fields(Adata,Bdata,skip):
+            return [f for f in Bdata.dtype.names
+                    if (f in Adata.dtype.names) and (f not in skip)]
+
+        # Nodes
+        B_nodes=np.nonzero( (~ugB.nodes['deleted']) & (node_map<0) )[0]
+        if tolerance is not None and len(B_nodes):
+            my_nodes=np.nonzero(~self.nodes['deleted'])[0]
+            if len(my_nodes):
+                from scipy.spatial import cKDTree
+                kdt=cKDTree(self.nodes['x'][my_nodes])
+                dist,nbr=kdt.query(ugB.nodes['x'][B_nodes])
+                hit=dist<=tolerance
+                node_map[B_nodes[hit]]=my_nodes[nbr[hit]]
+                B_nodes=B_nodes[~hit]
+
+        fields=common_fields(self.nodes,ugB.nodes,['x','deleted'])
+        node_map[B_nodes]=self.add_nodes(ugB.nodes['x'][B_nodes],
+                                         **{f:ugB.nodes[f][B_nodes] for f in fields})
+
+        # Edges
+        B_edges=np.nonzero(~ugB.edges['deleted'])[0]
+        en=node_map[ugB.edges['nodes'][B_edges]]
+        existing=topology.match_edges(self.edges['nodes'],en[:,0],en[:,1],
+                                      Nnodes=self.Nnodes(),
+                                      valid=~self.edges['deleted'])
+        edge_map[B_edges]=existing
+        new=existing<0
+        fields=common_fields(self.edges,ugB.edges,['nodes','cells','deleted'])
+        edge_map[B_edges[new]]=self.add_edges(en[new],_check_existing=False,
+                                              **{f:ugB.edges[f][B_edges[new]]
+                                                 for f in fields})
+
+        # Cells
+        B_cells=np.nonzero(~ugB.cells['deleted'])[0]
+        cn=ugB.cells['nodes'][B_cells]
+        if cn.shape[1]>self.max_sides:
+            if np.any(cn[:,self.max_sides:]>=0):
+                raise GridException("add_grid: ugB has cells with more than %d sides"%self.max_sides)
+            cn=cn[:,:self.max_sides]
+        cn=np.where(cn>=0,node_map[cn],self.UNDEFINED)
+        cn_pad=np.full((len(cn),self.max_sides),self.UNDEFINED,np.int32)
+        cn_pad[:,:cn.shape[1]]=cn
+
+        # duplicate cells have the same set of nodes
+        my_cells=np.nonzero(~self.cells['deleted'])[0]
+        keys=np.sort(np.concatenate([self.cells['nodes'][my_cells],cn_pad]),axis=1)
+        first=np.concatenate([my_cells,-1-np.arange(len(cn_pad))])[topology.first_duplicate(keys)]
+        first=first[len(my_cells):]
+        dup=first>=0
+        cell_map[B_cells[dup]]=first[dup]
+
+        fields=common_fields(self.cells,ugB.cells,['nodes','edges','deleted'])
+        new=~dup
+        cell_map[B_cells[new]]=self.add_cells(cn_pad[new],
+                                              **{f:ugB.cells[f][B_cells[new]]
+                                                 for f in fields})
 
-        for n in ugB.valid_edge_iter():
-            kwargs=rec_to_dict(ugB.edges[n])
-            for f in B_bad:
-                del kwargs[f]
-
-            kwargs['nodes']=node_map[kwargs['nodes']]
+        return node_map,edge_map,cell_map
 
-            # when merge_nodes is specified, have to also check
-            # for preexisting edges
-            if merge_nodes is not None:
-                j=self.nodes_to_edge(kwargs['nodes'])
-                if j is not None:
-                    edge_map[n]=j
-                    continue
-            edge_map[n]=self.add_edge(**kwargs)
-
-        B_bad=bad_fields(self.cells,ugB.cells)
-
-        for n in ugB.valid_cell_iter():
-            kwargs=rec_to_dict(ugB.cells[n])
-            for f in B_bad:
-                del kwargs[f]
-
-            # avoid mutating ugB.
-            orig_nodes=kwargs['nodes']
-            kwargs['nodes'] = orig_nodes.copy()
-            kwargs['edges'] = kwargs['edges'].copy()
-
-            for i,node in enumerate(kwargs['nodes']):
-                if node>=0:
-                    kwargs['nodes'][i]=node_map[node]
-
-            # less common, but still need to check for duplicated cells
-            # when merge_nodes is used.
-            if merge_nodes is not None:
-                c=self.nodes_to_cell( kwargs['nodes'], fail_hard=False)
-                if c is not None:
-                    cell_map[n]=c
-                    print("Skipping existing cell: %d: %s => %d: %s"%( n,str(orig_nodes),
-                                                                       c,str(kwargs['nodes'])))
+    @staticmethod
+    def merge_grids(grids,tolerance=0.0,grid_class=None):
+        """
+        Combine several grids into a new grid in one pass, merging nodes
+        within tolerance across all of them (see merge_duplicate_nodes).
+        Extra fields are kept when present in all of the grids.  The result
+        is renumbered, so deleted elements are dropped.
+        grid_class: class of the result, defaulting to the class of the
+          first grid.
+        """
+        if grid_class is None:
+            grid_class=grids[0].__class__
+
+        def common_dtype(attr):
+            return [ descr for descr in getattr(grids[0],attr).dtype.descr
+                     if all(descr[0] in getattr(g,attr).dtype.names for g in grids[1:]) ]
+
+        max_sides=max(g.max_sides for g in grids)
+        result=grid_class(max_sides=max_sides)
+        node_dtype=common_dtype('nodes')
+        edge_dtype=common_dtype('edges')
+        cell_dtype=[ descr if descr[0] not in ('nodes','edges') else (descr[0],np.int32,max_sides)
+                     for descr in common_dtype('cells') ]
+
+        nodes=[] ; edges=[] ; cells=[]
+        n_off=0 ; e_off=0 ; c_off=0
+        for g in grids:
+            n_valid=~g.nodes['deleted']
+            e_valid=~g.edges['deleted']
+            c_valid=~g.cells['deleted']
+            # renumber the valid elements of g into the combined arrays
+            n_new=np.cumsum(n_valid)-1+n_off
+            e_new=np.cumsum(e_valid)-1+e_off
+            c_new=np.cumsum(c_valid)-1+c_off
+
+            N=np.zeros(n_valid.sum(),node_dtype)
+            for f in N.dtype.names:
+                N[f]=g.nodes[f][n_valid]
+            E=np.zeros(e_valid.sum(),edge_dtype)
+            for f in E.dtype.names:
+                E[f]=g.edges[f][e_valid]
+            E['nodes']=n_new[g.edges['nodes'][e_valid]]
+            ec=g.edges['cells'][e_valid]
+            E['cells']=np.where(ec>=0,c_new[ec],ec)
+            C=np.zeros(c_valid.sum(),cell_dtype)
+            for f in C.dtype.names:
+                if f in ('nodes','edges'):
                     continue
-
-            for i,edge in enumerate(kwargs['edges']):
-                if edge>=0:
-                    kwargs['edges'][i]=edge_map[edge]
-
-            cell_map[n]=self.add_cell(**kwargs)
-
-        return node_map,edge_map,cell_map
+                C[f]=g.cells[f][c_valid]
+            for f,new_idx in [('nodes',n_new),('edges',e_new)]:
+                src=g.cells[f][c_valid]
+                C[f]=result.UNDEFINED
+                C[f][:,:src.shape[1]]=np.where(src>=0,new_idx[src],result.UNDEFINED)
+
+            nodes.append(N) ; edges.append(E) ; cells.append(C)
+            n_off+=len(N) ; e_off+=len(E) ; c_off+=len(C)
+
+        result.node_dtype=node_dtype
+        result.edge_dtype=edge_dtype
+        result.cell_dtype=cell_dtype
+        result.nodes=np.concatenate(nodes)
+        result.edges=np.concatenate(edges)
+        result.cells=np.concatenate(cells)
+        result.refresh_metadata()
+
+        result.merge_duplicate_nodes(tolerance=tolerance)
+        result.renumber()
+        return result
 
     def boundary_cycle(self):
         # find a point outside the domain:
@@ -1118,7 +1313,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         if recalc:
             self.edges['cells'][:,:]=self.UNMESHED
             self.log.info("Recalculating edge to cells" )
-            all_c=range(self.Ncells())
+            self._edge_to_cells_bulk()
+            return self.edges['cells'][e]
         else:
             if e is None:
                 e=slice(None)
@@ -1168,6 +1364,25 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         return self.edges['cells'][e]
 
+    def _edge_to_cells_bulk(self):
+        """ set edges['cells'] for all edges referenced by valid cells,
+        matching cell sides to edges with a single sort rather than
+        per-cell lookups.
+        """
+        c,i,a,b=topology.cell_halfedges(self.cells['nodes'],
+                                        valid=~self.cells['deleted'])
+        js=topology.match_edges(self.edges['nodes'],a,b,
+                                Nnodes=self.Nnodes(),
+                                valid=~self.edges['deleted'])
+        missing=js<0
+        if np.any(missing):
+            self.log.warning("Failed to find %d edges"%missing.sum())
+            c,a,js=c[~missing],a[~missing],js[~missing]
+        # cell is on the left when the side runs the same way as the edge
+        left=self.edges['nodes'][js,0]==a
+        self.edges['cells'][js[left],0]=c[left]
+        self.edges['cells'][js[~left],1]=c[~left]
+
     def make_cell_nodes_from_edge_nodes(self):
         """ some formats (old UnTRIM...) list edges that make up cells, but not
         the nodes.  This method uses cells['edges'] and edges['nodes'] to populate
@@ -1195,33 +1410,20 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             self.cells['nodes'][c,len(nodes):]=self.UNDEFINED
 
     def make_edges_from_cells(self):
-        edge_map = {} # keys are tuples of node indices, mapping to index into new_edges
-        new_edges = [] # each entry is [n1,n2,c1,c2].  assume for now that c1 is on the left of the edge n1->n2
-
-        for c in range(self.Ncells()):
-            for i,(a,b) in enumerate(circular_pairs(self.cell_to_nodes(c))):
-                if a<b:
-                    k = (a,b)
-                else:
-                    k = (b,a)
-                if k not in edge_map:
-                    j = len(new_edges)
-                    edge_map[k] = j
-                    # we know everything but the opposite cell
-                    new_edges.append([a,b,c,-1])
-                else:
-                    # if it's already in there, then we must be the right-hand side cell
-                    j = edge_map[k]
-                    new_edges[j][3] = c
-                # not 100% sure that this will put the edges in with the expected order
-                # this should have edge i immediately CCW from node i.
-                self.cells['edges'][c,i] = j
-
-        new_edges = np.array(new_edges)
-        self.edges = np.zeros( len(new_edges),self.edge_dtype )
-        self.edges['nodes'] = new_edges[:,:2]
-        self.edges['cells'] = new_edges[:,2:4]
+        """ Replace edges with the unique sides of all cells, and set
+        cells['edges'] to match.  Edges are numbered in the order they are
+        encountered in cells, and oriented so that the first cell referencing
+        an edge is on its left.
+        """
+        edge_nodes,edge_cells,cell_edges=topology.edges_from_cells(self.cells['nodes'],
+                                                                   Nnodes=self.Nnodes())
+        self.cells['edges']=cell_edges
+        self.edges = np.zeros( len(edge_nodes),self.edge_dtype )
+        self.edges['nodes'] = edge_nodes
+        self.edges['cells'] = edge_cells
         self._node_to_edges=None
+        self.drop_element_indices()
+        self.drop_graphs()
 
     def refresh_metadata(self):
         """ Call this when the cells, edges and nodes may be out of sync with indices
@@ -1234,6 +1436,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         #self._calc_vcenters = False
         self._node_to_edges = None
         self._node_to_cells = None
+        self.drop_element_indices()
+        self.drop_graphs()
 
     def Nnodes(self):
         """
@@ -1288,46 +1492,58 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         # return self.nodes['x'][self.edges['nodes']].mean(axis=1)
         return centers
 
+    # cells are processed in chunks of this size in the vectorized
+    # geometry calculations, to bound memory for very large grids
+    geometry_chunk=200000
+
     def cells_centroid(self,ids=None):
         if ids is None:
             ids=np.arange(self.Ncells())
-            
+        ids=np.asarray(ids)
+
         centroids=np.zeros( (len(ids),2),'f8')*np.nan
-        
-        for ci,c in enumerate(ids):
-            if not self.cells['deleted'][c]:
-                centroids[ci]= np.array(self.cell_polygon(c).centroid)
+        valid=~self.cells['deleted'][ids]
+        centroids[valid]=cell_geometry.cells_centroid(self.nodes['x'],
+                                                      self.cells['nodes'][ids[valid]],
+                                                      chunk=self.geometry_chunk)
         return centroids
 
     def cells_centroid_py(self):
         """
-        This is not currently any faster than using the above shapely 
-        code, but is pasted in here since it may become faster with 
-        some tweaking, or be more amenable to numba or cython acceleration
-        in the future.
+        Same as cells_centroid(), retained for compatibility.
         """
-        A=self.cells_area()
-        cxy=np.zeros( (self.Ncells(),2), np.float64)
+        return self.cells_centroid()
 
-        refs=self.nodes['x'][self.cells['nodes'][:,0]]
+    def cells_geometry(self,ids=None,mode='first3'):
+        """
+        Area, centroid and circumcenter for the given cells (default all),
+        calculated together in one pass.  This also refreshes the cached
+        area and center for those cells.  Deleted cells get nan.
 
-        all_pnts=self.nodes['x'][self.cells['nodes']] - refs[:,None,:]
+        mode: how to compute the circumcenter, see cells_center()
 
-        for c in np.nonzero(~self.cells['deleted'])[0]:
-            nodes=self.cell_to_nodes(c)
+        returns area [N], centroid [N,2], circumcenter [N,2]
+        """
+        if ids is None:
+            ids=np.arange(self.Ncells())
+        ids=np.asarray(ids)
+
+        area=np.zeros(len(ids),'f8')*np.nan
+        centroid=np.zeros( (len(ids),2),'f8')*np.nan
+        center=np.zeros( (len(ids),2),'f8')*np.nan
+
+        valid=~self.cells['deleted'][ids]
+        A,cxy,cc=cell_geometry.cells_geometry(self.nodes['x'],
+                                              self.cells['nodes'][ids[valid]],
+                                              chunk=self.geometry_chunk,
+                                              center=mode)
+        area[valid]=A
+        centroid[valid]=cxy
+        center[valid]=cc
+        self.cells['_area'][ids[valid]]=A
+        self.cells['_center'][ids[valid]]=cc
+        return area,centroid,center
 
-            i=np.arange(len(nodes))
-            ip1=(i+1)%len(nodes)
-            nA=all_pnts[c,i]
-            nB=all_pnts[c,ip1]
-
-            tmp=(nA[:,0]*nB[:,1] - nB[:,0]*nA[:,1])
-            cxy[c,0] = ( (nA[:,0]+nB[:,0])*tmp).sum()
-            cxy[c,1] = ( (nA[:,1]+nB[:,1])*tmp).sum()
-        cxy /= 6*A[:,None]    
-        cxy += refs
-        return cxy
-    
     def cells_center(self,refresh=False,mode='first3'):
         """ calling this method is preferable to direct access to the
         array, since cell centers can possibly be stale if the grid has been
@@ -1338,6 +1554,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         refresh: must be True, False, or something slice-like (slice, bitmap, integer array)
         mode: first3 - estimate circumcenter from the first 3 nodes
+              sequential - average of circumcenters of consecutive triples of nodes
         """
         if refresh is True:
             to_update=slice(None)
@@ -1346,15 +1563,13 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         else:
             to_update = np.isnan(self.cells['_center'][:,0])
 
-        if np.sum(to_update) > 0:
-            if mode=='first3':
-                p1,p2,p3 = [self.nodes['x'][self.cells['nodes'][to_update,i]] for i in [0,1,2]]
-                self.cells['_center'][to_update] = circumcenter(p1,p2,p3)
-            elif mode=='sequential':
-                for c in np.arange(self.Ncells())[to_update]:
-                    points=self.nodes['x'][self.cell_to_nodes(c)]
-                    self.cells['_center'][c] = poly_circumcenter(points)
-        
+        # atleast_1d so that a scalar cell index works, too
+        c_update=np.atleast_1d(np.arange(self.Ncells())[to_update])
+        if len(c_update) > 0:
+            self.cells['_center'][c_update]=cell_geometry.cells_circumcenter(self.nodes['x'],
+                                                                            self.cells['nodes'][c_update],
+                                                                            chunk=self.geometry_chunk,
+                                                                            mode=mode)
         return self.cells['_center']
 
     def bounds(self,order='xxyy'):
@@ -1396,10 +1611,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """ Return an ndarray of the node indices which share edges with 
         node n.
         """
-        js = self.node_to_edges(n)
+        if self._node_to_edges is None:
+            self.build_node_to_edges()
+        js = self._node_to_edges.row(n)
         all_nodes = self.edges['nodes'][js].ravel()
-        # return np.setdiff1d(all_nodes,[n]) # significantly slower than lists
-        return np.array( [nbr for nbr in all_nodes if nbr!=n] )
+        return all_nodes[all_nodes!=n]
 
     def angle_sort_adjacent_nodes(self,n,ref_nbr=None):
         """
@@ -1418,14 +1634,18 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             nbrs=np.roll(nbrs,-i)
         return nbrs
 
+    def node_to_cells_csr(self):
+        """ node to cell adjacency for all valid cells, as CSR arrays
+        (offsets,indices).  cells of node n are indices[offsets[n]:offsets[n+1]]
+        """
+        if self._node_to_cells is not None:
+            return self._node_to_cells.to_csr(self.Nnodes())
+        return topology.node_to_cells_csr(self.cells['nodes'],self.Nnodes(),
+                                          valid=~self.cells['deleted'])
+
     def build_node_to_cells(self):
-        n2c = defaultdict(list)
-        for c in range(self.Ncells()):
-            if self.cells['deleted'][c]:
-                continue
-            for cn in self.cell_to_nodes(c):
-                n2c[cn].append(c)
-        self._node_to_cells = n2c
+        self._node_to_cells = None
+        self._node_to_cells = topology.Adjacency(*self.node_to_cells_csr())
         
     _node_to_edges = None
     def node_to_edges(self,n):
@@ -1433,7 +1653,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             self.build_node_to_edges()
         return self._node_to_edges[n]
     def node_degree(self,n):
-        return len(self.node_to_edges(n))
+        if self._node_to_edges is None:
+            self.build_node_to_edges()
+        return self._node_to_edges.degree(n)
 
     def edge_to_edges(self,e):
         e_adj=[]
@@ -1441,12 +1663,18 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             e_adj += list(self.node_to_edges(n))
         return np.unique(e_adj)
 
+    def node_to_edges_csr(self):
+        """ node to edge adjacency for all valid edges, as CSR arrays
+        (offsets,indices).  edges of node n are indices[offsets[n]:offsets[n+1]]
+        """
+        if self._node_to_edges is not None:
+            return self._node_to_edges.to_csr(self.Nnodes())
+        return topology.node_to_edges_csr(self.edges['nodes'],self.Nnodes(),
+                                          valid=~self.edges['deleted'])
+
     def build_node_to_edges(self):
-        n2e = defaultdict(list)
-        for e in self.valid_edge_iter(): 
-            for i in [0,1]:
-                n2e[self.edges['nodes'][e,i]].append(e)
-        self._node_to_edges = n2e
+        self._node_to_edges = None
+        self._node_to_edges = topology.Adjacency(*self.node_to_edges_csr())
         
     def nodes_to_edge(self,n1,n2=None):
         if n2 is None:
@@ -1593,6 +1821,58 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 return hit
         return self.add_node(x=x,**kwargs)
     
+    # Storage for nodes, edges and cells is a prefix view on a larger base
+    # array, so that appending usually just extends the view.  This follows
+    # utils.array_append, but allows for adding many rows at once.
+    @staticmethod
+    def _capacity(A):
+        """ number of rows A can grow to in place """
+        base=A.base
+        # __array_interface__ is slow for structured arrays, compare
+        # data pointers via ctypes
+        if ( isinstance(base,np.ndarray) and base.dtype==A.dtype
+             and base.ndim==A.ndim and base.strides==A.strides
+             and base.flags.writeable
+             and base.ctypes.data==A.ctypes.data ):
+            return len(base)
+        return len(A)
+
+    def _extend_array(self,A,count):
+        """
+        returns A extended by count zeroed rows.  When A has no spare
+        capacity, the base array grows geometrically.
+        """
+        N=len(A)
+        if self._capacity(A)>=N+count:
+            A=A.base[:N+count]
+        else:
+            base=np.zeros( max(2*N+10,N+count), dtype=A.dtype)
+            base[:N]=A
+            A=base[:N+count]
+        A[N:]=np.zeros((),dtype=A.dtype)
+        return A
+
+    def _reserve_array(self,A,count):
+        if count is None or self._capacity(A)>=count:
+            return A
+        base=np.zeros(count,dtype=A.dtype)
+        base[:len(A)]=A
+        return base[:len(A)]
+
+    def reserve(self,nodes=None,edges=None,cells=None):
+        """
+        Preallocate storage for at least the given total number of nodes,
+        edges and cells, so that adding up to that many elements does not
+        copy the arrays.
+        """
+        self.nodes=self._reserve_array(self.nodes,nodes)
+        self.edges=self._reserve_array(self.edges,edges)
+        self.cells=self._reserve_array(self.cells,cells)
+
+    # Above this fraction of existing elements, bulk adds rebuild the
+    # node adjacency instead of updating it entry by entry
+    bulk_rebuild_fraction=0.25
+
     @listenable
     def add_node(self,**kwargs):
         i=None
@@ -1606,8 +1886,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 self.nodes[i]['deleted']=False
 
         if i is None: # have to extend the array
-            n=np.zeros( (), dtype=self.node_dtype)
-            self.nodes=array_append(self.nodes,n)
+            self.nodes=self._extend_array(self.nodes,1)
             i=len(self.nodes)-1
 
         for k,v in six.iteritems(kwargs):
@@ -1623,6 +1902,39 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     def unadd_node(self,idx):
         self.delete_node(idx)
 
+    @listenable
+    def add_nodes(self,x,**kwargs):
+        """
+        Bulk version of add_node.
+        x: [N,2] coordinates.
+        kwargs: other node fields, as arrays of length N or scalars.
+
+        Listeners see a single add_nodes event for the whole batch, and
+        no add_node events, so anything tracking nodes (e.g. ShadowCDT)
+        must subscribe to both.
+        returns [N] array of the new node indices.
+        """
+        x=np.asarray(x,np.float64).reshape([-1,2])
+        start=len(self.nodes)
+        self.nodes=self._extend_array(self.nodes,len(x))
+        idxs=np.arange(start,start+len(x))
+        self.nodes['x'][idxs]=x
+        for k,v in six.iteritems(kwargs):
+            self.nodes[k][idxs]=v
+        self.nodes['deleted'][idxs]=False
+
+        if self._node_index is not None:
+            for i in idxs:
+                self._node_index.insert(i, self.nodes['x'][i,self.xxyy] )
+        self.push_op(self.unadd_nodes,idxs)
+        return idxs
+
+    def unadd_nodes(self,idxs):
+        # delete_node only marks nodes deleted, so the slots remain.
+        # reverse order to mirror undoing the scalar adds.
+        for n in idxs[::-1]:
+            self.delete_node(n)
+
     class InvalidEdge(GridException):
         pass
 
@@ -1647,8 +1959,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 raise GridException("Edge already exists")
                 
         if j is None:
-            e=np.zeros( (),dtype=self.edge_dtype)
-            self.edges=array_append(self.edges,e)
+            self.edges=self._extend_array(self.edges,1)
             j=len(self.edges)-1
 
         # default values
@@ -1664,8 +1975,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         if self._node_to_edges is not None:
             n1,n2=self.edges['nodes'][j]
-            self._node_to_edges[n1].append(j)
-            self._node_to_edges[n2].append(j)
+            self._node_to_edges.add(n1,j)
+            self._node_to_edges.add(n2,j)
 
         self.push_op(self.unadd_edge,j)
         return j
@@ -1673,6 +1984,54 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     def unadd_edge(self,j):
         self.delete_edge(j)
 
+    @listenable
+    def add_edges(self,nodes,_check_existing=True,**kwargs):
+        """
+        Bulk version of add_edge.
+        nodes: [N,2] node indices.
+        kwargs: other edge fields, as arrays of length N or scalars.
+          'cells' defaults to -1.
+
+        Listeners see a single add_edges event for the whole batch, and
+        no add_edge events, so anything tracking edges (e.g. ShadowCDT)
+        must subscribe to both.
+        returns [N] array of the new edge indices.
+        """
+        nodes=np.asarray(nodes,np.int32).reshape([-1,2])
+        if np.any(nodes[:,0]==nodes[:,1]):
+            raise self.InvalidEdge('duplicate nodes')
+        if _check_existing and len(nodes):
+            hits=topology.match_edges(self.edges['nodes'],nodes[:,0],nodes[:,1],
+                                      Nnodes=self.Nnodes(),
+                                      valid=~self.edges['deleted'])
+            keys=topology.pair_keys(nodes[:,0],nodes[:,1],self.Nnodes())
+            if np.any(hits>=0) or len(np.unique(keys))<len(keys):
+                raise GridException("Edge already exists")
+
+        start=len(self.edges)
+        self.edges=self._extend_array(self.edges,len(nodes))
+        idxs=np.arange(start,start+len(nodes))
+        self.edges['nodes'][idxs]=nodes
+        self.edges['cells'][idxs]=-1
+        for k,v in six.iteritems(kwargs):
+            self.edges[k][idxs]=v
+        self.edges['deleted'][idxs]=False
+
+        if self._node_to_edges is not None:
+            if len(idxs)>self.bulk_rebuild_fraction*start:
+                self._node_to_edges=None
+            else:
+                for j,(n1,n2) in zip(idxs,nodes):
+                    self._node_to_edges.add(n1,j)
+                    self._node_to_edges.add(n2,j)
+
+        self.push_op(self.unadd_edges,idxs)
+        return idxs
+
+    def unadd_edges(self,idxs):
+        for j in idxs[::-1]:
+            self.delete_edge(j)
+
     # the delete_* operations require that there are no dependent
     # entities, while the delete_*_cascade operations will check
     # and remove dependent entitites
@@ -1683,7 +2042,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         self.edges['deleted'][j] = True
         if self._node_to_edges is not None:
             for n in self.edges['nodes'][j]:
-                self._node_to_edges[n].remove(j)
+                self._node_to_edges.remove(n,j)
 
         self.push_op(self.undelete_edge,j,self.edges[j].copy())
 
@@ -1927,14 +2286,12 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         promise to check!
         """
         if self._node_to_edges is not None:
-            if len(self._node_to_edges[n])>0:
+            if self._node_to_edges.degree(n)>0:
                 print( "Node %d has edges: %s"%(n,self._node_to_edges[n]) )
                 raise GridException("Node still has edges referring to it")
-            del self._node_to_edges[n]
         if self._node_to_cells is not None:
-            if len(self._node_to_cells[n])>0:
+            if self._node_to_cells.degree(n)>0:
                 raise GridException("Node still has cells referring to it")
-            del self._node_to_cells[n]
         if self._node_index is not None:
             self._node_index.delete(n, self.nodes['x'][n,self.xxyy] )
 
@@ -1987,7 +2344,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                     
         if self._node_to_cells is not None:
             for n in self.cell_to_nodes(i):
-                self._node_to_cells[n].remove(i)
+                self._node_to_cells.remove(n,i)
             
         self.push_op(self.undelete_cell,i,self.cells[i].copy())
 
@@ -2062,8 +2419,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 assert self.cells[i]['deleted']
 
         if i is None:
-            c=np.zeros( (),dtype=self.cell_dtype)
-            self.cells=array_append(self.cells,c)
+            self.cells=self._extend_array(self.cells,1)
             i=len(self.cells)-1
         else:
             pass
@@ -2085,7 +2441,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         if self._node_to_cells is not None:
             for n in self.cell_to_nodes(i):
-                self._node_to_cells[n].append(i)
+                self._node_to_cells.add(n,i)
 
         if self._cell_center_index is not None:
             if self.cell_center_index_point=='circumcenter':
@@ -2133,6 +2489,74 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     def unadd_cell(self,i):
         self.delete_cell(i)
 
+    @listenable
+    def add_cells(self,nodes,**kwargs):
+        """
+        Bulk version of add_cell.  Edges must already exist.
+        nodes: [N,k] node indices, k<=max_sides, padded with negative values.
+        kwargs: other cell fields, as arrays of length N or scalars.
+
+        Sets cells['edges'] and the corresponding edges['cells'] with
+        array operations.  Listeners see a single add_cells event for the
+        whole batch, and no add_cell events.
+        returns [N] array of the new cell indices.
+        """
+        nodes=np.asarray(nodes,np.int32)
+        if nodes.ndim<2:
+            nodes=nodes.reshape([len(nodes),-1])
+        N=len(nodes)
+        cell_nodes=np.full((N,self.max_sides),self.UNDEFINED,np.int32)
+        cell_nodes[:,:nodes.shape[1]]=np.where(nodes>=0,nodes,self.UNDEFINED)
+
+        start=len(self.cells)
+        idxs=np.arange(start,start+N)
+
+        # resolve the edges before modifying anything
+        c,i,a,b=topology.cell_halfedges(cell_nodes)
+        js=topology.match_edges(self.edges['nodes'],a,b,Nnodes=self.Nnodes(),
+                                valid=~self.edges['deleted'])
+        if np.any(js<0):
+            raise GridException("add_cells: %d cell sides have no edge"%np.sum(js<0))
+        side=np.where(self.edges['nodes'][js,0]==a,0,1)
+        if np.any(self.edges['cells'][js,side]>=0):
+            raise GridException("add_cells: edge already has a cell on that side")
+        slots=js*2+side
+        if len(np.unique(slots))<len(slots):
+            raise GridException("add_cells: cells in the batch overlap")
+
+        self.cells=self._extend_array(self.cells,N)
+        self.cells['nodes'][idxs]=cell_nodes
+        self.cells['edges'][idxs]=self.UNDEFINED
+        self.cells['edges'][idxs[c],i]=js
+        self.cells['_center'][idxs]=np.nan
+        self.cells['_area'][idxs]=np.nan
+        for k,v in six.iteritems(kwargs):
+            self.cells[k][idxs]=v
+        self.cells['deleted'][idxs]=False
+        self.edges['cells'][js,side]=idxs[c]
+
+        if self._node_to_cells is not None:
+            if N>self.bulk_rebuild_fraction*start:
+                self._node_to_cells=None
+            else:
+                for n,ci in zip(a,idxs[c]):
+                    self._node_to_cells.add(n,ci)
+
+        if self._cell_center_index is not None:
+            if self.cell_center_index_point=='circumcenter':
+                ccs=self.cells_center()[idxs]
+            else: # centroid
+                ccs=self.cells_centroid(idxs)
+            for ci,cc in zip(idxs,ccs):
+                self._cell_center_index.insert(ci,cc[self.xxyy])
+
+        self.push_op(self.unadd_cells,idxs)
+        return idxs
+
+    def unadd_cells(self,idxs):
+        for c in idxs[::-1]:
+            self.delete_cell(c)
+
     def add_cell_and_edges(self,nodes,**kws):
         """ convenience wrapper for add_cell which makes sure all 
         the edges exist first.
@@ -2151,7 +2575,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """
         if 'nodes' in kws and self._node_to_cells is not None:
             for n in self.cell_to_nodes(c):
-                self._node_to_cells[n].remove(c)
+                self._node_to_cells.remove(n,c)
 
         for k,v in six.iteritems(kws):
             if k in ('nodes','edges'):
@@ -2162,7 +2586,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         if 'nodes' in kws and self._node_to_cells is not None:
             for n in self.cell_to_nodes(c):
-                self._node_to_cells[n].append(c)
+                self._node_to_cells.add(n,c)
 
     @listenable
     def modify_edge(self,j,**kws):
@@ -2171,14 +2595,14 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
 
         if 'nodes' in kws and self._node_to_edges is not None:
             for n in self.edges['nodes'][j]:
-                self._node_to_edges[n].remove(j)
+                self._node_to_edges.remove(n,j)
 
         for k,v in six.iteritems(kws):
             self.edges[k][j]=v
 
         if 'nodes' in kws and self._node_to_edges is not None:
             for n in self.edges['nodes'][j]:
-                self._node_to_edges[n].append(j)
+                self._node_to_edges.add(n,j)
             
     @listenable
     def modify_node(self,n,**kws):
@@ -2255,8 +2679,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             if self.cells['nodes'][c,ni] == n_old:
                 self.cells['nodes'][c,ni] = n_new
                 if self._node_to_cells is not None:
-                    self._node_to_cells[n_old].remove(c)
-                    self._node_to_cells[n_new].append(c)
+                    self._node_to_cells.remove(n_old,c)
+                    self._node_to_cells.add(n_new,c)
     def edge_replace_node(self,j,n_old,n_new):
         """ see cell_replace_node
         """
@@ -2264,8 +2688,8 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             if self.edges['nodes'][j,ni] == n_old:
                 self.edges['nodes'][j,ni] = n_new
                 if self._node_to_edges is not None:
-                    self._node_to_edges[n_old].remove(j)
-                    self._node_to_edges[n_new].append(j)
+                    self._node_to_edges.remove(n_old,j)
+                    self._node_to_edges.add(n_new,j)
 
     #-# higher level topology modifications
     def collapse_short_edges(self,l_thresh=1.0):
@@ -2299,7 +2723,7 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 c_n.append(-1)
                 self.cells['nodes'][c] = c_n
                 if self._node_to_cells is not None:
-                    self._node_to_cells[n_del].remove(c)
+                    self._node_to_cells.remove(n_del,c)
 
                 c_e = list(self.cells['edges'][c])
                 c_e.remove(j_del)
@@ -2639,12 +3063,12 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         return mag( p2-p1 )
 
     def cells_area(self):
-        sel = np.isnan(self.cells['_area']) & (~self.cells['deleted'])
+        sel = np.nonzero( np.isnan(self.cells['_area']) & (~self.cells['deleted']) )[0]
 
-        if sum(sel)>0:
-            for c in np.nonzero(sel)[0]:
-                self.cells['_area'][c] = signed_area(self.nodes['x'][self.cell_to_nodes(c)])
-                
+        if len(sel)>0:
+            self.cells['_area'][sel] = cell_geometry.cells_area(self.nodes['x'],
+                                                                self.cells['nodes'][sel],
+                                                                chunk=self.geometry_chunk)
         return self.cells['_area']
 
     #-# Selection methods:
@@ -2653,20 +3077,21 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     #  easier to compose selections with bitmasks, so there it is.
     #  when implementing these, note that all selections should avoid 'deleted' elements.
     #   unless the selection criteria explicitly includes them.
-    def select_edges_intersecting(self,geom,invert=False):
+    def select_edges_intersecting(self,geom,invert=False,as_type='mask'):
         """
         geom: a shapely geometry
         returns: bitmask overcells, with non-deleted, selected edges set and others False.
         if invert is True, select edges which do not intersect the the given geometry.  
+        as_type: 'mask' returns boolean valued mask, 'indices' returns array of indices
+
+        Uses the bulk test of element_index, with exact tests only for
+        edges near the linework of geom.
         """
-        sel = np.zeros(self.Nedges(),np.bool8) # initialized to False
-        for j in range(self.Nedges()):
-            if self.edges['deleted'][j]:
-                continue
-            edge_line = geometry.LineString(self.nodes['x'][self.edges['nodes'][j]])
-            sel[j] = geom.intersects(edge_line)
-            if invert:
-                sel[j] = ~sel[j]
+        sel=self.edge_index().select_intersecting(geom)
+        if invert:
+            sel=(~sel) & (~self.edges['deleted'])
+        if as_type!='mask':
+            sel=np.nonzero(sel)[0]
         return sel
     
     def cell_polygon(self,c):
@@ -2815,20 +3240,16 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         return boundary_nodes
 
     def select_nodes_intersecting(self,geom=None,xxyy=None,invert=False,as_type='mask'):
-        sel = np.zeros(self.Nnodes(),np.bool8) # initialized to False
-
         assert (geom is not None) or (xxyy is not None)
 
         if xxyy is not None:
             geom=geometry.box(xxyy[0], xxyy[2],xxyy[1],xxyy[3])
-            
-        for n in range(self.Nnodes()):
-            if self.nodes['deleted'][n]:
-                continue
-            test = geom.intersects(self.node_point(n))
-            if invert:
-                test = ~test
-            sel[n] = test
+
+        valid=~self.nodes['deleted']
+        sel = np.zeros(self.Nnodes(),np.bool8) # initialized to False
+        sel[valid]=element_index.points_intersecting(geom,self.nodes['x'][valid])
+        if invert:
+            sel=(~sel) & valid
         if as_type!='mask':
             sel=np.nonzero(sel)[0]
         return sel
@@ -2841,28 +3262,18 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         by_center: if true, test against the cell center.  By default, tests against the 
         finite cell.
         """
-        if as_type is 'mask':
+        valid=~self.cells['deleted']
+        if by_center:
             sel = np.zeros(self.Ncells(),np.bool8) # initialized to False
+            centers=self.cells_center()
+            sel[valid]=element_index.points_intersecting(geom,centers[valid])
         else:
-            sel = []
+            sel=self.cell_index().select_intersecting(geom)
 
-        if by_center:
-            centers=self.cells_center()
-            
-        for c in range(self.Ncells()):
-            if self.cells['deleted'][c]:
-                continue
-            if by_center:
-                test=geom.intersects( geometry.Point(centers[c]) )
-            else:
-                test=geom.intersects( self.cell_polygon(c) )
-            if invert:
-                test = ~test
-            if as_type is 'mask':
-                sel[c] = test
-            else:
-                if test:
-                    sel.append(c)
+        if invert:
+            sel=(~sel) & valid
+        if as_type!='mask':
+            sel=np.nonzero(sel)[0]
         return sel
 
     def select_cells_by_cut(self,line,start=0,side='left',delta=1.0):
@@ -2973,75 +3384,185 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         else:
             return hits
 
-    def shortest_path(self,n1,n2,return_type='nodes',
-                      edge_selector=lambda j: True):
-        """ dijkstra on the edge graph from n1 to n2
-        returns list of node indexes
-        selector: given an edge index, return True if the edge should be considered
-        """
-        if pq is None:
-            raise GridException("shortest_path requires the  priority_queue module.")
-
-        queue = pq.priorityDictionary()
-        # 
-        queue[n1] = [0,None] # distance, predecessor
-
-        done = {} # likewise
-
-        while 1:
-            # find the queue-member with the lowest cost:
-            if len(queue)==0:
-                return None
-            best = queue.smallest()
-            best_cost,pred = queue[best]
-            del queue[best]
-
-            done[best] = [best_cost,pred]
-
-            if best == n2:
-                break
-
-            # figure out its neighbors
-            nbrs=[]
-            for j in self.node_to_edges(n=best):
-                if edge_selector(j):
-                    ne1,ne2=self.edges['nodes'][j]
-                    if ne1==best:
-                        nbrs.append(ne2)
-                    else:
-                        nbrs.append(ne1)
-
-            for nbr in nbrs:
-                if nbr in done:
-                    continue
-
-                dist = mag( self.nodes['x'][nbr] - self.nodes['x'][best] )
-                new_cost = best_cost + dist
-
-                if nbr not in queue:
-                    queue[nbr] = [np.inf,None]
-
-                if queue[nbr][0] > new_cost:
-                    queue[nbr] = [new_cost,best]
+    # Sparse graph representations, for scipy.sparse.csgraph
+    _graph_cache=None
+    _graph_events=['add_node','add_nodes','delete_node','modify_node',
+                   'add_edge','add_edges','delete_edge','modify_edge',
+                   'add_cell','add_cells','delete_cell','modify_cell']
+
+    def _cached_graph(self,key,build):
+        if self._graph_cache is None:
+            self._graph_cache={}
+            for func_name in self._graph_events:
+                self.subscribe_after(func_name,self._on_graph_change)
+        if key not in self._graph_cache:
+            self._graph_cache[key]=build()
+        return self._graph_cache[key]
+
+    def _on_graph_change(self,grid,func_name,*a,**k):
+        self.drop_graphs()
+
+    def drop_graphs(self):
+        """ Discard cached node and cell graphs.  Called automatically
+        when the grid is modified through add/delete/modify methods.
+        """
+        if self._graph_cache is not None:
+            for func_name in self._graph_events:
+                self.unsubscribe_after(func_name,self._on_graph_change)
+            self._graph_cache=None
+
+    def _sym_graph(self,N,pairs,weights):
+        from scipy import sparse
+        weights=np.asarray(weights,np.float64)
+        return sparse.csr_matrix( (np.r_[weights,weights],
+                                   (np.r_[pairs[:,0],pairs[:,1]],
+                                    np.r_[pairs[:,1],pairs[:,0]])),
+                                  shape=(N,N) )
+
+    def node_graph(self,edge_weights=None,edge_mask=None):
+        """
+        Symmetric scipy.sparse [Nnodes,Nnodes] matrix of the edge graph.
+        edge_weights: [Nedges] array of weights, defaults to edge length.
+        edge_mask: [Nedges] boolean array, false for edges to omit.  Deleted
+          edges are always omitted.
+        The default graph (length weights, no mask) is cached until the grid
+        is modified.
+        """
+        if edge_weights is None and edge_mask is None:
+            return self._cached_graph('node',lambda: self._node_graph(None,None))
+        return self._node_graph(edge_weights,edge_mask)
+
+    def _node_graph(self,edge_weights,edge_mask):
+        sel=~self.edges['deleted']
+        if edge_mask is not None:
+            sel=sel & edge_mask
+        js=np.nonzero(sel)[0]
+        pairs=self.edges['nodes'][js]
+        if edge_weights is None:
+            weights=mag( self.nodes['x'][pairs[:,0]] - self.nodes['x'][pairs[:,1]] )
+        else:
+            weights=np.asarray(edge_weights)[js]
+        return self._sym_graph(self.Nnodes(),pairs,weights)
 
-        # reconstruct the path:
-        path = [n2]
+    def cell_graph(self,edge_weights=None,edge_mask=None):
+        """
+        Symmetric scipy.sparse [Ncells,Ncells] matrix of the dual graph, with
+        a connection across each internal edge.
+        edge_weights: [Nedges] array of weights, defaults to the distance
+          between the cells_center() of the two cells.
+        edge_mask: [Nedges] boolean array, false for edges which do not
+          connect their cells.
+        The default graph is cached until the grid is modified.
+        """
+        if edge_weights is None and edge_mask is None:
+            return self._cached_graph('cell',lambda: self._cell_graph(None,None))
+        return self._cell_graph(edge_weights,edge_mask)
 
-        while 1:
-            pred=done[path[-1]][1]
-            if pred is None:
-                break
+    def _cell_graph(self,edge_weights,edge_mask):
+        e2c=self.edge_to_cells()
+        sel=(~self.edges['deleted']) & np.all(e2c>=0,axis=1)
+        if edge_mask is not None:
+            sel=sel & edge_mask
+        js=np.nonzero(sel)[0]
+        pairs=e2c[js]
+        if edge_weights is None:
+            cc=self.cells_center()
+            weights=mag( cc[pairs[:,0]] - cc[pairs[:,1]] )
+        else:
+            weights=np.asarray(edge_weights)[js]
+        return self._sym_graph(self.Ncells(),pairs,weights)
+
+    def node_distances(self,sources,edge_weights=None,edge_mask=None,limit=np.inf,
+                       return_predecessors=False):
+        """
+        Distance along the edge graph from the nearest of sources to every node.
+        sources: node index or sequence of node indices.
+        edge_weights, edge_mask: see node_graph.
+        limit: stop searching beyond this distance.
+        returns [Nnodes] distances, inf for unreachable nodes.  With
+        return_predecessors, also return [Nnodes] predecessor of each node on
+        its shortest path, and the source each node is closest to, both
+        negative when unreachable.
+        """
+        graph=self.node_graph(edge_weights=edge_weights,edge_mask=edge_mask)
+        return self._graph_distances(graph,sources,limit,return_predecessors)
+
+    def cell_distances(self,sources,edge_weights=None,edge_mask=None,limit=np.inf,
+                       return_predecessors=False):
+        """
+        Like node_distances, but on the cell graph (see cell_graph).
+        """
+        graph=self.cell_graph(edge_weights=edge_weights,edge_mask=edge_mask)
+        return self._graph_distances(graph,sources,limit,return_predecessors)
+
+    def _graph_distances(self,graph,sources,limit,return_predecessors):
+        from scipy.sparse import csgraph
+        sources=np.atleast_1d(sources)
+        dist,pred,src=csgraph.dijkstra(graph,directed=False,indices=sources,
+                                       limit=limit,min_only=True,
+                                       return_predecessors=True)
+        if return_predecessors:
+            return dist,pred,src
+        return dist
+
+    def shortest_path(self,n1,n2,return_type='nodes',edge_selector=None,
+                      edge_weights=None,edge_mask=None):
+        """ dijkstra on the edge graph from n1 to n2
+        returns array of node indexes, or None if n2 cannot be reached.
+        n1: a node index, or sequence of node indices in which case the path
+          starts from the closest of them.
+        edge_selector: given an edge index, return True if the edge should be
+          considered.  Evaluated once per edge; edge_mask is faster.
+        edge_weights,edge_mask: see node_graph.  Weights default to edge length.
+        return_type: 'nodes', or 'edges'/'sides' for the edges along the path.
+        """
+        if edge_selector is not None:
+            selected=np.zeros(self.Nedges(),np.bool8)
+            for j in self.valid_edge_iter():
+                selected[j]=edge_selector(j)
+            if edge_mask is None:
+                edge_mask=selected
             else:
-                path.append(pred)
+                edge_mask=edge_mask & selected
 
-        path = np.array(path[::-1]) # reverse it so it goes from n1 to n2
+        dist,pred,src=self.node_distances(n1,edge_weights=edge_weights,
+                                          edge_mask=edge_mask,
+                                          return_predecessors=True)
+        if not np.isfinite(dist[n2]):
+            return None
+        path=self._graph_path(pred,n2)
 
-        if return_type=='nodes':    
+        if return_type=='nodes':
             return path
         elif return_type in ('edges','sides'):
-            return np.array( [self.nodes_to_edge(path[i],path[i+1])
-                              for i in range(len(path)-1)] )
-
+            return topology.match_edges(self.edges['nodes'],path[:-1],path[1:],
+                                        Nnodes=self.Nnodes(),
+                                        valid=~self.edges['deleted'])
+
+    def _graph_path(self,pred,target):
+        """ follow predecessors back from target, returning the path
+        in forward order """
+        path=[target]
+        while pred[path[-1]]>=0:
+            path.append(pred[path[-1]])
+        return np.array(path[::-1])
+
+    def nodes_connected_components(self,edge_mask=None):
+        """
+        Label nodes by connected component of the edge graph.
+        edge_mask: [Nedges] boolean, false for edges which do not connect
+          their nodes.
+        returns n_comps, labels.  labels is [Nnodes], numbered sequentially
+        from 0, and -1 for deleted nodes.
+        """
+        from scipy.sparse import csgraph
+        graph=self.node_graph(edge_weights=np.ones(self.Nedges()),
+                              edge_mask=edge_mask)
+        n_comps,labels=csgraph.connected_components(graph,directed=False)
+        valid=~self.nodes['deleted']
+        uniq,labels[valid]=np.unique(labels[valid],return_inverse=True)
+        labels[~valid]=-1
+        return len(uniq),labels
 
     def create_dual(self,center='centroid',create_cells=False):
         """
@@ -3092,19 +3613,11 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
           masked out, other cells labeled with the component to which they belong.
           
         """
-        # further constrain to edges which are not on the boundary
-        edge_mask=edge_mask & np.all( self.edges['cells']>=0,axis=1)
-
-        cell_pairs = self.edges['cells'][edge_mask]
-
-        # use scipy graph algorithms to find the connections
-        from scipy import sparse
-
-        graph=sparse.csr_matrix( (np.ones(len(cell_pairs)), 
-                                  (cell_pairs[:,0],cell_pairs[:,1])),
-                                 shape=(self.Ncells(),self.Ncells()) )
+        from scipy.sparse import csgraph
 
-        n_comps,labels=sparse.csgraph.connected_components(graph,directed=False)
+        # cell_graph omits boundary edges
+        graph=self.cell_graph(edge_weights=np.ones(self.Nedges()),edge_mask=edge_mask)
+        n_comps,labels=csgraph.connected_components(graph,directed=False)
 
         if cell_mask is None:
             cell_mask=slice(None)
@@ -3145,33 +3658,47 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
             self._cell_center_index = gen_spatial_index.PointIndex(tuples,interleaved=False)
         return self._cell_center_index
 
+    _edge_index=None
+    _cell_index=None
+    def edge_index(self):
+        """ Spatial index of edges as finite segments.  Built on first use,
+        and kept up to date through subsequent grid edits.
+        """
+        if self._edge_index is None:
+            self._edge_index=element_index.EdgeIndex(self)
+        return self._edge_index
+
+    def cell_index(self):
+        """ Spatial index of cells as polygons.  Built on first use,
+        and kept up to date through subsequent grid edits.
+        """
+        if self._cell_index is None:
+            self._cell_index=element_index.CellIndex(self)
+        return self._cell_index
+
+    def drop_element_indices(self):
+        """ Discard the edge and cell indices, i.e. after bulk changes which
+        bypass add/delete/modify.  They are rebuilt on next use.
+        """
+        for attr in ['_edge_index','_cell_index']:
+            idx=getattr(self,attr)
+            if idx is not None:
+                idx.unsubscribe()
+                setattr(self,attr,None)
+
     def select_edges_nearest(self,xy,count=None,fast=True):
+        """
+        Edges nearest to xy, by distance to the edge segment.
+        count: if None, return a single index, otherwise an array of indices.
+        fast: ignored. Queries always go through edge_index(), which is exact.
+        """
         xy=np.asarray(xy)
 
         real_count=count
         if count is None:
             real_count=1
 
-        if fast:
-            # TODO: maintain a proper edge index
-            # For now, brute force it.
-            ec=self.edges_center()
-            dists=mag(xy-ec)
-            dists[self.edges['deleted']]=np.inf
-            hits=np.argsort(dists)[:real_count]
-        else:
-            # actually query against the finite geometry of the edge
-            # still not exact, but okay in most cases.  an exact solution
-            # will have to wait until exact_delaunay is faster.
-            j_near = self.select_edges_nearest(xy,count=real_count*5,fast=True)
-
-            geoms=[geometry.LineString(self.nodes['x'][self.edges['nodes'][j]])
-                  for j in j_near]
-            P=geometry.Point(xy)
-
-            dists=[g.distance(P) for g in geoms]
-            order=np.argsort(dists)
-            hits=j_near[order[:real_count]]
+        hits=self.edge_index().nearest(xy,real_count)
 
         if count is None:
             return hits[0]
@@ -3247,6 +3774,110 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
                 return c
         return None
 
+    def points_to_cells(self,xy,walk=False,chunk=100000,max_steps=20):
+        """
+        Vectorized point location.
+        xy: [N,2] array of points
+        walk: if True, first try to reach each point by walking across
+          cell neighbors from the cell of the previous point.  This is
+          faster when successive points are close together, e.g. along
+          a track.  Points the walk cannot settle within max_steps fall
+          back to the index.
+        chunk: number of points to process at a time with the index.
+
+        returns [N] array of cell indices, -1 for points outside the grid.
+        Points on a side shared by two cells are assigned to just one of
+        them.
+        """
+        xy=np.asarray(xy,np.float64).reshape([-1,2])
+        result=np.full(len(xy),-1,np.int32)
+        if len(xy)==0 or self.Ncells()==0:
+            return result
+
+        if walk:
+            result[:]=self._walk_points(xy,max_steps=max_steps)
+            # the walk counts points on a side as inside, so confirm with the
+            # containment test used by the index path, which assigns points
+            # on a shared side to just one cell.
+            sel=np.nonzero(result>=0)[0]
+            if len(sel):
+                ok=cell_geometry.cells_contain_points(self.nodes['x'],
+                                                      self.cells['nodes'][result[sel]],
+                                                      xy[sel])
+                result[sel[~ok]]=-1
+            todo=np.nonzero(result<0)[0]
+        else:
+            todo=np.arange(len(xy))
+
+        cidx=self.cell_index()
+        for start in range(0,len(todo),chunk):
+            pnts=todo[start:start+chunk]
+            p,c=cidx.query_points(xy[pnts])
+            if len(p)==0:
+                continue
+            inside=cell_geometry.cells_contain_points(self.nodes['x'],
+                                                      self.cells['nodes'][c],
+                                                      xy[pnts[p]])
+            # reverse so that for overlapping cells the lowest index wins
+            result[pnts[p[inside]][::-1]]=c[inside][::-1]
+        return result
+
+    def _walk_points(self,xy,max_steps=20):
+        """
+        Sequential neighbor walk for points_to_cells.  Each walk starts from
+        the last cell found, and steps across the side which the point is
+        furthest outside of.  Points where the walk is blocked are located
+        with the index instead.  Uses python scalars, since the per-step work is
+        too small to benefit from numpy.
+        """
+        result=np.full(len(xy),-1,np.int32)
+        X=self.nodes['x']
+        cell_nodes=self.cells['nodes']
+        cell_edges=self.cells['edges']
+        edge_cells=self.edges['cells']
+        deleted=self.cells['deleted']
+
+        c_last=-1
+        for i,(px,py) in enumerate(xy.tolist()):
+            if c_last<0:
+                # no start yet, use the index for this point
+                result[i]=c_last=self.points_to_cells(xy[i:i+1])[0]
+                continue
+            c=c_last
+            for step in range(max_steps):
+                pts=X[cell_nodes[c][cell_nodes[c]>=0]].tolist()
+                best=0.0
+                s=None # side the point is furthest outside of
+                for k in range(len(pts)):
+                    ax,ay=pts[k-1]
+                    bx,by=pts[k]
+                    dx=bx-ax ; dy=by-ay
+                    L=math.sqrt(dx*dx+dy*dy)
+                    if L==0.0:
+                        continue
+                    side_dist=(dx*(py-ay) - dy*(px-ax))/L
+                    if side_dist<best:
+                        best=side_dist
+                        # side k-1 runs from node k-1 to node k
+                        s=(k-1)%len(pts)
+                if s is None: # inside all sides
+                    result[i]=c_last=c
+                    break
+                j=cell_edges[c,s]
+                if j<0:
+                    break
+                c1,c2=edge_cells[j]
+                c=c2 if c1==c else c1
+                if c<0 or deleted[c]:
+                    break
+            if result[i]<0:
+                # blocked by the boundary, or a non-convex cell.  Settle it
+                # with the index so the next walk starts nearby.
+                result[i]=self.points_to_cells(xy[i:i+1])[0]
+                if result[i]>=0:
+                    c_last=result[i]
+        return result
+
     def circum_errors(self):
         rel_errors=np.zeros(self.Ncells(),'f8')
         centers = self.cells_center()
@@ -3326,6 +3957,25 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
     def write_pickle(self,fn):
         with open(fn,'wb') as fp:
             pickle.dump(self,fp,-1)
+
+    @staticmethod
+    def from_native(fn,mmap_mode='c'):
+        """
+        Load a grid written by write_native.  By default the file is memory
+        mapped copy-on-write, so opening is fast even for large grids, and
+        processes opening the same file share the unmodified pages.
+        mmap_mode='r' gives read-only arrays, and None reads into memory.
+        """
+        return native_format.read_grid(fn,mmap_mode=mmap_mode)
+
+    def write_native(self,fn,adjacency=True,indices=False):
+        """
+        Write the grid in the versioned binary format of native_format.
+        Nodes, edges and cells are stored as-is, including extra fields.
+        adjacency: also store node to edge/cell adjacency.
+        indices: also store edge and cell bounding boxes for the element indices.
+        """
+        native_format.write_grid(self,fn,adjacency=adjacency,indices=indices)
             
     def __getstate__(self):
         # Mostly just clear out elements which can be easily recreated,
@@ -3336,6 +3986,9 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         d['_node_to_cells']=None
         d['_node_index'] = None
         d['_cell_center_index'] = None
+        d['_edge_index'] = None
+        d['_cell_index'] = None
+        d['_graph_cache'] = None
         d['log']=None
 
         return d
@@ -3728,25 +4381,22 @@ class UnstructuredGrid(Listenable,undoer.OpHistory):
         """
         assert self.max_sides>=4
 
-        node_ids=np.zeros( (nx,ny), int)-1
         xs=np.linspace(p0[0],p1[0],nx)
         ys=np.linspace(p0[1],p1[1],ny)
+        X,Y=np.meshgrid(xs,ys,indexing='ij')
 
         # create the nodes
-        for xi,x in enumerate(xs):
-            for yi,y in enumerate(ys):
-                node_ids[xi,yi] = self.add_node(x=[x,y])
-
-        cell_ids=np.zeros( (nx-1,ny-1), int)-1
-
-        # create the cells
-        for xi in range(nx-1):
-            for yi in range(ny-1):
-                nodes=[ node_ids[xi,yi],
-                        node_ids[xi+1,yi],
-                        node_ids[xi+1,yi+1],
-                        node_ids[xi,yi+1] ]
-                cell_ids[xi,yi]=self.add_cell_and_edges(nodes=nodes) 
+        node_ids=self.add_nodes(x=np.c_[X.ravel(),Y.ravel()]).reshape([nx,ny])
+
+        # create the cells, with edges numbered and oriented as
+        # add_cell_and_edges would for cells added in this order
+        cell_nodes=np.c_[ node_ids[:-1,:-1].ravel(),
+                          node_ids[1:,:-1].ravel(),
+                          node_ids[1:,1:].ravel(),
+                          node_ids[:-1,1:].ravel() ]
+        edge_nodes=topology.edges_from_cells(cell_nodes,Nnodes=self.Nnodes())[0]
+        self.add_edges(nodes=edge_nodes,_check_existing=False)
+        cell_ids=self.add_cells(nodes=cell_nodes).reshape([nx-1,ny-1])
         return {'cells':cell_ids,
                 'nodes':node_ids}
 
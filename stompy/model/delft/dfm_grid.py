@@ -308,6 +308,12 @@ class DFMGrid(unstructured_grid.UnstructuredGrid):
             print("Making cells from edges")
             self.make_cells_from_edges()
 
+        if self.Ncells() and self.Nedges():
+            # bulk topology is cheap, so set it up front rather than
+            # leaving edges['cells'] and cells['edges'] UNKNOWN.
+            self.update_cell_edges()
+            self.edge_to_cells(recalc=True)
+
         if var_depth in nc.variables: # have depth at nodes
             self.nodes['depth']=nc[var_depth].values.copy()
 
@@ -74,7 +74,9 @@ try:
 except ImportError:
     import pickle
     
-import subprocess,threading
+import subprocess,threading,itertools
+import json,hashlib,time
+from collections import OrderedDict
 import logging
 log=logging.getLogger(__name__)
 
@@ -174,6 +176,20 @@ class Field(object):
     def bounds(self):
         raise Exception("Not Implemented")
 
+    def tile_signature(self,xxyy):
+        """ JSON-able description of everything which determines this
+        field's values within xxyy, for TileMaker to tell whether a tile
+        is out of date.  None if that can't be determined.
+        """
+        return None
+
+    def tile_halo(self,dx,dy):
+        """ (x,y) number of pixels around a tile rendered at dx,dy which can
+        affect values within the tile, e.g. by filling or feathering.  For
+        TileMaker.  Pointwise fields need none.
+        """
+        return 0,0
+
     def bounds_in_cs(self,cs):
         b = self.bounds()
 
@@ -1672,6 +1688,9 @@ class ConstantField(Field):
     def value(self,X):
         X=np.asanyarray(X)
         return self.c * np.ones(X.shape[:-1])
+
+    def tile_signature(self,xxyy):
+        return ['ConstantField',self.c]
         
 
 class BinopField(Field):
@@ -2083,6 +2102,13 @@ class SimpleGrid(QuadrilateralGrid):
     def bounds(self):
         return np.array(self.extents)
 
+    def tile_signature(self,xxyy):
+        # in-memory data, so hash the part under the tile
+        min_row,max_row,min_col,max_col = self.rect_to_indexes(xxyy)
+        F = np.ascontiguousarray(self.F[min_row:max_row+1, min_col:max_col+1])
+        return ['SimpleGrid',list(self.extents),list(F.shape),
+                hashlib.md5(F.tobytes()).hexdigest()]
+
     def interpolate(self,X,interpolation=None,fallback=True):
         """ interpolation can be nearest or linear
         """
@@ -2575,6 +2601,25 @@ class SimpleGrid(QuadrilateralGrid):
         missing: the value to be assigned to parts of the tile which are not covered 
         by the source data.
         """
+        if isinstance(self.F,LazyRaster):
+            # only read the part of the raster under the tile
+            if match is not None:
+                window = match.extents
+            else:
+                window = as_xxyy(xxyy)
+            dx,dy = self.delta()
+            min_row,max_row,min_col,max_col = self.rect_to_indexes([window[0]-2*dx,window[1]+2*dx,
+                                                                    window[2]-2*dy,window[3]+2*dy])
+            # keep enough pixels for a cubic spline, even if the tile misses the raster
+            nrows,ncols = self.F.shape[:2]
+            min_row = max(0,min(min_row,nrows-4))
+            max_row = min(nrows-1,max(max_row,min_row+3))
+            min_col = max(0,min(min_col,ncols-4))
+            max_col = min(ncols-1,max(max_col,min_col+3))
+            sub = self.crop(indexes=[min_row,max_row,min_col,max_col])
+            return sub.extract_tile(xxyy=xxyy,res=res or self.dx,match=match,
+                                    interpolation=interpolation,missing=missing)
+
         if match is not None:
             xxyy = match.extents
             resx,resy = match.delta()
@@ -2736,6 +2781,335 @@ class GtxGrid(SimpleGrid):
                             F = heights,
                             projection=projection) 
 
+def file_signature(filename):
+    """ identifies a version of a file for Field.tile_signature """
+    try:
+        st=os.stat(filename)
+    except (OSError,TypeError):
+        return [filename]
+    return [os.path.abspath(filename),st.st_mtime,st.st_size]
+
+
+class RasterCache(object):
+    """ LRU cache for raster data, limited by total bytes rather than
+    by count.  One process-wide instance, raster_cache, holds the
+    grids opened by MultiRasterField, the in-memory sources and rendered
+    layers of CompositeField, and the decoded blocks of lazy GdalGrids.
+    Safe to use from several threads.
+
+    Lazy grids are charged 0 bytes, as their blocks are cached separately,
+    but each may hold an open file.  Entries added with grid=True, i.e.
+    by open_gdal_grid(), are therefore also limited in number, by max_grids.
+
+    The budget can be changed at any time, e.g.
+      field.raster_cache.max_bytes=4*2**30
+
+    Cached grids are shared, so treat them as read-only.
+    """
+    def __init__(self,max_bytes=1024*2**20,max_entries=None,max_grids=20):
+        """
+        max_bytes: total size of the cached entries
+        max_entries: optional limit on the number of entries.
+        max_grids: limit on the number of entries added with grid=True,
+          i.e. opened rasters, to bound the number of open files.  None
+          for no limit.
+        """
+        self.max_bytes=max_bytes
+        self.max_entries=max_entries
+        self.max_grids=max_grids
+        self.entries=OrderedDict() # key => (value,nbytes,grid)
+        self.nbytes=0
+        self.ngrids=0
+        self.hits=self.misses=self.evictions=0
+        self.lock=threading.Lock()
+
+    def get(self,key,load,nbytes=None,grid=False):
+        """ return the entry for key, calling load() to create it on a miss.
+        nbytes: function giving the size of the loaded value, defaults
+        to value.nbytes.
+        grid: count the entry against max_grids.
+        """
+        with self.lock:
+            entry=self.entries.pop(key,None)
+            if entry is not None:
+                self.entries[key]=entry # most recently used goes last
+                self.hits+=1
+                return entry[0]
+            self.misses+=1
+        # load outside the lock so other threads can keep going.  Two threads
+        # may load the same entry, and the second just replaces the first.
+        value=load()
+        size=nbytes(value) if nbytes is not None else value.nbytes
+        with self.lock:
+            self.remove(key)
+            self.entries[key]=(value,size,grid)
+            self.nbytes+=size
+            self.ngrids+=grid
+            self.evict()
+        return value
+
+    def remove(self,key):
+        # caller holds the lock
+        entry=self.entries.pop(key,None)
+        if entry is not None:
+            self.nbytes-=entry[1]
+            self.ngrids-=entry[2]
+        return entry
+
+    def evict(self):
+        # always keep the newest entry, even if it alone is over budget.
+        # caller holds the lock.
+        while len(self.entries)>1 and ( self.nbytes>self.max_bytes or
+                                        (self.max_entries is not None and
+                                         len(self.entries)>self.max_entries) ):
+            self.remove(next(iter(self.entries)))
+            self.evictions+=1
+        if self.max_grids is not None and self.ngrids>self.max_grids:
+            # oldest grids go first, blocks stay
+            newest=next(reversed(self.entries))
+            grid_keys=[k for k,entry in self.entries.items()
+                       if entry[2] and k!=newest]
+            for k in grid_keys[:self.ngrids-self.max_grids]:
+                self.remove(k)
+                self.evictions+=1
+
+    def discard(self,key):
+        with self.lock:
+            self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries=OrderedDict()
+            self.nbytes=0
+            self.ngrids=0
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits=self.misses=self.evictions=0
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits,misses=self.misses,evictions=self.evictions,
+                        entries=len(self.entries),nbytes=self.nbytes,
+                        grids=self.ngrids,max_bytes=self.max_bytes)
+
+raster_cache=RasterCache()
+
+
+def grid_nbytes(g):
+    """ in-memory size of a field for RasterCache, counting only its raster.
+    Lazy grids count as 0, as their blocks are cached separately.
+    """
+    F=getattr(g,'F',None)
+    if isinstance(F,np.ndarray):
+        return F.nbytes
+    return 0
+
+def open_gdal_grid(filename,lazy=False):
+    """ GdalGrid for filename via the shared raster_cache, only reading the
+    file if it is not already cached, or has changed since.
+    """
+    filename=os.path.abspath(filename)
+    return raster_cache.get( ('GdalGrid',tuple(file_signature(filename)),lazy),
+                             lambda: GdalGrid(filename,lazy=lazy),
+                             nbytes=grid_nbytes,grid=True)
+
+
+class LazyRaster(object):
+    """ Array-like view of a raster which is read one block at a time, on demand.
+
+    Indexing follows SimpleGrid conventions, with row 0 at the south, and
+    supports what SimpleGrid needs: ints, slices, and integer arrays for
+    pointwise lookups.  The result is always an in-memory ndarray.  Blocks
+    are aligned to the native block size of the file, and held in the shared
+    raster_cache.  np.asarray(lazy) reads the whole raster.
+    """
+    # strip-organized files have blocks one row tall - group several native
+    # blocks so that each cached block is at least this many pixels on a side
+    min_block=256
+
+    tokens=itertools.count()
+
+    def __init__(self,reader,file_shape,block_shape,dtype,
+                 window=None,flip=False,nodata=None,int_nan=-9999,
+                 bands=(),key=None,cache=None):
+        """
+        reader: function(xoff,yoff,xsize,ysize) returning an array
+          [rows,cols,...] of the file, in file order.
+        file_shape: (rows,cols) of the whole file.
+        block_shape: (rows,cols) of a native block of the file.
+        window: (row offset,col offset,rows,cols) of the part of the file
+          exposed by this raster.  Defaults to the whole file.
+        flip: if True, row 0 of this raster is the last row of the window.
+        nodata: value mapped to nan, int_nan for signed ints, or 0 for unsigned ints.
+        bands: any trailing dimensions of what reader returns
+        key: hashable, identifies the file in the cache, so that rasters on
+          the same file can share blocks.  Defaults to a token unique to this
+          object.  Must change if the file does, see file_signature().
+        """
+        self.reader=reader
+        self.file_shape=tuple(file_shape)
+        by,bx=block_shape
+        by=by*int(np.ceil(float(self.min_block)/by))
+        bx=bx*int(np.ceil(float(self.min_block)/bx))
+        self.block_shape=(min(by,self.file_shape[0]),min(bx,self.file_shape[1]))
+        self.dtype=np.dtype(dtype)
+        if window is None:
+            window=(0,0)+self.file_shape
+        self.window=tuple(window)
+        self.flip=flip
+        self.nodata=nodata
+        self.int_nan=int_nan
+        self.bands=tuple(bands)
+        # not id(self), which is reused once this raster is freed while
+        # its blocks are still cached
+        self.key=key if key is not None else ('LazyRaster',next(LazyRaster.tokens))
+        self.cache=cache if cache is not None else raster_cache
+        # GDAL datasets are not safe to read from several threads at once
+        self.read_lock=threading.Lock()
+
+    @property
+    def shape(self):
+        return self.window[2:]+self.bands
+    @property
+    def ndim(self):
+        return len(self.shape)
+    def __len__(self):
+        return self.shape[0]
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape))*self.dtype.itemsize
+
+    def __array__(self,dtype=None):
+        A=self[:,:]
+        if dtype is not None:
+            A=A.astype(dtype)
+        return A
+    def copy(self):
+        return np.asarray(self)
+
+    def block(self,bi,bj):
+        """ the decoded block at block row bi, block col bj of the file """
+        def load():
+            by,bx=self.block_shape
+            yoff=bi*by ; xoff=bj*bx
+            with self.read_lock:
+                A=self.reader(xoff,yoff,
+                              min(bx,self.file_shape[1]-xoff),
+                              min(by,self.file_shape[0]-yoff))
+            A=np.array(A,dtype=self.dtype)
+            if self.nodata is not None:
+                if A.dtype in (np.int16,np.int32):
+                    A[ A==self.nodata ] = self.int_nan
+                elif A.dtype in (np.uint16,np.uint32):
+                    A[ A==self.nodata ] = 0 # not great...
+                else:
+                    A[ A==self.nodata ] = np.nan
+            return A
+        return self.cache.get( ('block',self.key,self.int_nan,bi,bj), load)
+
+    def file_rows(self,rows):
+        """ map rows of this raster to rows of the file """
+        if self.flip:
+            rows=self.window[2]-1-rows
+        return rows+self.window[0]
+
+    def read_window(self,r0,r1,c0,c1):
+        """ rows [r0,r1) and cols [c0,c1) of this raster as an ndarray """
+        if self.flip:
+            fr0=self.file_rows(r1-1)
+        else:
+            fr0=self.file_rows(r0)
+        fr1=fr0+(r1-r0)
+        fc0=c0+self.window[1] ; fc1=c1+self.window[1]
+        by,bx=self.block_shape
+
+        out=np.empty( (r1-r0,c1-c0)+self.bands, self.dtype)
+        for bi in range(fr0//by,(fr1-1)//by+1):
+            ra=max(fr0,bi*by) ; rb=min(fr1,(bi+1)*by)
+            for bj in range(fc0//bx,(fc1-1)//bx+1):
+                ca=max(fc0,bj*bx) ; cb=min(fc1,(bj+1)*bx)
+                blk=self.block(bi,bj)
+                out[ra-fr0:rb-fr0,ca-fc0:cb-fc0]=blk[ra-bi*by:rb-bi*by,ca-bj*bx:cb-bj*bx]
+        if self.flip:
+            out=out[::-1]
+        return out
+
+    def read_points(self,rows,cols):
+        """ pointwise lookup, rows and cols integer arrays of the same shape """
+        fr=self.file_rows(rows).ravel()
+        fc=(cols+self.window[1]).ravel()
+        by,bx=self.block_shape
+        nbx=(self.file_shape[1]+bx-1)//bx
+        blocks=(fr//by)*nbx + fc//bx
+
+        out=np.empty( (len(fr),)+self.bands, self.dtype)
+        order=np.argsort(blocks,kind='mergesort')
+        breaks=np.nonzero(np.diff(blocks[order]))[0]+1
+        for sel in np.split(order,breaks):
+            if len(sel)==0:
+                continue
+            bi,bj=divmod(blocks[sel[0]],nbx)
+            blk=self.block(bi,bj)
+            out[sel]=blk[fr[sel]-bi*by,fc[sel]-bj*bx]
+        return out.reshape(rows.shape+self.bands)
+
+    def __getitem__(self,idx):
+        if not isinstance(idx,tuple):
+            idx=(idx,)
+        extra=idx[2:]
+        idx=idx[:2]+(slice(None),)*(2-len(idx))
+
+        if any(isinstance(i,(np.ndarray,list)) for i in idx):
+            sub=[]
+            for i,n in zip(idx,self.window[2:]):
+                if isinstance(i,slice):
+                    i=np.arange(*i.indices(n))
+                i=np.asarray(i)
+                if i.dtype.kind not in 'iu':
+                    raise IndexError("Lazy rasters only support integer array indices")
+                i=np.where(i<0,i+n,i)
+                if np.any( (i<0) | (i>=n) ):
+                    raise IndexError("index out of bounds for axis with size %d"%n)
+                sub.append(i)
+            rows,cols=sub
+            # match numpy when a slice is combined with an array
+            if isinstance(idx[1],slice):
+                rows=rows[...,None]
+            elif isinstance(idx[0],slice):
+                rows=rows.reshape( rows.shape+(1,)*cols.ndim )
+            rows,cols=np.broadcast_arrays(rows,cols)
+            result=self.read_points(rows,cols)
+        else:
+            sub=[] ; squeeze=[]
+            for i,n in zip(idx,self.window[2:]):
+                if isinstance(i,slice):
+                    sub.append( np.arange(*i.indices(n)) )
+                    squeeze.append(slice(None))
+                else:
+                    i=int(i)
+                    if i<0:
+                        i+=n
+                    if not 0<=i<n:
+                        raise IndexError("index %d out of bounds for axis with size %d"%(i,n))
+                    sub.append( np.array([i]) )
+                    squeeze.append(0)
+            rows,cols=sub
+            if len(rows)==0 or len(cols)==0:
+                result=np.zeros( (len(rows),len(cols))+self.bands, self.dtype)
+            else:
+                r0=rows.min() ; c0=cols.min()
+                result=self.read_window(r0,rows.max()+1,c0,cols.max()+1)
+                if len(rows)!=result.shape[0] or rows[0]!=r0:
+                    result=result[rows-r0]
+                if len(cols)!=result.shape[1] or cols[0]!=c0:
+                    result=result[:,cols-c0]
+            result=result[tuple(squeeze)]
+        if extra:
+            result=result[(Ellipsis,)+extra]
+        return result
+
+
 class GdalGrid(SimpleGrid):
     @staticmethod
     def metadata(filename):
@@ -2757,18 +3131,23 @@ class GdalGrid(SimpleGrid):
         
         return [xmin,xmax,ymin,ymax],[dx,dy]
 
-    def __init__(self,filename,bounds=None,geo_bounds=None):
+    def __init__(self,filename,bounds=None,geo_bounds=None,lazy=False):
         """ Load a raster dataset into memory.
         bounds: [x-index start, x-index end, y-index start, y-index end]
          will load a subset of the raster.
 
         filename: path to a GDAL-recognize file, or an already opened GDAL dataset.
         geo_bounds: xxyy bounds in geographic coordinates 
+        lazy: if True, nothing is read up front.  self.F is a LazyRaster,
+         which reads blocks as they are needed and keeps them in the shared
+         raster_cache.
         """
         if isinstance(filename,gdal.Dataset):
             self.gds=filename
+            self.filename=self.gds.GetDescription()
         else:
             self.gds = gdal.Open(filename)
+            self.filename=filename
         (x0, dx, r1, y0, r2, dy ) = self.gds.GetGeoTransform()
 
         if geo_bounds is not None:
@@ -2798,8 +3177,14 @@ class GdalGrid(SimpleGrid):
             self.geo_bounds = geo_bounds
             
         self.subset_bounds = bounds
-        
-        if bounds:
+        self.lazy = lazy
+
+        if lazy:
+            A = self.lazy_raster(filename,bounds,dy<0)
+            if bounds:
+                x0 += bounds[0]*dx
+                y0 += bounds[2]*dy
+        elif bounds:
             A = self.gds.ReadAsArray(xoff = bounds[0],yoff=bounds[2],
                                      xsize = bounds[1] - bounds[0],
                                      ysize = bounds[3] - bounds[2])
@@ -2811,8 +3196,8 @@ class GdalGrid(SimpleGrid):
 
         # A is rows/cols !
         # And starts off with multiple channels, if they exist, as the
-        # first index.
-        if A.ndim == 3:
+        # first index.  LazyRaster already puts them last.
+        if A.ndim == 3 and not lazy:
             print("Putting multiple channels as last index")
             A = A.transpose(1,2,0)
 
@@ -2829,13 +3214,14 @@ class GdalGrid(SimpleGrid):
             dy = -dy
             # this used to have the extra indices at the start, 
             # but I think that's wrong, as we put extra channels at the end
-            A = A[::-1,:,...]
+            if not lazy: # LazyRaster handles the flip
+                A = A[::-1,:,...]
 
         # and there might be a nodata value, which we want to map to NaN
         b = self.gds.GetRasterBand(1)
         nodata = b.GetNoDataValue()
 
-        if nodata is not None:
+        if nodata is not None and not lazy:
             if A.dtype in (np.int16,np.int32):
                 A[ A==nodata ] = self.int_nan
             elif A.dtype in (np.uint16,np.uint32):
@@ -2851,6 +3237,45 @@ class GdalGrid(SimpleGrid):
                             F=A,
                             projection=self.gds.GetProjection() )
 
+    def tile_signature(self,xxyy):
+        return ['GdalGrid',file_signature(self.filename),self.subset_bounds]
+
+    def lazy_raster(self,filename,bounds,flip):
+        """ LazyRaster reading from self.gds, limited to bounds if given
+        """
+        gds=self.gds
+        nx=gds.RasterXSize
+        ny=gds.RasterYSize
+        if bounds:
+            window=(bounds[2],bounds[0],bounds[3]-bounds[2],bounds[1]-bounds[0])
+        else:
+            window=(0,0,ny,nx)
+
+        band=gds.GetRasterBand(1)
+        bx,by=band.GetBlockSize()
+        sample=gds.ReadAsArray(0,0,1,1)
+
+        if gds.RasterCount>1:
+            bands=(gds.RasterCount,)
+            def reader(xoff,yoff,xsize,ysize):
+                # multiple channels go last, as in the non-lazy case
+                return gds.ReadAsArray(xoff,yoff,xsize,ysize).transpose(1,2,0)
+        else:
+            bands=()
+            def reader(xoff,yoff,xsize,ysize):
+                return band.ReadAsArray(xoff,yoff,xsize,ysize)
+
+        # blocks can be shared between grids opened on the same version
+        # of the same file
+        if isinstance(filename,gdal.Dataset):
+            key=None
+        else:
+            key=tuple(file_signature(filename))
+        return LazyRaster(reader,file_shape=(ny,nx),block_shape=(by,bx),
+                          dtype=sample.dtype,window=window,flip=flip,
+                          nodata=band.GetNoDataValue(),int_nan=self.int_nan,
+                          bands=bands,key=key)
+
 if ogr:
     from stompy.spatial import interp_coverage
     class BlenderField(Field):
@@ -3132,7 +3557,11 @@ class CompositeField(Field):
 
         self.factory = factory
 
-        self.delegate_list=[None]*len(self.sources)
+        # identifies this field's sources in raster_cache
+        self.cache_token=next(CompositeField.cache_tokens)
+        # i => (signature hash, field) for sources which are not held
+        # in raster_cache, see load_source()
+        self.delegates={}
 
         self.src_priority=self.sources[priority_field]
         self.priorities=np.unique(self.src_priority)
@@ -3140,13 +3569,109 @@ class CompositeField(Field):
     def bounds(self):
         raise Exception("For now, you have to specify the bounds when gridding a BlenderField")
 
+    def __getstate__(self):
+        d=dict(self.__dict__)
+        d['delegates']={} # may hold open files, reloaded on demand
+        return d
+
+    cache_tokens=itertools.count()
     def load_source(self,i):
-        if self.delegate_list[i] is None:
-            self.delegate_list[i] = self.factory( self.sources[i] )
-        return self.delegate_list[i]
+        """ The field for source i, from the factory, loaded again if the
+        source's attributes change.  In-memory rasters are held in the
+        shared raster_cache, so large ones may be evicted and loaded again
+        later.  Anything else, e.g. constant fields or lazy GdalGrids, costs
+        nothing to hold and is kept by this field.
+        """
+        sig=json.dumps(self.source_signature(i),sort_keys=True,default=str)
+        sig=hashlib.md5(sig.encode()).hexdigest()
+        held=self.delegates.get(i)
+        if held is not None and held[0]==sig:
+            return held[1]
+        key=('CompositeField',self.cache_token,i,sig)
+        src=raster_cache.get( key, lambda: self.factory( self.sources[i] ),
+                              nbytes=grid_nbytes )
+        if grid_nbytes(src)==0:
+            raster_cache.discard(key)
+            self.delegates[i]=(sig,src)
+        else:
+            self.delegates.pop(i,None)
+        return src
+
+    def relevant_sources(self,bounds):
+        """ indices of sources with non-negative priority which overlap the
+        xxyy bounds, lowest priority first.
+        """
+        box=geometry.box(bounds[0],bounds[2],bounds[1],bounds[3])
+        relevant_srcs=np.nonzero( [ box.intersects(geom)  
+                                    for geom in self.sources['geom'] ])[0]
+        # omit negative priorities
+        relevant_srcs=relevant_srcs[ self.src_priority[relevant_srcs]>=0 ]
+
+        # Starts with lowest, goes to highest
+        order = np.argsort(self.src_priority[relevant_srcs])
+        return relevant_srcs[order]
+
+    def source_signature(self,i):
+        """ describes source i: its attributes, with the geometry as a hash
+        of its WKB, and attributes naming existing files by modification time.
+        Assumes that the factory's result depends only on these.
+        """
+        sig=[self.data_mode[i],self.alpha_mode[i]]
+        for name in self.sources.dtype.names:
+            value=self.sources[name][i]
+            if name=='geom':
+                value=hashlib.md5(value.wkb).hexdigest()
+            elif isinstance(value,str) and os.path.exists(value):
+                value=file_signature(value)
+            elif isinstance(value,np.generic):
+                value=value.item()
+            sig.append( [name,value] )
+        return sig
+
+    def tile_signature(self,xxyy):
+        return ['CompositeField']+[self.source_signature(i)
+                                   for i in self.relevant_sources(xxyy)]
+
+    def tile_halo(self,dx,dy):
+        """ the furthest reach of any fill() or feather() in the sources'
+        modes, in pixels, mirroring render_layer_uncached.  Raises a
+        ValueError for modes it doesn't know.
+        """
+        reach=[0]
+        def fill(dist):
+            reach[0]=max(reach[0], max( int(round(float(dist)/dx))//3, 2 ))
+        def feather(dist):
+            reach[0]=max(reach[0], int(round(float(dist)/dx)))
+        def none():
+            pass
+        ops=dict(fill=fill,feather=feather,
+                 min=none,max=none,overlay=none,valid=none)
+
+        for i in np.nonzero(self.src_priority>=0)[0]:
+            for mode in [self.data_mode[i],self.alpha_mode[i]]:
+                try:
+                    eval(mode,{},ops)
+                except NameError as exc:
+                    raise ValueError("Can't tell how far mode %r reaches (%s), set TileMaker.halo"%(mode,exc))
+        # fill and feather work in whole pixels in both directions
+        return reach[0],reach[0]
+
+    # Rendered layers can be cached by the signature of their source and the
+    # tile, so editing one source only re-renders that layer.  They are held
+    # in raster_cache, and if layer_cache_dir is set, also saved there so
+    # that later runs can reuse them.
+    # Off by default: the signature only covers the source's attributes and
+    # any files they name, so this assumes the factory's result depends on
+    # nothing else.  A factory which reads in-memory data, other state, or
+    # code which changes between runs will get stale layers.  Change
+    # layer_cache_version when the factory changes to invalidate saved layers.
+    cache_layers=False
+    layer_cache_dir=None
+    layer_cache_version=None
 
     def to_grid(self,nx=None,ny=None,bounds=None,dx=None,dy=None):
         """ render the layers to a SimpleGrid tile.
+        bounds: [xmin,xmax,ymin,ymax], or [[xmin,ymin],[xmax,ymax]]
         """
         # boil the arguments down to dimensions
         if bounds is None:
@@ -3157,9 +3682,13 @@ class CompositeField(Field):
                 xmax,ymax = bounds[1]
             else:
                 xmin,xmax,ymin,ymax = bounds
+        bounds=[xmin,xmax,ymin,ymax]
         if nx is None:
             nx=1+int(np.round((xmax-xmin)/dx))
             ny=1+int(np.round((ymax-ymin)/dy))
+        if dx is None:
+            dx=(xmax-xmin)/(nx-1.0)
+            dy=(ymax-ymin)/(ny-1.0)
 
         # allocate the blank starting canvas
         result_F =np.ones((ny,nx),'f8')
@@ -3169,99 +3698,141 @@ class CompositeField(Field):
         result_alpha.F[:]=0.0
 
         # Which sources to use, and in what order?
-        box=geometry.box(bounds[0],bounds[2],bounds[1],bounds[3])
-
-        # Which sources are relevant?
-        relevant_srcs=np.nonzero( [ box.intersects(geom)  
-                                    for geom in self.sources['geom'] ])[0]
-        # omit negative priorities
-        relevant_srcs=relevant_srcs[ self.src_priority[relevant_srcs]>=0 ]
-
-        # Starts with lowest, goes to highest
-        order = np.argsort(self.src_priority[relevant_srcs])
-        ordered_srcs=relevant_srcs[order]
-
-        for src_i in ordered_srcs:
+        for src_i in self.relevant_sources(bounds):
             log.info(self.sources['src_name'][src_i])
             log.info("   data mode: %s  alpha mode: %s"%(self.data_mode[src_i],
                                                          self.alpha_mode[src_i]))
-                  
-            source=self.load_source(src_i)
-            src_data = source.to_grid(bounds=bounds,dx=dx,dy=dy)
-            src_alpha= SimpleGrid(extents=src_data.extents,
-                                  F=np.ones(src_data.F.shape,'f8'))
-
-            if 0: # slower
-                src_alpha.mask_outside(self.sources['geom'][src_i],value=0.0)
-            else: 
-                mask=src_alpha.polygon_mask(self.sources['geom'][src_i])
-                src_alpha.F[~mask] = 0.0
-
-            # create an alpha tile. depending on alpha_mode, this may draw on the lower data,
-            # the polygon and/or the data tile.
-            # modify the data tile according to the data mode - so if the data mode is 
-            # overlay, do nothing.  but if it's max, the resulting data tile is the max
-            # of itself and the lower data.
-            # composite the data tile, using its alpha to blend with lower data.
-
-            # the various operations
-            def min():
-                """ new data will only decrease values
-                """
-                valid=result_alpha.F>0
-                src_data.F[valid]=np.minimum( src_data.F[valid],result_data.F[valid] )
-            def max():
-                """ new data will only increase values
-                """
+
+            src_data,src_alpha,combine=self.render_layer(src_i,bounds,dx,dy,nx,ny)
+
+            # modes which depend on the lower data are applied here, since
+            # they can't be cached with the layer.
+            if combine is not None:
                 valid=result_alpha.F>0
-                src_data.F[valid]=np.maximum( src_data.F[valid],result_data.F[valid] )
-            def fill(dist):
-                "fill in small missing areas"
-                pixels=int(round(float(dist)/dx))
-                niters=np.maximum( pixels//3, 2 )
-                src_data.fill_by_convolution(iterations=niters)
-            # def blur(dist):
-            #     "smooth data channel with gaussian filter - this allows spreading beyond original poly!"
-            #     pixels=int(round(float(dist)/dx))
-            #     src_data.F=ndimage.gaussian_filter(src_alpha.F,pixels)
-                
-            def overlay():
-                pass 
-            # alpha channel operations:
-            def valid():
-                # updates alpha channel to be zero where source data is missing.
-                data_missing=np.isnan(src_data.F)
-                src_alpha.F[data_missing]=0.0
-            # def blur_alpha(dist):
-            #     "smooth alpha channel with gaussian filter - this allows spreading beyond original poly!"
-            #     pixels=int(round(float(dist)/dx))
-            #     src_alpha.F=ndimage.gaussian_filter(src_alpha.F,pixels)
-            def feather(dist):
-                "linear feathering within original poly"
-                pixels=int(round(float(dist)/dx))
-                Fsoft=ndimage.distance_transform_bf(src_alpha.F)
-                src_alpha.F = (Fsoft/pixels).clip(0,1)
-
-            # dangerous! executing code from a shapefile!
-            eval(self.data_mode[src_i])
-            eval(self.alpha_mode[src_i])
+                op={'min':np.minimum,'max':np.maximum}[combine]
+                src_data=src_data.copy()
+                src_data[valid]=op( src_data[valid],result_data.F[valid] )
 
-            data_missing=np.isnan(src_data.F)
-            src_alpha.F[data_missing]=0.0
-            cleaned=src_data.F.copy()
-            cleaned[data_missing]=-999 # avoid nan contamination.
+            cleaned=np.where(np.isnan(src_data),-999,src_data) # avoid nan contamination.
 
-            assert np.allclose( result_data.extents, src_data.extents )
-            assert np.all( result_data.F.shape==src_data.F.shape )
+            assert np.all( result_data.F.shape==src_data.shape )
             # before getting into fancy modes, just stack it all up:
-            result_data.F   = result_data.F *(1-src_alpha.F) + cleaned*src_alpha.F
-            result_alpha.F  = result_alpha.F*(1-src_alpha.F) + src_alpha.F
+            result_data.F   = result_data.F *(1-src_alpha) + cleaned*src_alpha
+            result_alpha.F  = result_alpha.F*(1-src_alpha) + src_alpha
 
         # fudge it a bit, and allow semi-transparent data back out, but 
         # at least nan out the totally transparent stuff.
         result_data.F[ result_alpha.F==0 ] = np.nan
         return result_data
 
+    def layer_key(self,src_i,bounds,nx,ny):
+        text=json.dumps( [self.layer_cache_version,self.source_signature(src_i),
+                          list(bounds),nx,ny],
+                         sort_keys=True, default=str )
+        return hashlib.md5(text.encode()).hexdigest()
+
+    def render_layer(self,src_i,bounds,dx,dy,nx,ny):
+        """ Render source src_i on its own, returning (data,alpha,combine).
+        data and alpha are [ny,nx] arrays, with alpha already 0 where data
+        is nan.  combine is None, or 'min' / 'max' for data modes which 
+        are applied against the lower layers.  Cached results are shared,
+        so don't modify the arrays.
+        """
+        if not self.cache_layers:
+            return self.render_layer_uncached(src_i,bounds,dx,dy)
+
+        key=self.layer_key(src_i,bounds,nx,ny)
+        if self.layer_cache_dir is not None:
+            cache_fn=os.path.join(self.layer_cache_dir,key+'.npz')
+        else:
+            cache_fn=None
+
+        def load():
+            if cache_fn is not None and os.path.exists(cache_fn):
+                saved=np.load(cache_fn)
+                return (saved['data'],saved['alpha'],str(saved['combine']) or None)
+            layer=self.render_layer_uncached(src_i,bounds,dx,dy)
+            if cache_fn is not None:
+                if not os.path.exists(self.layer_cache_dir):
+                    os.makedirs(self.layer_cache_dir)
+                # np.savez adds .npz to names without it
+                tmp_fn=cache_fn[:-4]+'-tmp%d.npz'%os.getpid()
+                np.savez(tmp_fn,data=layer[0],alpha=layer[1],combine=layer[2] or '')
+                os.rename(tmp_fn,cache_fn)
+            return layer
+        # in memory, layers are specific to this field and its factory
+        return raster_cache.get( ('CompositeField layer',self.cache_token,key), load,
+                                 nbytes=lambda layer: layer[0].nbytes+layer[1].nbytes )
+
+    def render_layer_uncached(self,src_i,bounds,dx,dy):
+        source=self.load_source(src_i)
+        src_data = source.to_grid(bounds=bounds,dx=dx,dy=dy)
+        src_alpha= SimpleGrid(extents=src_data.extents,
+                              F=np.ones(src_data.F.shape,'f8'))
+
+        if 0: # slower
+            src_alpha.mask_outside(self.sources['geom'][src_i],value=0.0)
+        else: 
+            mask=src_alpha.polygon_mask(self.sources['geom'][src_i])
+            src_alpha.F[~mask] = 0.0
+
+        # create an alpha tile. depending on alpha_mode, this may draw on the lower data,
+        # the polygon and/or the data tile.
+        # modify the data tile according to the data mode - so if the data mode is 
+        # overlay, do nothing.  but if it's max, the resulting data tile is the max
+        # of itself and the lower data.
+        # composite the data tile, using its alpha to blend with lower data.
+        combine=[None]
+
+        # the various operations
+        def min():
+            """ new data will only decrease values
+            """
+            combine[0]='min'
+        def max():
+            """ new data will only increase values
+            """
+            combine[0]='max'
+        def fill(dist):
+            "fill in small missing areas"
+            pixels=int(round(float(dist)/dx))
+            niters=np.maximum( pixels//3, 2 )
+            src_data.fill_by_convolution(iterations=niters)
+        # def blur(dist):
+        #     "smooth data channel with gaussian filter - this allows spreading beyond original poly!"
+        #     pixels=int(round(float(dist)/dx))
+        #     src_data.F=ndimage.gaussian_filter(src_alpha.F,pixels)
+
+        def overlay():
+            pass 
+        # alpha channel operations:
+        def valid():
+            # updates alpha channel to be zero where source data is missing.
+            data_missing=np.isnan(src_data.F)
+            src_alpha.F[data_missing]=0.0
+        # def blur_alpha(dist):
+        #     "smooth alpha channel with gaussian filter - this allows spreading beyond original poly!"
+        #     pixels=int(round(float(dist)/dx))
+        #     src_alpha.F=ndimage.gaussian_filter(src_alpha.F,pixels)
+        def feather(dist):
+            "linear feathering within original poly"
+            pixels=int(round(float(dist)/dx))
+            # exact euclidean distance, same as distance_transform_bf but linear time
+            Fsoft=ndimage.distance_transform_edt(src_alpha.F)
+            src_alpha.F = (Fsoft/pixels).clip(0,1)
+
+        # dangerous! executing code from a shapefile!
+        eval(self.data_mode[src_i])
+        eval(self.alpha_mode[src_i])
+
+        # min/max don't change which data are missing, so this can be done
+        # before combining with lower layers
+        data_missing=np.isnan(src_data.F)
+        src_alpha.F[data_missing]=0.0
+
+        assert np.allclose( bounds, src_data.extents )
+        return src_data.F,src_alpha.F,combine[0]
+
 
             
 class MultiRasterField(Field):
@@ -3281,9 +3852,9 @@ class MultiRasterField(Field):
 
     Cell/region queries will have to wait for another day
 
-    Some effort is made to keep only the most-recently used rasters in memory, since it is not feasible
-    to load all rasters at one time. to this end, it is most efficient for successive queries to have some
-    spatial locality.
+    Rasters are opened through the shared raster_cache, which keeps the most-recently used rasters
+    in memory up to its byte budget, since it is not feasible to load all rasters at one time. to this
+    end, it is most efficient for successive queries to have some spatial locality.
     """
 
     # If finite, any point sample greater than this value will be clamped to this value
@@ -3301,6 +3872,10 @@ class MultiRasterField(Field):
     # all: raise an exception if all patterns come up empty
     # False: silently proceed with no matches. 
     error_on_null_input='any' # 'all', or False
+
+    # If True, sources are opened as lazy GdalGrids, and only the blocks
+    # which are queried are read, held in the shared field.raster_cache.
+    lazy = False
     
     def __init__(self,raster_file_patterns,**kwargs):
         self.__dict__.update(kwargs)
@@ -3336,8 +3911,7 @@ class MultiRasterField(Field):
                                   ('resolution','f8'),
                                   ('resx','f8'),
                                   ('resy','f8'),
-                                  ('order','f8'),
-                                  ('last_used','i4') ] )
+                                  ('order','f8') ] )
 
         for fi,f in enumerate(self.raster_files):
             extent,resolution = GdalGrid.metadata(f)
@@ -3348,15 +3922,15 @@ class MultiRasterField(Field):
             sources['order'][fi] = 0.0
             sources['field'][fi]=None
             sources['filename'][fi]=f
-            sources['last_used'][fi]=-1
         
         self.sources = sources
-        # -1 means the source isn't loaded.  non-negative means it was last used when serial
-        # was that value.  overflow danger...
+        # 'field' is only set for sources supplied directly.  Otherwise they
+        # are opened through raster_cache.
 
         self.build_index()
 
     def build_index(self):
+        from rtree.index import Rtree
         # Build a basic index that will return the overlapping dataset for a given point
         # these are x,x,y,y
         tuples = [(i,extent,None) 
@@ -3375,29 +3949,23 @@ class MultiRasterField(Field):
                                          rec['resolution'],
                                          rec['filename']))
 
+    def tile_signature(self,xxyy):
+        sig = ['MultiRasterField',self.clip_max,self.offset,self.order]
+        for i in self.ordered_hits(xxyy):
+            if self.sources['field'][i] is not None:
+                sig.append( self.sources['field'][i].tile_signature(xxyy) )
+            else:
+                sig.append( file_signature(self.sources['filename'][i]) )
+        return sig
+
+    # number of sources held open at once by interpolate_groups
     max_count = 20 
-    open_count = 0
-    serial = 0
     def source(self,i):
-        """ LRU based cache of the datasets
+        """ The field for source i, opened through the shared raster_cache
         """
-        if self.sources['field'][i] is None:
-            if self.open_count >= self.max_count:
-                # Have to choose someone to close.
-                current = np.nonzero(self.sources['last_used']>=0)[0]
-                
-                victim = current[ np.argmin( self.sources['last_used'][current] ) ]
-                # print "Will evict source %d"%victim
-                self.sources['last_used'][victim] = -1
-                self.sources['field'][victim] = None
-                self.open_count -= 1
-            # open the new guy:
-            self.sources['field'][i] = GdalGrid(self.sources['filename'][i])
-            self.open_count += 1
-            
-        self.serial += 1
-        self.sources['last_used'][i] = self.serial
-        return self.sources['field'][i]
+        if self.sources['field'][i] is not None:
+            return self.sources['field'][i]
+        return open_gdal_grid(self.sources['filename'][i],lazy=self.lazy)
         
     def value_on_point(self,xy):
         hits=self.ordered_hits(xy[xxyy])
@@ -3420,21 +3988,63 @@ class MultiRasterField(Field):
         print("Bad sample at point ",xy)
         return v
             
+    # threads for interpolating from independent sources in value().
+    # None for one per cpu, 1 to stay in the calling thread.
+    threads = None
+
     def value(self,X):
         """ X must be shaped (...,2)
+
+        Points are grouped by the highest priority source covering them,
+        and each group is interpolated in one call.  Points which come
+        back nan fall through to their next source, until all sources
+        covering them have been tried.  Same results as value_on_point().
         """
-        X = np.array(X)
+        X = np.array(X,np.float64)
         orig_shape = X.shape
 
         X = X.reshape((-1,2))
 
-        newF = np.zeros( X.shape[0],np.float64 )
-        
-        for i in range(X.shape[0]):
-            if i > 0 and i % 2000 == 0:
-                print("%d/%d"%(i,X.shape[0]))
-            newF[i] = self.value_on_point( X[i] )
-        
+        newF = np.nan*np.ones( X.shape[0],np.float64 )
+
+        # rank of each source in the order used by ordered_hits()
+        priority = self.priority()
+        rank = np.zeros(len(priority),np.int32)
+        rank[priority] = np.arange(len(priority))
+        extents = self.sources['extent']
+
+        pending = np.arange(X.shape[0])
+        # only sources with at least this rank are left for each point
+        min_rank = np.zeros(X.shape[0],np.int32)
+
+        while len(pending):
+            # best remaining source covering each pending point
+            choice = -np.ones(len(pending),np.int32)
+            Xp = X[pending]
+            for src_i in priority[::-1]:
+                xmin,xmax,ymin,ymax = extents[src_i]
+                sel = ( (Xp[:,0]>=xmin) & (Xp[:,0]<=xmax) &
+                        (Xp[:,1]>=ymin) & (Xp[:,1]<=ymax) &
+                        (min_rank[pending]<=rank[src_i]) )
+                choice[sel] = src_i
+            pending = pending[choice>=0]
+            choice = choice[choice>=0]
+            if len(pending)==0:
+                break
+
+            groups = [ (src_i,pending[choice==src_i])
+                       for src_i in np.unique(choice) ]
+            for src_i,idxs in groups:
+                min_rank[idxs] = rank[src_i]+1
+            self.interpolate_groups(X,newF,groups)
+            pending = pending[ np.isnan(newF[pending]) ]
+
+        newF = np.minimum(newF,self.clip_max) # nan passes through
+
+        n_bad = np.isnan(newF).sum()
+        if n_bad:
+            print("Bad sample at %d of %d points"%(n_bad,len(newF)))
+
         newF = newF.reshape(orig_shape[:-1])
         
         if newF.ndim == 0:
@@ -3442,6 +4052,36 @@ class MultiRasterField(Field):
         else:
             return newF
 
+    def interpolate_groups(self,X,F,groups):
+        """
+        groups: list of (source index, point indices).  Fills in
+        F[idxs] from each source, with up to self.threads sources at once.
+        At most max_count sources are held for each batch.
+        """
+        threads = self.threads
+        if threads is None:
+            import multiprocessing
+            threads = multiprocessing.cpu_count()
+        for start in range(0,len(groups),self.max_count):
+            batch = groups[start:start+self.max_count]
+            # hold references so the batch survives eviction from raster_cache
+            srcs = [self.source(src_i) for src_i,idxs in batch]
+
+            def interp(job):
+                src,(src_i,idxs) = job
+                return src.interpolate( X[idxs], interpolation='linear' )
+
+            jobs = list(zip(srcs,batch))
+            if threads>1 and len(jobs)>1:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=min(threads,len(jobs))) as pool:
+                    results = list(pool.map(interp,jobs))
+            else:
+                results = [interp(job) for job in jobs]
+
+            for (src_i,idxs),vals in zip(batch,results):
+                F[idxs] = vals
+
     def value_on_edge(self,e,samples=None):
         """
         Subsample the edge, using an interval based on the highest resolution overlapping
@@ -3491,9 +4131,17 @@ class MultiRasterField(Field):
 
         if len(hits) == 0:
             return []
-        
-        hits = hits[ np.argsort( self.sources[hits], order=('order','resolution')) ]
-        return hits
+        # rtree returns hits in its own order; sort so that ties in
+        # priority fall back to source index, as in value()
+        hits = np.sort(hits)
+        return hits[ self.priority(hits) ]
+
+    def priority(self,hits=None):
+        """ order of the given source indices (default all) by
+        ('order','resolution'), ties by index.  Returns indices into hits.
+        """
+        srcs = self.sources if hits is None else self.sources[hits]
+        return np.lexsort( (srcs['resolution'],srcs['order']) )
 
     def extract_tile(self,xxyy=None,res=None):
         """ Create the requested tile from merging the sources.  Resolution defaults to
@@ -3565,9 +4213,20 @@ class MultiRasterField(Field):
             dec_x = dec_x[ col_slice ]
             dec_y = dec_y[ row_slice ]
 
+            srcF = src.F
+            if isinstance(srcF,LazyRaster):
+                # read just the window under the tile, with a margin for the spline
+                pad = 2 + self.order
+                r0 = max(0,int(np.floor(dec_y.min()))-pad)
+                c0 = max(0,int(np.floor(dec_x.min()))-pad)
+                srcF = srcF[r0:int(np.ceil(dec_y.max()))+pad+1,
+                            c0:int(np.ceil(dec_x.max()))+pad+1]
+                dec_y = dec_y - r0
+                dec_x = dec_x - c0
+
             C,R = np.meshgrid( dec_x,dec_y )
 
-            newF = ndimage.map_coordinates(src.F, [R,C],order=self.order)
+            newF = ndimage.map_coordinates(srcF, [R,C],order=self.order)
 
             # only update missing values
             missing = np.isnan(target.F[ row_slice,col_slice ])
@@ -3589,6 +4248,16 @@ class FunctionField(Field):
 class TileMaker(object):
     """ Given a field, create gridded tiles of the field, including some options for blending, filling,
     cropping, etc.
+
+    Tiles can be rendered in a pool of processes, and each one is rendered
+    with a halo around it which is cropped off before writing, so that
+    filling and smoothing match across tile boundaries.
+
+    Completed tiles are recorded in a manifest in output_dir, along with a
+    checksum of the inputs to each tile from the field's tile_signature().
+    Calling tile() again skips tiles whose inputs have not changed, so after
+    one source layer of a CompositeField is edited only the tiles it
+    overlaps are rendered again.
     """
     tx = 1000 # physical size, x, for a tile
     ty = 1000 # physical size, y, for a tile
@@ -3596,11 +4265,23 @@ class TileMaker(object):
     dy = 2    # pixel height
     fill_iterations = 10
     smoothing_iterations = 5
-    
+
+    # physical width of the extra margin rendered around each tile.  None
+    # chooses enough for the fill and smoothing iterations plus the field's
+    # own tile_halo(), e.g. fill and feather distances of CompositeField
+    # sources.
+    halo = None
+
+    processes = 1 # >1 renders tiles in a multiprocessing pool
+
     force = False # overwrite existing output files
     output_dir = "."
 
     filename_fmt = "%(left).0f-%(bottom).0f.tif"
+    manifest_name = "manifest.json"
+    # seconds between writes of the manifest during a run.  It is always
+    # written at the end, and tiles missing from it are rendered again.
+    manifest_interval = 30.0
     
     def __init__(self,f,**kwargs):
         """ f: the field to be gridded
@@ -3611,43 +4292,179 @@ class TileMaker(object):
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
 
-    def tile(self,xmin,ymin,xmax,ymax):
+    def halo_pixels(self):
+        """ halo width in pixels, (x,y) """
+        if self.halo is None:
+            if self.fill_iterations=='adaptive':
+                raise ValueError("Set TileMaker.halo when using adaptive filling")
+            # each iteration of a 3x3 filter reaches one pixel further
+            n = self.fill_iterations + self.smoothing_iterations
+            if n>0:
+                n+=1
+            fx,fy = self.f.tile_halo(self.dx,self.dy)
+            return n+fx,n+fy
+        return ( int(np.ceil(float(self.halo)/self.dx)),
+                 int(np.ceil(float(self.halo)/self.dy)) )
+
+    def tiles(self,xmin,ymin,xmax,ymax):
+        """ list of dicts describing each tile: xxyy bounds, the padded
+        bounds which are rendered, output filename and input checksum.
+        """
         nx = int(np.ceil((xmax - xmin)/self.tx))
         ny = int(np.ceil((ymax - ymin)/self.ty))
+        hx,hy = self.halo_pixels()
 
-        print("Tiles: %d x %d"%(nx,ny))
-
+        result = []
         for xi in range(nx):
             for yi in range(ny):
-                ll = [xmin+xi*self.tx,
-                      ymin+yi*self.ty]
-                ur = [ll[0]+self.tx,
-                      ll[1]+self.ty]
-                bounds = np.array( [ll,ur] )
-                print("Tile ",bounds)
-
                 # populate some local variables for giving to the filename format
-                left=ll[0]
-                right=ll[0]+self.tx
-                bottom=ll[1]
-                top = ll[1]+self.ty
+                left = xmin+xi*self.tx
+                right = left+self.tx
+                bottom = ymin+yi*self.ty
+                top = bottom+self.ty
                 dx = self.dx
                 dy = self.dy
-                
+
+                xxyy = [left,right,bottom,top]
+                padded = [left-hx*dx,right+hx*dx,bottom-hy*dy,top+hy*dy]
                 output_fn = os.path.join(self.output_dir,self.filename_fmt%locals())
+                result.append( dict(xxyy=xxyy,padded=padded,halo=[hx,hy],
+                                    output_fn=output_fn,
+                                    checksum=self.tile_checksum(padded)) )
+        return result
 
-                print("Looking for output file: %s"%output_fn)
+    def tile_checksum(self,padded):
+        """ checksum of everything that goes into a tile, or None if the field
+        can't describe its inputs.
+        """
+        sig = self.f.tile_signature(padded)
+        if sig is None:
+            return None
+        settings = [padded,self.dx,self.dy,self.fill_iterations,self.smoothing_iterations]
+        text = json.dumps( [settings,sig], sort_keys=True, default=str )
+        return hashlib.md5(text.encode()).hexdigest()
 
-                if self.force or not os.path.exists(output_fn):
-                    blend = self.f.to_grid(dx=self.dx,dy=self.dy,bounds=bounds)
-                    if self.fill_iterations + self.smoothing_iterations > 0:
-                        print("Filling and smoothing")
-                        blend.fill_by_convolution(self.fill_iterations,self.smoothing_iterations)
-                    print("Saving")
-                    blend.write_gdal( output_fn )
-                    print("Done")
-                else:
-                    print("Already exists. Skipping")
+    def manifest_path(self):
+        return os.path.join(self.output_dir,self.manifest_name)
+
+    def read_manifest(self):
+        """ dict of output filename => record of the completed tile """
+        try:
+            with open(self.manifest_path()) as fp:
+                return json.load(fp)
+        except (IOError,ValueError):
+            return {}
+
+    def write_manifest(self,manifest):
+        tmp = self.manifest_path()+'.tmp'
+        with open(tmp,'wt') as fp:
+            json.dump(manifest,fp,indent=1,sort_keys=True)
+        os.rename(tmp,self.manifest_path())
+
+    def is_current(self,spec,manifest):
+        if self.force or not os.path.exists(spec['output_fn']):
+            return False
+        if spec['checksum'] is None:
+            return True # can't tell, so go by the file alone
+        record = manifest.get(os.path.basename(spec['output_fn']),{})
+        return record.get('checksum') == spec['checksum']
+
+    def render_tile(self,spec):
+        """ render, fill and write a single tile.  Returns the number of pixels. """
+        blend = self.f.to_grid(dx=self.dx,dy=self.dy,bounds=spec['padded'])
+        if self.fill_iterations + self.smoothing_iterations > 0:
+            blend.fill_by_convolution(self.fill_iterations,self.smoothing_iterations)
+        hx,hy = spec['halo']
+        nrows,ncols = blend.F.shape
+        blend = blend.crop(indexes=[hy,nrows-1-hy,hx,ncols-1-hx])
+        # write to a temporary name, so an interrupted run doesn't leave
+        # a partial tile which looks complete
+        tmp_fn = spec['output_fn']+'.tmp'
+        self.write_tile(blend,tmp_fn)
+        os.rename(tmp_fn,spec['output_fn'])
+        return blend.F.size
+
+    def write_tile(self,blend,output_fn):
+        blend.write_gdal( output_fn )
+
+    def tile(self,xmin,ymin,xmax,ymax):
+        """ Render all tiles covering the given bounds which are not already
+        current.  Returns a dict summarizing the run, with counts of
+        rendered, skipped and failed tiles and the throughput.
+        """
+        specs = self.tiles(xmin,ymin,xmax,ymax)
+        manifest = self.read_manifest()
+        todo = [spec for spec in specs if not self.is_current(spec,manifest)]
+        log.info("Tiles: %d total, %d to render"%(len(specs),len(todo)))
+
+        summary = dict(tiles=len(specs),rendered=0,skipped=len(specs)-len(todo),
+                       failed=[],pixels=0)
+        t_start = time.time()
+
+        if self.processes > 1 and len(todo) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(self.processes,len(todo)),
+                                        initializer=_tile_worker_init,initargs=(self,))
+            results = pool.imap_unordered(_tile_worker,todo)
+        else:
+            pool = None
+            results = (_render_tile(self,spec) for spec in todo)
+
+        t_manifest = t_start
+        dirty = False
+        try:
+            for spec,pixels,elapsed,error in results:
+                name = os.path.basename(spec['output_fn'])
+                if error is not None:
+                    log.error("Tile %s failed: %s"%(name,error))
+                    summary['failed'].append(name)
+                    continue
+                manifest[name] = dict(checksum=spec['checksum'],xxyy=spec['xxyy'],
+                                      seconds=elapsed,time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+                dirty = True
+                # rewriting the whole manifest for every tile would be quadratic
+                if time.time() - t_manifest >= self.manifest_interval:
+                    self.write_manifest(manifest)
+                    t_manifest = time.time()
+                    dirty = False
+
+                summary['rendered'] += 1
+                summary['pixels'] += pixels
+                done = summary['rendered'] + len(summary['failed'])
+                t = time.time() - t_start
+                log.info("Tile %s: %d/%d in %.1fs, %.2f tiles/s, %.0f pixels/s, %.0fs remaining"%(
+                    name,done,len(todo),t,done/t,summary['pixels']/t,(len(todo)-done)*t/done))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if dirty:
+                self.write_manifest(manifest)
+
+        summary['seconds'] = t = time.time() - t_start
+        summary['tiles_per_second'] = summary['rendered']/t if t>0 else 0.0
+        summary['pixels_per_second'] = summary['pixels']/t if t>0 else 0.0
+        return summary
+
+
+def _render_tile(tile_maker,spec):
+    """ returns (spec,pixels,seconds,error message or None) """
+    t0 = time.time()
+    try:
+        pixels = tile_maker.render_tile(spec)
+    except Exception as exc:
+        log.exception("Rendering tile %s"%spec['output_fn'])
+        return spec,0,time.time()-t0,"%s: %s"%(exc.__class__.__name__,exc)
+    return spec,pixels,time.time()-t0,None
+
+# TileMaker for this worker process, set once by the pool initializer rather
+# than sent along with every tile
+_worker_tile_maker = None
+def _tile_worker_init(tile_maker):
+    global _worker_tile_maker
+    _worker_tile_maker = tile_maker
+def _tile_worker(spec):
+    return _render_tile(_worker_tile_maker,spec)
 
     
 if __name__ == '__main__':
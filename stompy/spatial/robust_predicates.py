@@ -4,6 +4,8 @@ from __future__ import print_function
 # This is a straightforward translation of the predicates in triangle.c into
 # python.
 
+import numpy as np
+
 
 ## Initialization:
 #  There is a bit of dynamic work which happens on import to figure out
@@ -834,6 +836,80 @@ def orientation(a,b,c):
     return (ccw>0)-(ccw<0)
 
 
+## Batched versions
+# These evaluate the same determinants with numpy, using the error bounds
+# from the adaptive predicates as a filter.  Only entries where the filter
+# cannot decide the sign are passed to the exact, scalar code above.
+
+def _points(*pnts):
+    pnts=np.broadcast_arrays(*[np.asarray(p,np.float64) for p in pnts])
+    shape=pnts[0].shape[:-1]
+    return [p.reshape([-1,2]) for p in pnts],shape
+
+def orientation_array(pa,pb,pc):
+    """
+    Vectorized orientation(): pa,pb,pc are [...,2] arrays of points,
+    broadcast against each other.
+    returns int8 array of 1 for CCW, -1 for CW, 0 for collinear.
+    """
+    (pa,pb,pc),shape=_points(pa,pb,pc)
+    detleft = (pa[:,0] - pc[:,0]) * (pb[:,1] - pc[:,1])
+    detright = (pa[:,1] - pc[:,1]) * (pb[:,0] - pc[:,0])
+    det = detleft - detright
+
+    # as in counterclockwise(), the sign is certain when detleft and
+    # detright do not have the same sign, or det exceeds the error bound.
+    same_sign=( (detleft>0.0) & (detright>0.0) ) | ( (detleft<0.0) & (detright<0.0) )
+    detsum=np.abs(detleft+detright)
+    sure=(~same_sign) | (np.abs(det)>=ccwerrboundA*detsum)
+
+    result=np.sign(det).astype(np.int8)
+    for i in np.nonzero(~sure)[0]:
+        result[i]=orientation(pa[i],pb[i],pc[i])
+    return result.reshape(shape)
+
+def incircle_array(pa,pb,pc,pd):
+    """
+    Vectorized incircle(): pa,pb,pc,pd are [...,2] arrays of points,
+    broadcast against each other.
+    returns int8 array of 1 where pd is inside the circle through
+    CCW-ordered pa,pb,pc, -1 outside, 0 on the circle.
+    """
+    (pa,pb,pc,pd),shape=_points(pa,pb,pc,pd)
+    adx = pa[:,0] - pd[:,0]
+    bdx = pb[:,0] - pd[:,0]
+    cdx = pc[:,0] - pd[:,0]
+    ady = pa[:,1] - pd[:,1]
+    bdy = pb[:,1] - pd[:,1]
+    cdy = pc[:,1] - pd[:,1]
+
+    bdxcdy = bdx * cdy
+    cdxbdy = cdx * bdy
+    alift = adx * adx + ady * ady
+
+    cdxady = cdx * ady
+    adxcdy = adx * cdy
+    blift = bdx * bdx + bdy * bdy
+
+    adxbdy = adx * bdy
+    bdxady = bdx * ady
+    clift = cdx * cdx + cdy * cdy
+
+    det = ( alift * (bdxcdy - cdxbdy)
+            + blift * (cdxady - adxcdy)
+            + clift * (adxbdy - bdxady) )
+
+    permanent = ( (np.abs(bdxcdy) + np.abs(cdxbdy)) * alift
+                  + (np.abs(cdxady) + np.abs(adxcdy)) * blift
+                  + (np.abs(adxbdy) + np.abs(bdxady)) * clift )
+    sure=np.abs(det) > iccerrboundA * permanent
+
+    result=np.sign(det).astype(np.int8)
+    for i in np.nonzero(~sure)[0]:
+        result[i]=np.sign(incircle(pa[i],pb[i],pc[i],pd[i]))
+    return result.reshape(shape)
+
+
 if __name__ == '__main__':
     ## Some testing:
 
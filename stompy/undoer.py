@@ -1,6 +1,275 @@
 """ Generic support for recording operations, with the option
 of undoing those operations.
 """
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+class OpLog(object):
+    """
+    Array-backed stack of undo operations, used by OpHistory.
+
+    Operations declared in the owner's undo_ops are stored as an op code,
+    an element index, and optionally a row of saved field values in a
+    structured array pool shared by all entries with the same dtype.
+    Anything else is kept as (method,args,kwargs), as before.
+
+    Frames are absolute: after release() drops old entries, len() still
+    counts them, so existing checkpoints stay meaningful.
+
+    spill_ops: if set, when more than 2*spill_ops entries are in memory the
+    oldest spill_ops are written to a temporary file in spill_dir, and read
+    back in when a revert reaches them.  Untyped entries are not spilled.
+    """
+    GENERIC=-1
+
+    def __init__(self,owner,spill_ops=None,spill_dir=None):
+        self.owner=owner
+        self.spill_ops=spill_ops
+        self.spill_dir=spill_dir
+
+        self.base=0 # absolute frame of the first entry in memory
+        self.count=0 # entries in memory
+        self.codes=np.zeros(64,np.int16)
+        self.idxs=np.zeros(64,np.int64)
+        self.keys=np.zeros(64,np.int32) # pool id, -1 for none
+        self.rows=np.zeros(64,np.int64) # absolute row in the pool
+
+        self.op_names=[] # code => method name
+        self.op_codes={} # method name => code
+        self.pool_ids={} # (dtype,kind) => pool id
+        self.pools=[] # pool id => [array, base row, row count]
+        self.generic={} # absolute frame => (meth,args,kwargs)
+        self.spilled=[] # [ (path, entry count, {pool id: row count}), ...]
+
+        # entries at or above this frame were pushed since the last checkpoint
+        self.barrier=0
+
+    def __len__(self):
+        return self.base+self.count
+
+    def _code(self,name):
+        if name not in self.op_codes:
+            self.op_codes[name]=len(self.op_names)
+            self.op_names.append(name)
+        return self.op_codes[name]
+
+    def _pool(self,dtype,kind):
+        key=(dtype,kind)
+        if key not in self.pool_ids:
+            self.pool_ids[key]=len(self.pools)
+            self.pools.append( [np.zeros(16,dtype),0,0] )
+        return self.pool_ids[key]
+
+    def _pool_append(self,pid,values):
+        pool=self.pools[pid]
+        arr,base,n=pool
+        if n==len(arr):
+            new_arr=np.zeros(2*len(arr),arr.dtype)
+            new_arr[:n]=arr
+            pool[0]=arr=new_arr
+        for name,v in values:
+            arr[name][n]=v
+        pool[2]=n+1
+        return base+n
+
+    def _encode(self,meth,data,kwdata):
+        """ returns (code,index,pool id,values) or None """
+        if getattr(meth,'__self__',None) is not self.owner:
+            return None
+        name=meth.__name__
+        spec=self.owner.undo_ops.get(name,None)
+        if spec is None or len(data)<1:
+            return None
+        kind,array_name=spec
+        try:
+            idx=int(data[0])
+        except TypeError:
+            return None
+        if kind=='index':
+            if len(data)!=1 or kwdata:
+                return None
+            return self._code(name),idx,-1,None
+        elif kind=='record':
+            if len(data)!=2 or kwdata or getattr(data[1],'dtype',None) is None:
+                return None
+            rec=data[1]
+            pid=self._pool(rec.dtype,kind)
+            return self._code(name),idx,pid,[ (f,rec[f]) for f in rec.dtype.names]
+        elif kind=='fields':
+            if len(data)!=1 or not kwdata:
+                return None
+            arr_dtype=getattr(self.owner,array_name).dtype
+            if any(f not in arr_dtype.names for f in kwdata):
+                return None
+            dtype=np.dtype([ (f,arr_dtype[f]) for f in sorted(kwdata) ])
+            pid=self._pool(dtype,kind)
+            return self._code(name),idx,pid,[ (f,kwdata[f]) for f in dtype.names]
+        return None
+
+    def push(self,meth,data,kwdata):
+        enc=self._encode(meth,data,kwdata)
+        if enc is not None:
+            code,idx,pid,values=enc
+            kind=self.owner.undo_ops[self.op_names[code]][0]
+            # Successive changes to the same fields of one element since
+            # the last checkpoint: only the oldest value is needed.
+            if ( kind=='fields' and self.count>0 and len(self)-1>=self.barrier
+                 and self.codes[self.count-1]==code and self.idxs[self.count-1]==idx
+                 and self.keys[self.count-1]==pid ):
+                return
+        else:
+            code,idx,pid,values=self.GENERIC,-1,-1,None
+
+        if self.count==len(self.codes):
+            for attr in ['codes','idxs','keys','rows']:
+                old=getattr(self,attr)
+                new=np.zeros(2*len(old),old.dtype)
+                new[:self.count]=old[:self.count]
+                setattr(self,attr,new)
+        i=self.count
+        self.codes[i]=code
+        self.idxs[i]=idx
+        self.keys[i]=pid
+        self.rows[i]=-1
+        if pid>=0:
+            self.rows[i]=self._pool_append(pid,values)
+        elif code==self.GENERIC:
+            self.generic[len(self)]=(meth,data,kwdata)
+        self.count+=1
+
+        if self.spill_ops and self.count>2*self.spill_ops:
+            self.spill(self.spill_ops)
+
+    def pop(self):
+        """ remove the last entry, returning (meth,args,kwargs) """
+        if self.count==0:
+            if not self.spilled:
+                raise IndexError("pop from empty undo log")
+            self.unspill()
+        self.count-=1
+        i=self.count
+        frame=len(self)
+        code=self.codes[i]
+        if code==self.GENERIC:
+            return self.generic.pop(frame)
+
+        name=self.op_names[code]
+        meth=getattr(self.owner,name)
+        kind=self.owner.undo_ops[name][0]
+        idx=int(self.idxs[i])
+        pid=self.keys[i]
+        if pid<0:
+            return meth,(idx,),{}
+        pool=self.pools[pid]
+        row=self.rows[i]-pool[1]
+        assert row==pool[2]-1,"Undo pool out of order"
+        pool[2]-=1
+        rec=pool[0][row].copy()
+        if kind=='record':
+            return meth,(idx,rec),{}
+        else:
+            kw={}
+            for f in rec.dtype.names:
+                kw[f]=rec[f]
+            return meth,(idx,),kw
+
+    def spill(self,n):
+        """ write the oldest n entries in memory to a temporary file """
+        n=min(n,self.count)
+        pool_rows={}
+        typed=self.keys[:n]
+        for pid in np.unique(typed[typed>=0]):
+            last=self.rows[:n][typed==pid].max()
+            pool_rows[pid]=last+1-self.pools[pid][1]
+        chunk={'codes':self.codes[:n].copy(),
+               'idxs':self.idxs[:n].copy(),
+               'keys':self.keys[:n].copy(),
+               'rows':self.rows[:n].copy(),
+               'pools':dict( (pid,self.pools[pid][0][:k].copy())
+                             for pid,k in pool_rows.items() )}
+        fd,path=tempfile.mkstemp(suffix='.undo',dir=self.spill_dir)
+        with os.fdopen(fd,'wb') as fp:
+            pickle.dump(chunk,fp,protocol=2)
+
+        for attr in ['codes','idxs','keys','rows']:
+            arr=getattr(self,attr)
+            arr[:self.count-n]=arr[n:self.count].copy()
+        for pid,k in pool_rows.items():
+            arr,base,count=self.pools[pid]
+            arr[:count-k]=arr[k:count].copy()
+            self.pools[pid][1:]=[base+k,count-k]
+        self.count-=n
+        self.base+=n
+        self.spilled.append( (path,n,pool_rows) )
+
+    def unspill(self):
+        """ read the most recently spilled entries back into memory """
+        path,n,pool_rows=self.spilled.pop()
+        with open(path,'rb') as fp:
+            chunk=pickle.load(fp)
+        os.unlink(path)
+        for attr in ['codes','idxs','keys','rows']:
+            old=getattr(self,attr)
+            new=np.zeros(max(len(old),2*(n+self.count)),old.dtype)
+            new[:n]=chunk[attr]
+            new[n:n+self.count]=old[:self.count]
+            setattr(self,attr,new)
+        for pid,k in pool_rows.items():
+            arr,base,count=self.pools[pid]
+            new=np.zeros(max(len(arr),2*(k+count)),arr.dtype)
+            new[:k]=chunk['pools'][pid]
+            new[k:k+count]=arr[:count]
+            self.pools[pid]=[new,base-k,count+k]
+        self.count+=n
+        self.base-=n
+
+    def start(self):
+        """ oldest frame which can still be reverted to """
+        return self.base-sum(n for path,n,pool_rows in self.spilled)
+
+    def release(self,frame):
+        """ discard entries below frame, which can no longer be reverted """
+        # spilled segments entirely below frame
+        seg_start=self.start()
+        while self.spilled and seg_start+self.spilled[0][1]<=frame:
+            path,n,pool_rows=self.spilled.pop(0)
+            os.unlink(path)
+            seg_start+=n
+
+        if not self.spilled:
+            n=min(max(frame-self.base,0),self.count)
+            if n>0:
+                typed=self.keys[:n]
+                for pid in np.unique(typed[typed>=0]):
+                    last=self.rows[:n][typed==pid].max()
+                    arr,base,count=self.pools[pid]
+                    k=last+1-base
+                    arr[:count-k]=arr[k:count].copy()
+                    self.pools[pid][1:]=[base+k,count-k]
+                for attr in ['codes','idxs','keys','rows']:
+                    arr=getattr(self,attr)
+                    arr[:self.count-n]=arr[n:self.count].copy()
+                self.count-=n
+                self.base+=n
+        start=self.start()
+        for k in [k for k in self.generic if k<start]:
+            del self.generic[k]
+
+    def close(self):
+        """ remove any spill files.  The log is unusable afterwards """
+        for path,n,pool_rows in self.spilled:
+            if os.path.exists(path):
+                os.unlink(path)
+        self.spilled=[]
+
+    def nbytes(self):
+        """ approximate memory held by typed entries """
+        return ( self.codes.nbytes+self.idxs.nbytes+self.keys.nbytes+self.rows.nbytes
+                 + sum(p[0].nbytes for p in self.pools) )
+
 
 class OpHistory(object):
     state='inactive' # 'recording','reverting'
@@ -14,13 +283,27 @@ class OpHistory(object):
     op_stack_serial = 17
     op_stack = None
     abs_serial=0
+
+    # name of undo method => (kind, array name), for methods which can be
+    # stored compactly in the OpLog:
+    #   ('index',None): meth(i)
+    #   ('record',None): meth(i,record), record a numpy structured scalar
+    #   ('fields',array): meth(i,**fields), with fields of getattr(self,array)
+    undo_ops={}
+    # see OpLog
+    undo_spill_ops=None
+    undo_spill_dir=None
+
     def checkpoint(self):
         assert self.state != 'reverting'
 
         if self.op_stack is None:
             self.op_stack_serial += 1
-            self.op_stack = []
+            self.op_stack = OpLog(self,
+                                  spill_ops=self.undo_spill_ops,
+                                  spill_dir=self.undo_spill_dir)
         self.state='recording'
+        self.op_stack.barrier=len(self.op_stack)
         return self.Checkpoint(self.op_stack_serial,len(self.op_stack))
 
     def revert(self,cp):
@@ -30,12 +313,16 @@ class OpHistory(object):
                                                              cp.serial) )
         if self.state!='recording':
             raise Exception("Tried to revert, but not recording")
+        if cp.frame < self.op_stack.start():
+            raise ValueError("Checkpoint at frame %d was released (history starts at %d)"%
+                             (cp.frame,self.op_stack.start()))
         try:
             self.state='reverting'
             while len(self.op_stack) > cp.frame:
                 self.pop_op()
         finally:
             self.state='recording'
+            self.op_stack.barrier=len(self.op_stack)
 
     def backstep(self):
         if self.state!='recording':
@@ -45,34 +332,47 @@ class OpHistory(object):
             self.pop_op()
         finally:
             self.state='recording'
+            self.op_stack.barrier=len(self.op_stack)
+
+    def release(self,cp):
+        """
+        Discard the history before checkpoint cp.  cp and later
+        checkpoints remain valid, while reverting to anything earlier
+        raises ValueError.  Bounds memory in long runs where old
+        checkpoints are no longer needed.
+        """
+        if cp.serial != self.op_stack_serial:
+            raise ValueError( ("The current op stack has serial %d,"
+                               "but your checkpoint is %s")%(self.op_stack_serial,
+                                                             cp.serial) )
+        self.op_stack.release(cp.frame)
 
     def commit(self):
         assert self.state != 'reverting'
+        if self.op_stack is not None:
+            self.op_stack.close()
         self.op_stack = None
         self.op_stack_serial += 1
         self.state='inactive'
-    
+
     def push_op(self,meth,*data,**kwdata):
         self.abs_serial=self.abs_serial+1
         if self.state!='recording':
             return
 
         if self.op_stack is not None:
-            self.op_stack.append( (meth,data,kwdata) )
+            self.op_stack.push(meth,data,kwdata)
 
     def pop_op(self):
         assert self.state=='reverting'
 
         self.abs_serial=self.abs_serial+1
 
-        f = self.op_stack.pop()
-        self.log.debug("popping: %s"%( str(f) ) )
-        meth = f[0]
-        args = f[1]
-        kwargs = f[2]
-        
+        meth,args,kwargs = self.op_stack.pop()
+        self.log.debug("popping: %s"%( str(meth) ) )
+
         meth(*args,**kwargs)
-        
+
     def __getstate__(self):
         try:
             d=super(OpHistory,self).__getstate__()
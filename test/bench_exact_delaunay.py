@@ -0,0 +1,57 @@
+"""
+Benchmark point insertion into exact_delaunay.Triangulation, comparing
+the spatially hinted starting cell for locate() against starting each
+walk from the first valid cell.
+
+usage: python bench_exact_delaunay.py [N] [N_baseline]
+
+N points are inserted in random order with the hint.  Without the hint
+each walk crosses O(sqrt(N)) cells, so the baseline only inserts the
+first N_baseline of the same points.  Rates are reported for the
+baseline prefix, and for all N points.
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+
+from stompy.grid import exact_delaunay
+
+
+def insert_points(points,start_hint,marks=()):
+    """
+    Insert points one at a time.
+    returns list of (count,elapsed seconds,locate steps) at each count in marks,
+    and at the end.
+    """
+    dt=exact_delaunay.Triangulation()
+    dt.start_hint=start_hint
+    marks=sorted(set([m for m in marks if m<len(points)] + [len(points)]))
+    results=[]
+    t0=time.time()
+    for i,x in enumerate(points):
+        dt.add_node(x=x)
+        if i+1==marks[len(results)]:
+            results.append( (i+1,time.time()-t0,dt.locate_steps) )
+    return results
+
+
+def report(label,results):
+    for count,elapsed,steps in results:
+        print("%-10s N=%7d  %8.0f inserts/s  %7.1f cells walked/insert"%(label,count,
+                                                                       count/elapsed,
+                                                                       steps/float(count)))
+
+
+def main(N=100000,N_baseline=5000,seed=37):
+    points=np.random.RandomState(seed).uniform(0,1000,size=(N,2))
+
+    report('hint',insert_points(points,start_hint=True,marks=[N_baseline]))
+    report('no hint',insert_points(points[:N_baseline],start_hint=False))
+
+
+if __name__=='__main__':
+    args=[int(a) for a in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,69 @@
+"""
+Benchmark attaching a ShadowCDT to an existing grid, comparing the bulk
+path in init_from_grid against inserting the grid edges one constraint
+at a time.
+
+usage: python bench_shadow_cdt.py [nx] [nx_baseline]
+
+The grid is an nx by nx quad grid with perturbed nodes and one diagonal
+in every fifth cell, so that some constraints are not Delaunay edges.
+The one-at-a-time baseline uses a smaller nx_baseline grid.
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+
+from stompy.grid import unstructured_grid, exact_delaunay, shadow_cdt
+
+
+def make_grid(nx,seed=17):
+    g=unstructured_grid.UnstructuredGrid(max_sides=4)
+    g.add_rectilinear([0,0],[1000,1000],nx,nx)
+    rs=np.random.RandomState(seed)
+    dx=1000./(nx-1)
+    g.nodes['x']+=rs.uniform(-0.1*dx,0.1*dx,g.nodes['x'].shape)
+    # diagonals, without cells
+    cells=np.arange(0,g.Ncells(),5)
+    diags=g.cells['nodes'][cells][:,[0,2]]
+    g.cells['deleted'][:]=True
+    g.add_edges(nodes=diags)
+    g.refresh_metadata()
+    return g
+
+
+def attach_bulk(g):
+    t0=time.time()
+    cdt=shadow_cdt.ShadowCDT(g)
+    return time.time()-t0
+
+
+def attach_sequential(g):
+    t0=time.time()
+    cdt=exact_delaunay.Triangulation()
+    cdt.bulk_init(g.nodes['x'])
+    for j in g.valid_edge_iter():
+        cdt.add_constraint(*g.edges['nodes'][j])
+    return time.time()-t0
+
+
+def report(label,g,elapsed):
+    Nedges=(~g.edges['deleted']).sum()
+    print("%-12s nodes=%7d edges=%7d  %7.2f s  %9.0f edges/s"%(label,g.Nnodes(),Nedges,
+                                                              elapsed,Nedges/elapsed))
+
+
+def main(nx=225,nx_baseline=60):
+    g=make_grid(nx)
+    report('bulk',g,attach_bulk(g))
+
+    g=make_grid(nx_baseline)
+    report('bulk',g,attach_bulk(g))
+    report('sequential',g,attach_sequential(g))
+
+
+if __name__=='__main__':
+    args=[int(a) for a in sys.argv[1:]]
+    main(*args)
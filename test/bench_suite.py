@@ -0,0 +1,275 @@
+"""
+Benchmark suite for the grid generation and triangulation hot paths,
+with JSON output for tracking results across commits.
+
+usage: python bench_suite.py [-s small,medium] [-b name,...] [-r repeat] [-o out.json]
+
+Benchmarks, each run at every requested size:
+  delaunay_insert   exact_delaunay.Triangulation, random points added one
+                    at a time, then 10% of them deleted
+  shadow_cdt        ShadowCDT attached to a perturbed quad grid with
+                    some diagonals (see bench_shadow_cdt.py)
+  front_synthetic   AdvancingTriangles.loop() on a seeded wavy shoreline
+                    with an island
+  front_sample      AdvancingTriangles.loop() on test/data/dumbarton.shp
+  paving            paver.Paving.pave_all() on the synthetic shoreline
+  orthomaker        OrthoMaker.pass_two() on a jittered triangle lattice
+
+All inputs come from fixed seeds.  Setup, such as initializing the
+front boundaries, is not timed.  A benchmark that
+raises is recorded with its error, and the rest still run.  For each case
+the JSON has the best and all times over the repeats, the work done
+(points, edges, cells...), and for the front benchmarks the totals from
+telemetry.Telemetry.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import platform
+import subprocess
+import traceback
+import contextlib
+
+import numpy as np
+from scipy.spatial import Delaunay
+
+from stompy.grid import (exact_delaunay, shadow_cdt, front, telemetry)
+from stompy.spatial import field
+
+import bench_shadow_cdt
+
+data_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),'data')
+
+SIZES=['small','medium','large']
+
+
+@contextlib.contextmanager
+def quiet():
+    """ the older generators print progress to stdout """
+    saved=sys.stdout
+    sys.stdout=io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout=saved
+
+
+def synthetic_shoreline(radius=1000.,seed=0,n=150):
+    """ wavy closed shoreline and an off-center island, as [exterior,island] """
+    rs=np.random.RandomState(seed)
+    theta=np.linspace(0,2*np.pi,n,endpoint=False)
+    r=np.ones_like(theta)
+    for k,amp in [(3,0.15),(7,0.06),(13,0.03)]:
+        r+=amp*np.sin(k*theta+rs.uniform(0,2*np.pi))
+    exterior=radius*np.c_[r*np.cos(theta),r*np.sin(theta)]
+    theta=theta[::-10] # CW
+    island=radius*np.c_[0.3+0.1*np.cos(theta),0.1*np.sin(theta)]
+    return [exterior,island]
+
+
+def sample_shoreline():
+    from stompy.spatial import wkb2shp
+    geom=wkb2shp.shp2geom(os.path.join(data_dir,'dumbarton.shp'))['geom'][0]
+    return [np.array(geom.exterior.coords)[:-1]]
+
+
+## Benchmarks
+# Each takes a size name and returns a function which runs the case and
+# returns a dict of results, with the timed part in 'seconds'.
+
+def delaunay_insert(size):
+    N={'small':2000,'medium':10000,'large':50000}[size]
+    points=np.random.RandomState(0).uniform(0,1000,(N,2))
+    victims=np.random.RandomState(1).permutation(N)[:N//10]
+
+    def run():
+        dt=exact_delaunay.Triangulation()
+        t0=time.time()
+        for x in points:
+            dt.add_node(x=x)
+        t_insert=time.time()-t0
+        t0=time.time()
+        for n in victims:
+            dt.delete_node(n)
+        t_delete=time.time()-t0
+        return dict(points=N,deleted=len(victims),
+                    seconds=t_insert+t_delete,
+                    insert_seconds=t_insert,delete_seconds=t_delete,
+                    cells=int((~dt.cells['deleted']).sum()))
+    return run
+
+def shadow_cdt_attach(size):
+    nx={'small':30,'medium':100,'large':225}[size]
+    g=bench_shadow_cdt.make_grid(nx)
+
+    def run():
+        t0=time.time()
+        cdt=shadow_cdt.ShadowCDT(g)
+        return dict(seconds=time.time()-t0,
+                    nodes=int(g.Nnodes()),
+                    edges=int((~g.edges['deleted']).sum()))
+    return run
+
+def front_loop(rings,scale,count):
+    def run():
+        af=front.AdvancingTriangles()
+        af.set_edge_scale(scale)
+        af.add_curve(rings[0],interior=False)
+        for ring in rings[1:]:
+            af.add_curve(ring,interior=True)
+        af.initialize_boundaries()
+        af.cdt.post_check=False
+        tel=telemetry.Telemetry()
+        t0=time.time()
+        success=af.loop(count=count,telemetry=tel)
+        result=dict(seconds=time.time()-t0,
+                    success=bool(success),count=count,
+                    nodes=int(af.grid.Nnodes()),cells=int(af.grid.Ncells()))
+        for k,v in tel.summary().items():
+            result['telemetry_'+k]=v
+        return result
+    return run
+
+def front_synthetic(size):
+    scale,count={'small':(100.,100),
+                 'medium':(50.,500),
+                 'large':(25.,0)}[size]
+    return front_loop(synthetic_shoreline(),field.ConstantField(scale),count)
+
+def front_sample(size):
+    scale,count={'small':(500.,100),
+                 'medium':(250.,500),
+                 'large':(250.,0)}[size]
+    return front_loop(sample_shoreline(),field.ConstantField(scale),count)
+
+def paving(size):
+    from stompy.grid import paver
+    scale,n_steps={'small':(100.,100),
+                   'medium':(50.,500),
+                   'large':(25.,None)}[size]
+    rings=synthetic_shoreline()
+
+    def run():
+        with quiet():
+            p=paver.Paving(rings,field.ConstantField(scale),label='bench')
+            tel=telemetry.Telemetry()
+            t0=time.time()
+            p.pave_all(n_steps=n_steps,telemetry=tel)
+        result=dict(seconds=time.time()-t0,
+                    n_steps=n_steps,cells=int(p.Ncells()))
+        for k,v in tel.summary().items():
+            result['telemetry_'+k]=v
+        return result
+    return run
+
+def orthomaker(size):
+    from stompy.grid import orthomaker as om
+    n={'small':15,'medium':30,'large':60}[size]
+    x,y=np.meshgrid(np.arange(n)*1.0,np.arange(n)*np.sqrt(3)/2)
+    x[1::2]+=0.5
+    points=np.c_[x.ravel(),y.ravel()]
+    points+=np.random.RandomState(0).uniform(-0.25,0.25,points.shape)
+    cells=Delaunay(points).simplices.astype(np.int32)
+
+    def run():
+        with quiet():
+            grid=om.OrthoMaker(points=points.copy(),cells=cells.copy())
+            bad_before=len(grid.bad_cells())
+            t0=time.time()
+            grid.pass_two()
+        return dict(seconds=time.time()-t0,
+                    points=len(points),cells=len(cells),
+                    bad_before=bad_before,bad_after=len(grid.bad_cells()),
+                    nodes_nudged=grid.nodes_nudged)
+    return run
+
+BENCHMARKS=[('delaunay_insert',delaunay_insert),
+            ('shadow_cdt',shadow_cdt_attach),
+            ('front_synthetic',front_synthetic),
+            ('front_sample',front_sample),
+            ('paving',paving),
+            ('orthomaker',orthomaker)]
+
+
+def run_case(name,make,size,repeat):
+    result=dict(name=name,size=size)
+    try:
+        run=make(size)
+        times=[]
+        for i in range(repeat):
+            details=run()
+            times.append(details['seconds'])
+        result.update(details)
+        result['seconds']=min(times)
+        result['all_seconds']=times
+    except Exception as exc:
+        result['error']="%s: %s"%(exc.__class__.__name__,exc)
+        result['traceback']=traceback.format_exc()
+    return result
+
+
+def metadata():
+    try:
+        commit=subprocess.check_output(['git','rev-parse','HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        commit=None
+    return dict(commit=commit,
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                platform=platform.platform(),
+                cgal=hasattr(shadow_cdt,'ShadowCGALCDT'))
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Grid generation benchmarks")
+    parser.add_argument('-s','--sizes',default='small',
+                        help="comma separated subset of %s"%(",".join(SIZES)))
+    parser.add_argument('-b','--benchmarks',default=None,
+                        help="comma separated names, default all: %s"%(
+                            ",".join(name for name,make in BENCHMARKS)))
+    parser.add_argument('-r','--repeat',type=int,default=1)
+    parser.add_argument('-o','--output',default=None,
+                        help="JSON output file, default stdout")
+    args=parser.parse_args(argv)
+
+    sizes=args.sizes.split(',')
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("Unknown size %s"%size)
+    names=[name for name,make in BENCHMARKS]
+    selected=args.benchmarks.split(',') if args.benchmarks else names
+    for name in selected:
+        if name not in names:
+            parser.error("Unknown benchmark %s"%name)
+
+    results=[]
+    for name,make in BENCHMARKS:
+        if name not in selected:
+            continue
+        for size in sizes:
+            result=run_case(name,make,size,args.repeat)
+            if 'error' in result:
+                print("%-16s %-7s  failed: %s"%(name,size,result['error']),file=sys.stderr)
+            else:
+                print("%-16s %-7s %8.2f s"%(name,size,result['seconds']),file=sys.stderr)
+            results.append(result)
+
+    report=dict(meta=metadata(),results=results)
+    if args.output:
+        with open(args.output,'wt') as fp:
+            json.dump(report,fp,indent=1)
+    else:
+        json.dump(report,sys.stdout,indent=1)
+    return report
+
+
+if __name__=='__main__':
+    main()
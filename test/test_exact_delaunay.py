@@ -267,6 +267,68 @@ def test_incircle():
     assert robust_predicates.incircle(A,B,C,Don) == 0
     assert robust_predicates.incircle(A,B,C,Din) >0
 
+def test_batched_predicates():
+    rs=np.random.RandomState(3)
+    pnts=rs.uniform(0,10,size=(500,4,2))
+    # degenerate and nearly degenerate cases, where the filter must defer
+    # to the exact predicates
+    pnts[:50,:3]=np.round(pnts[:50,:3])
+    pnts[:50,2]=3*pnts[:50,1]-2*pnts[:50,0] # colinear
+    pnts[25:50,:3]*=0.1 # colinear after rounding
+    pnts[50:100]=[ [0,0],[1,0],[1,1],[0,1] ] # cocircular
+    pnts[100:150,:3]=[ [0,0],[1,0],[2,0] ]
+    pnts[100:150,2,1]=rs.choice([-1e-30,0.0,1e-30],size=50)
+    pnts[150:200]=pnts[50:100] + [1e10,1e10]
+    pnts[150:200,3,1]+=rs.choice([-1e-6,0.0,1e-6],size=50)
+
+    ccw=robust_predicates.orientation_array(pnts[:,0],pnts[:,1],pnts[:,2])
+    inc=robust_predicates.incircle_array(pnts[:,0],pnts[:,1],pnts[:,2],pnts[:,3])
+    for i in range(len(pnts)):
+        assert ccw[i]==robust_predicates.orientation(*pnts[i,:3])
+        assert inc[i]==np.sign(robust_predicates.incircle(*pnts[i]))
+    assert np.all(ccw[:25]==0)
+    assert np.all(inc[50:100]==0)
+
+def test_bulk_init_validate():
+    # lattice points are all cocircular in groups of 4, the worst case
+    # for choosing the diagonals
+    X,Y=np.meshgrid(np.arange(20.),np.arange(20.))
+    pnts=np.c_[X.ravel(),Y.ravel()]
+    pnts=np.r_[pnts, np.random.RandomState(5).uniform(0,19,(100,2))]
+    dt=Triangulation()
+    dt.bulk_init(pnts)
+    assert len(dt.check_orientations())==0
+    assert len(dt.local_delaunay_failures()[0])==0
+    assert len(dt.check_global_delaunay())==0
+
+def test_add_constraints():
+    # ring of points, sorted by angle, gives non-crossing constraints
+    # which are mostly not Delaunay edges
+    rs=np.random.RandomState(7)
+    theta=np.sort(rs.uniform(0,2*np.pi,100))
+    r=rs.uniform(5,10,100)
+    ring=np.c_[r*np.cos(theta),r*np.sin(theta)]
+    pnts=np.r_[ring,rs.uniform(-15,15,(100,2))]
+    pairs=np.c_[np.arange(100),(np.arange(100)+1)%100]
+
+    dt_seq=Triangulation()
+    dt_seq.bulk_init(pnts)
+    for a,b in pairs:
+        dt_seq.add_constraint(a,b)
+
+    dt=Triangulation()
+    dt.bulk_init(pnts)
+    dt.add_constraints(pairs)
+    dt.check_local_delaunay()
+    assert len(dt.check_orientations())==0
+
+    def edge_set(d,constrained):
+        sel=(~d.edges['deleted'])&(d.edges['constrained']==constrained)
+        return set( [tuple(sorted(e)) for e in d.edges['nodes'][sel]] )
+    assert edge_set(dt,True)==set( [tuple(sorted(e)) for e in pairs] )
+    assert edge_set(dt,True)==edge_set(dt_seq,True)
+    assert edge_set(dt,False)==edge_set(dt_seq,False)
+
 # testing dim_down
 def test_test_dim_down():
     dt = Triangulation()
@@ -577,6 +639,26 @@ def test_move1():
 
 ## 
         
+def test_start_hint():
+    # locate() should start near the target, even as nodes are
+    # added, moved and deleted
+    pnts=np.random.RandomState(3).uniform(0,100,size=(400,2))
+    dt = Triangulation()
+    nodes=[dt.add_node(x=x) for x in pnts]
+    # without the hint this is roughly sqrt(N)
+    assert dt.locate_steps/float(len(pnts)) < 8
+
+    for n in nodes[:200:2]:
+        dt.delete_node(n)
+    assert not dt.check_global_delaunay()
+    for n in nodes[201:300:2]:
+        dt.modify_node(n,x=dt.nodes['x'][n]+0.1)
+
+    for n in dt.valid_node_iter():
+        c,loc_type,loc_index=dt.locate(dt.nodes['x'][n])
+        assert loc_type==dt.IN_VERTEX
+        assert dt.cells['nodes'][c,loc_index]==n
+
 if 0:
     test_find_intersected_elements()
     test_adjacent_nodes_dim1()
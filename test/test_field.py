@@ -1,5 +1,9 @@
 import os
+import shutil
+import pickle
+import tempfile
 import numpy as np
+from nose.tools import assert_raises
 
 from stompy.spatial import field
 
@@ -36,3 +40,329 @@ def test_lin_interp():
     assert np.allclose(out,F)
 
 
+
+##
+
+def multi_raster_field(threads=None):
+    """ MultiRasterField over in-memory SimpleGrids, highest priority first """
+    mrf=field.MultiRasterField([],error_on_null_input=False,threads=threads)
+    rs=np.random.RandomState(0)
+    grids=[]
+    # fine grid with a hole, coarse grid, and a fine grid off to the side
+    for extents,res,order in [ ([0,50,0,50],1.0,0.0),
+                               ([-20,120,-20,120],5.0,0.0),
+                               ([60,100,0,40],1.0,0.0) ]:
+        nx=int(round((extents[1]-extents[0])/res))+1
+        ny=int(round((extents[3]-extents[2])/res))+1
+        F=rs.uniform(0,10,(ny,nx))
+        grids.append(field.SimpleGrid(extents=extents,F=F))
+    grids[0].F[20:30,20:30]=np.nan
+
+    sources=np.zeros(len(grids),dtype=mrf.sources.dtype)
+    for i,g in enumerate(grids):
+        sources['field'][i]=g
+        sources['filename'][i]='grid%d'%i
+        sources['extent'][i]=g.extents
+        sources['resolution'][i]=g.delta()[0]
+        sources['resx'][i],sources['resy'][i]=g.delta()
+    mrf.sources=sources
+    mrf.build_index()
+    return mrf
+
+def test_multi_raster_value():
+    X=np.random.RandomState(1).uniform(-30,130,(2000,2))
+    for threads in [1,4]:
+        mrf=multi_raster_field(threads=threads)
+        mrf.clip_max=9.0
+        batch=mrf.value(X)
+        single=np.array([mrf.value_on_point(x) for x in X])
+        assert np.allclose(batch,single,equal_nan=True)
+        # some of each: fall-through from the hole, and outside everything
+        assert np.isnan(batch).sum()>0
+        assert np.all(batch[np.isfinite(batch)]<=9.0)
+    # shape is kept
+    assert mrf.value(X.reshape(10,200,2)).shape==(10,200)
+    assert np.isscalar(mrf.value(X[0]))
+
+def test_multi_raster_ties():
+    # equal order and resolution: the lower source index wins, whatever
+    # order the spatial index reports hits in
+    mrf=multi_raster_field()
+    mrf.sources['field'][2]=field.SimpleGrid(extents=[0,50,0,50],
+                                            F=np.zeros_like(mrf.sources['field'][0].F))
+    mrf.sources['extent'][2]=mrf.sources['extent'][0]
+    mrf.build_index()
+    class Reversed(object):
+        def __init__(self,index):
+            self.index=index
+        def intersection(self,xxyy):
+            return list(self.index.intersection(xxyy))[::-1]
+    mrf.index=Reversed(mrf.index)
+    X=np.random.RandomState(3).uniform(0,50,(200,2))
+    assert list(mrf.ordered_hits([10,11,10,11]))==[0,2,1]
+    single=np.array([mrf.value_on_point(x) for x in X])
+    assert np.allclose(mrf.value(X),single,equal_nan=True)
+
+def test_lazy_raster():
+    # file order is north-up, as GDAL would read it, with strip blocks
+    rs=np.random.RandomState(2)
+    A=rs.uniform(0,10,(700,600)).astype(np.float32)
+    A[100:120,50:60]=-9999
+    reads=[]
+    def reader(xoff,yoff,xsize,ysize):
+        reads.append( (xoff,yoff,xsize,ysize) )
+        return A[yoff:yoff+ysize,xoff:xoff+xsize]
+
+    cache=field.RasterCache(max_bytes=4*256*600*4)
+    lazy=field.LazyRaster(reader,file_shape=A.shape,block_shape=(1,600),dtype=A.dtype,
+                          flip=True,nodata=-9999,cache=cache)
+    F=A[::-1].copy()
+    F[F==-9999]=np.nan
+    assert lazy.shape==F.shape
+    assert lazy.block_shape==(256,600)
+    assert len(reads)==0
+
+    assert np.allclose(lazy[10:500:3,-20:],F[10:500:3,-20:],equal_nan=True)
+    assert np.allclose(lazy[5,:],F[5,:])
+    rows=rs.randint(0,700,(30,40)) ; cols=rs.randint(0,600,(30,40))
+    assert np.allclose(lazy[rows,cols],F[rows,cols],equal_nan=True)
+    assert np.allclose(lazy[rows[0],:],F[rows[0],:],equal_nan=True)
+    assert np.allclose(np.asarray(lazy),F,equal_nan=True)
+    stats=cache.stats()
+    assert stats['nbytes']<=cache.max_bytes
+    assert stats['hits']>0 and stats['misses']==len(reads)
+
+    # SimpleGrid methods read through the cache
+    eager=field.SimpleGrid(extents=[0,599,0,699],F=F)
+    grid=field.SimpleGrid(extents=[0,599,0,699],F=lazy)
+    X=rs.uniform(-10,700,(1000,2))
+    for interp in ['nearest','linear']:
+        assert np.allclose(grid.interpolate(X,interp),eager.interpolate(X,interp),equal_nan=True)
+    crop=grid.crop([100.3,200.7,50,60])
+    assert isinstance(crop.F,np.ndarray)
+    assert np.allclose(crop.F,eager.crop([100.3,200.7,50,60]).F)
+    tile=grid.extract_tile([200,260,300,330],res=2.5,interpolation='bilinear')
+    assert np.allclose(tile.F,eager.extract_tile([200,260,300,330],res=2.5,
+                                                 interpolation='bilinear').F)
+
+def test_lazy_raster_keys():
+    # blocks outlive their raster in the cache, and must not be picked up
+    # by a later raster which happens to reuse its id()
+    cache=field.RasterCache()
+    for i in range(200):
+        A=np.full((10,10),i,np.float64)
+        lazy=field.LazyRaster(lambda xoff,yoff,xsize,ysize,A=A: A[yoff:yoff+ysize,xoff:xoff+xsize],
+                              file_shape=A.shape,block_shape=(10,10),dtype=A.dtype,
+                              cache=cache)
+        assert lazy[0,0]==i
+        del lazy
+
+def test_raster_cache():
+    cache=field.RasterCache(max_bytes=10*8000)
+    loads=[]
+    def load(i):
+        def f():
+            loads.append(i)
+            return field.SimpleGrid(extents=[0,1,0,1],F=np.full((10,100),i,np.float64))
+        return f
+    for i in [0,1,2,0,3,4,5,6,7,8,9,10,1,0]:
+        g=cache.get(i,load(i),nbytes=field.grid_nbytes)
+        assert g.F[0,0]==i
+    stats=cache.stats()
+    # 0 was used again, so 1 and then 2 are evicted first
+    assert loads==[0,1,2,3,4,5,6,7,8,9,10,1]
+    assert stats['hits']==2 and stats['misses']==12
+    assert stats['nbytes']<=cache.max_bytes and stats['entries']==10
+    assert stats['evictions']==2
+
+    # a single entry over budget is still returned and kept
+    big=cache.get('big',lambda: np.zeros(20000))
+    assert cache.stats()['entries']==1 and 'big' in cache.entries
+
+    cache.max_entries=2
+    for i in range(5):
+        cache.get(i,lambda: np.zeros(10))
+    assert cache.stats()['entries']==2
+
+    # zero-byte grids, i.e. lazy rasters, are limited by count
+    cache=field.RasterCache(max_grids=3)
+    cache.get('block',lambda: np.zeros(10))
+    for i in range(5):
+        cache.get(('grid',i),object,nbytes=field.grid_nbytes,grid=True)
+    stats=cache.stats()
+    assert stats['grids']==3 and stats['entries']==4 and stats['evictions']==2
+    assert 'block' in cache.entries and ('grid',4) in cache.entries
+
+class PickleTileMaker(field.TileMaker):
+    # no GDAL needed
+    filename_fmt = "%(left).0f-%(bottom).0f.pkl"
+    def write_tile(self,blend,output_fn):
+        with open(output_fn,'wb') as fp:
+            pickle.dump( (blend.extents,blend.F), fp, -1)
+
+def read_tile(fn):
+    with open(fn,'rb') as fp:
+        return pickle.load(fp)
+
+def test_tile_maker():
+    rs=np.random.RandomState(3)
+    F=rs.uniform(0,10,(201,301))
+    F[rs.uniform(size=F.shape)<0.2]=np.nan # holes to fill
+    src=field.SimpleGrid(extents=[0,300,0,200],F=F)
+    kw=dict(tx=100,ty=100,dx=2,dy=2,fill_iterations=2,smoothing_iterations=1)
+
+    # reference: fill the whole domain at once
+    whole=src.to_grid(dx=2,dy=2,bounds=[-10,310,-10,210])
+    whole.fill_by_convolution(2,1)
+
+    out_dirs=[]
+    for processes in [1,2]:
+        out_dir=tempfile.mkdtemp()
+        out_dirs.append(out_dir)
+        tm=PickleTileMaker(src,output_dir=out_dir,processes=processes,**kw)
+        summary=tm.tile(0,0,300,200)
+        assert summary['rendered']==6 and summary['skipped']==0
+        assert summary['failed']==[] and summary['pixels_per_second']>0
+
+        # the halo makes tiles match filling the whole domain
+        extents,tile=read_tile(os.path.join(out_dir,'100-100.pkl'))
+        assert extents==[100,200,100,200]
+        assert np.allclose(tile,whole.crop([100,200,100,200]).F,equal_nan=True)
+
+    for fn in os.listdir(out_dirs[0]):
+        if fn.endswith('.pkl'):
+            a=read_tile(os.path.join(out_dirs[0],fn))[1]
+            b=read_tile(os.path.join(out_dirs[1],fn))[1]
+            assert np.allclose(a,b,equal_nan=True)
+
+    # resuming skips current tiles, and redoes those touched by a change
+    tm=PickleTileMaker(src,output_dir=out_dirs[0],**kw)
+    assert tm.tile(0,0,300,200)['rendered']==0
+    src.F[150,250]=-5
+    src.F[50,50]=-5
+    # the manifest is written once at the end, not after every tile
+    writes=[]
+    write_manifest=tm.write_manifest
+    def counted(manifest):
+        writes.append(len(manifest))
+        write_manifest(manifest)
+    tm.write_manifest=counted
+    summary=tm.tile(0,0,300,200)
+    assert summary['rendered']==2 and summary['skipped']==4
+    assert writes==[6]
+    extents,tile=read_tile(os.path.join(out_dirs[0],'200-100.pkl'))
+    assert tile[25,25]==-5
+
+    for out_dir in out_dirs:
+        shutil.rmtree(out_dir)
+
+def test_composite_tile_halo():
+    from shapely import geometry
+    sources=np.zeros(3,dtype=[('geom','O'),('priority','f8'),('data_mode','O'),
+                              ('alpha_mode','O')])
+    sources['geom']=[geometry.box(0,0,10,10)]*3
+    sources['priority']=[0,1,-1]
+    sources['data_mode']=['fill(30.0)','overlay()','fill(1000.0)']
+    sources['alpha_mode']=['valid()','feather(40.0)','feather(1000.0)']
+    cf=field.CompositeField(shp_data=sources,factory=None)
+    # feather reaches 40/2 pixels, fill only 30/2//3, and the negative
+    # priority source is not rendered
+    assert cf.tile_halo(2,2)==(20,20)
+    tm=field.TileMaker(cf,dx=2,dy=2,fill_iterations=2,smoothing_iterations=1,
+                       output_dir=tempfile.mkdtemp())
+    assert tm.halo_pixels()==(4+20,4+20)
+    os.rmdir(tm.output_dir)
+
+    sources['alpha_mode'][1]='blur_alpha(5.0)'
+    assert_raises(ValueError,cf.tile_halo,2,2)
+
+def test_composite_many_sources():
+    # more sources than raster_cache.max_grids, each loaded just once
+    from shapely import geometry
+    n=field.raster_cache.max_grids+5
+    sources=np.zeros(n,dtype=[('geom','O'),('priority','f8'),('data_mode','O'),
+                              ('alpha_mode','O'),('src_name','O')])
+    sources['geom']=[geometry.box(i,0,i+10,10) for i in range(n)]
+    sources['priority']=np.arange(n)
+    sources['data_mode']='overlay()'
+    sources['alpha_mode']='valid()'
+    sources['src_name']=['s%d'%i for i in range(n)]
+    calls=[]
+    def factory(rec):
+        calls.append(rec['src_name'])
+        return field.ConstantField(float(len(calls)))
+    cf=field.CompositeField(shp_data=sources,factory=factory)
+    for repeat in range(3):
+        cf.to_grid(dx=1,dy=1,bounds=[0,n+10,0,10])
+    assert sorted(calls)==sorted(sources['src_name'])
+
+def test_composite_layer_cache():
+    from shapely import geometry
+    rs=np.random.RandomState(0)
+    base=rs.uniform(0,10,(101,101))
+    base[rs.uniform(size=base.shape)<0.05]=np.nan
+    grids={'a':field.SimpleGrid(extents=[0,100,0,100],F=base),
+           'b':field.ConstantField(3.0),
+           'c':field.ConstantField(12.0)}
+    sources=np.zeros(3,dtype=[('geom','O'),('priority','f8'),('data_mode','O'),
+                              ('alpha_mode','O'),('src_name','O')])
+    sources['geom']=[geometry.box(-5,-5,105,105),geometry.box(20,20,70,70),
+                     geometry.box(40,10,90,60)]
+    sources['priority']=[0,1,2]
+    sources['data_mode']=['fill(3.0)','min()','max()']
+    sources['alpha_mode']=['valid()','feather(8.0)','valid()']
+    sources['src_name']=['a','b','c']
+    cf=field.CompositeField(shp_data=sources,factory=lambda rec: grids[rec['src_name']])
+    cache_dir=tempfile.mkdtemp()
+    cf.layer_cache_dir=cache_dir
+
+    bounds=[0,100,0,100]
+    cf.cache_layers=False
+    uncached=cf.to_grid(dx=1,dy=1,bounds=bounds)
+    cf.cache_layers=True
+    cached=cf.to_grid(dx=1,dy=1,bounds=bounds)
+    assert np.allclose(uncached.F,cached.F,equal_nan=True)
+    assert len(os.listdir(cache_dir))==3
+
+    # only the edited layer is rendered again
+    cf.sources['geom'][1]=geometry.box(25,20,70,70)
+    edited=cf.to_grid(dx=1,dy=1,bounds=bounds)
+    assert len(os.listdir(cache_dir))==4
+    cf.cache_layers=False
+    assert np.allclose(edited.F,cf.to_grid(dx=1,dy=1,bounds=bounds).F,equal_nan=True)
+
+    # a new version invalidates the saved layers
+    cf.cache_layers=True
+    cf.layer_cache_version='v2'
+    cf.to_grid(dx=1,dy=1,bounds=bounds)
+    assert len(os.listdir(cache_dir))==7
+    shutil.rmtree(cache_dir)
+
+    # same sources, different factory: nothing is shared in memory
+    grids['b']=field.ConstantField(1.0)
+    cf2=field.CompositeField(shp_data=cf.sources,factory=lambda rec: grids[rec['src_name']])
+    cf2.cache_layers=True
+    other=cf2.to_grid(dx=1,dy=1,bounds=bounds)
+    cf2.cache_layers=False
+    assert np.allclose(other.F,cf2.to_grid(dx=1,dy=1,bounds=bounds).F,equal_nan=True)
+    assert not np.allclose(other.F,edited.F,equal_nan=True)
+
+def test_composite_bounds():
+    # [[xmin,ymin],[xmax,ymax]] and [xmin,xmax,ymin,ymax] give the same tile
+    from shapely import geometry
+    sources=np.zeros(2,dtype=[('geom','O'),('priority','f8'),('data_mode','O'),
+                              ('alpha_mode','O'),('src_name','O'),('value','f8')])
+    sources['geom']=[geometry.box(-5,-5,105,55),geometry.box(20,10,70,40)]
+    sources['priority']=[0,1]
+    sources['data_mode']=['overlay()','overlay()']
+    sources['alpha_mode']=['valid()','feather(5.0)']
+    sources['src_name']=['base','patch']
+    sources['value']=[1.0,2.0]
+    cf=field.CompositeField(shp_data=sources,
+                            factory=lambda rec: field.ConstantField(rec['value']))
+    xxyy=cf.to_grid(dx=1,dy=1,bounds=[0,100,0,50])
+    pairs=cf.to_grid(dx=1,dy=1,bounds=[[0,0],[100,50]])
+    assert np.allclose(pairs.extents,[0,100,0,50])
+    assert pairs.F.shape==xxyy.F.shape==(51,101)
+    assert np.allclose(pairs.F,xxyy.F)
+    assert pairs.F[25,45]==2.0 and pairs.F[0,0]==1.0
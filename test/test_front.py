@@ -1,16 +1,18 @@
 import os
 import time
+import tempfile
 import logging
 import matplotlib.pyplot as plt
 import numpy as np
 import pdb
 
 from scipy import optimize as opt
+from scipy.spatial import Delaunay
 
 from stompy.spatial import field
 from stompy import utils
 
-from stompy.grid import (unstructured_grid, exact_delaunay, front)
+from stompy.grid import (unstructured_grid, exact_delaunay, front, telemetry)
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -319,6 +321,92 @@ def test_actions():
     edits=actions[best].execute(site)
     af.optimize_edits(edits)
 
+def test_site_queue():
+    af=test_basic_setup()
+
+    def check():
+        # the queue should agree with scoring every site
+        sites=af.enumerate_sites()
+        best=sites[np.argmin([s.metric() for s in sites])]
+        site=af.site_queue.best()
+        assert list(site.abc)==list(best.abc)
+        return site
+
+    site=check()
+    cp=af.grid.checkpoint()
+    af.resample_neighbors(site)
+    check()
+    edits=front.Wall.execute(site)
+    assert edits['cells']
+    check()
+    af.grid.revert(cp)
+    check()
+
+def jittered_triangles(relax_method):
+    # perturbed equilateral mesh, boundary RIGID and interior FREE
+    X,Y=np.meshgrid(np.arange(12.),np.arange(12.))
+    pnts=np.c_[X.ravel()+0.5*(Y.ravel()%2),Y.ravel()*np.sqrt(3)/2]
+    bdry=(X.ravel()==0)|(X.ravel()==11)|(Y.ravel()==0)|(Y.ravel()==11)
+    pnts[~bdry]+=np.random.RandomState(1).uniform(-0.25,0.25,((~bdry).sum(),2))
+    cells=Delaunay(pnts).simplices
+    g=unstructured_grid.UnstructuredGrid(max_sides=3,points=pnts,cells=cells)
+    g.make_edges_from_cells()
+    af=front.AdvancingTriangles(grid=g,scale=field.ConstantField(1.0))
+    g.nodes['fixed'][:]=af.RIGID
+    g.nodes['fixed'][~bdry]=af.FREE
+    af.relax_method=relax_method
+    return af,np.nonzero(~bdry)[0]
+
+def test_relax_batch():
+    af,nodes=jittered_triangles('batch')
+    g=af.grid
+
+    batch=af.batch_cost_function(nodes)(g.nodes['x'][nodes])
+    assert np.allclose(batch,[af.eval_cost(n) for n in nodes])
+
+    sets=af.independent_sets(nodes)
+    assert sorted(np.concatenate(sets))==sorted(nodes)
+    for group in sets:
+        for n in group:
+            nbrs=set(np.concatenate([g.cell_to_nodes(c) for c in g.node_to_cells(n)]))
+            assert len(nbrs.intersection(group))==1
+
+    x_rigid=g.nodes['x'][g.nodes['fixed']==af.RIGID].copy()
+    af.optimize_nodes(list(nodes),max_levels=1)
+    after=np.array([af.eval_cost(n) for n in nodes])
+    assert after.sum()<batch.sum()
+    assert np.all(g.nodes['x'][g.nodes['fixed']==af.RIGID]==x_rigid)
+    assert g.cells_area().min()>0
+
+    # comparable to relaxing one node at a time
+    af_fmin,nodes=jittered_triangles('fmin')
+    af_fmin.optimize_nodes(list(nodes),max_levels=1)
+    after_fmin=np.array([af_fmin.eval_cost(n) for n in nodes])
+    assert after.sum() < 1.05*after_fmin.sum()
+
+def test_relax_slide_closed_ring():
+    # node 0 sits just past f=0 of the closed hex ring, and its slide
+    # limits come back a period higher.  The slide has to stay local
+    # rather than go the long way around the ring.
+    af=test_basic_setup()
+    g=af.grid
+    g.nodes['fixed'][:]=af.SLIDE
+    crv=af.curves[0]
+    L=crv.total_distance()
+    g.modify_node(0,x=crv(1.0),ring_f=1.0)
+    n=g.add_node(x=[3.,11.],fixed=af.FREE)
+    g.add_edge(nodes=[31,n])
+    g.add_edge(nodes=[n,0])
+    g.add_cell(nodes=[31,0,n])
+
+    lo,hi=af.find_slide_limits(0,9.0)
+    assert lo>1.0 # shifted by a period
+    x0=g.nodes['x'][0].copy()
+    af.relax_slide_node(0)
+    assert utils.dist(g.nodes['x'][0]-x0) < 3.0
+    assert lo < lo+(g.nodes['ring_f'][0]-lo)%L < hi
+    assert np.sum(~g.nodes['deleted'])==33
+
 # af=test_basic_setup()
 # check0=af.grid.checkpoint()
 
@@ -460,6 +548,93 @@ def test_no_lookahead():
         else:
             assert False # none of the children worked out
     return af
+
+##
+# Per-step telemetry
+
+def test_loop_telemetry():
+    af=test_basic_setup()
+    af.cdt.post_check=False
+    tel=telemetry.Telemetry()
+    assert af.loop(count=5,telemetry=tel)
+    assert len(tel.rows)==5
+    table=tel.table()
+    for col in ['site_time','resample_time','strategy_time','optimize_time',
+                'cdt_time','cdt_calls','step_time']:
+        assert col in table.dtype.names
+    assert np.all(table['step']==np.arange(5))
+    assert table['cdt_calls'].sum()>0
+    assert np.all(table['optimize_time']<=table['step_time'])
+    # wrappers are removed after the loop
+    assert 'revert' not in af.grid.__dict__
+    assert 'add_constraint' not in af.cdt.__dict__
+
+    fn=os.path.join(tempfile.mkdtemp(),'steps.csv')
+    tel.to_csv(fn)
+    with open(fn) as fp:
+        lines=fp.readlines()
+    assert len(lines)==6
+    assert lines[0].strip().split(',')==tel.columns()
+    os.unlink(fn)
+
+    # later loops keep recording into the same table
+    assert af.loop(count=2)
+    assert len(tel.rows)==7
+    assert tel.summary()['steps']==7
+
+def test_loop_telemetry_complete():
+    # running to completion records one row per step, nothing for the
+    # final check which finds no site
+    af=front.AdvancingTriangles()
+    af.set_edge_scale(field.ConstantField(50))
+    af.add_curve(np.array([[0,0],[150,0],[150,100],[0,100]]))
+    af.initialize_boundaries()
+    tel=telemetry.Telemetry()
+    assert af.loop(telemetry=tel)
+    assert len(tel.rows)==af.loop_count>0
+    assert np.all(tel.table()['strategy_time']>0)
+    # nothing left to do
+    assert af.loop()
+    assert len(tel.rows)==af.loop_count
+
+def test_pave_all_telemetry():
+    from stompy.grid import paver
+    rect=np.array([[0,0],[300,0],[300,100],[0,100]])
+    p=paver.Paving([rect],field.ConstantField(50))
+    tel=telemetry.Telemetry()
+    p.pave_all(telemetry=tel)
+    assert len(p.unpaved)==0
+    assert len(tel.rows)==p.step>0
+    table=tel.table()
+    for col in ['site_calls','resample_time','strategy_time','optimize_time',
+                'cdt_calls','step_time']:
+        assert col in table.dtype.names
+    assert np.all(table['strategy_calls']>0)
+    assert 'fill' not in p.__dict__
+
+##
+# Bounded look-ahead:
+
+def test_dt_search():
+    af=test_basic_setup()
+    af.log.setLevel(logging.INFO)
+    af.cdt.post_check=False
+    af.current=af.root=front.DTChooseSite(af)
+
+    search=front.DTSearch(beam_width=2,depth=2)
+    assert search.loop(af,count=10)
+    assert search.stats['decisions']==5
+    assert search.stats['children']<=5*(2+2*2)
+    assert search.stats['changed_greedy']<=search.stats['decisions']
+    assert af.grid.Ncells()>0
+    assert isinstance(af.current,front.DTChooseSite)
+
+    # with no time, each decision takes the first child which works
+    search=front.DTSearch(beam_width=3,depth=3,time_budget=0.0)
+    assert search.loop(af,count=4)
+    assert search.stats['decisions']==2
+    assert search.stats['children']-search.stats['failed']<=2
+    assert search.stats['changed_greedy']==0
 ##
 
 # how are we doing time-wise?
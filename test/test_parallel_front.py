@@ -0,0 +1,80 @@
+import numpy as np
+
+from stompy.spatial import field
+from stompy.grid import parallel_front
+
+def square_with_island():
+    return [np.array([[0,0],[2000,0],[2000,1000],[0,1000]]),
+            np.array([[200,200],[600,200],[200,600]])]
+
+def seam_points(rings):
+    pnts=set()
+    for p,seam in rings:
+        for i in np.nonzero(seam)[0]:
+            pnts.add(tuple(p[i]))
+            pnts.add(tuple(p[(i+1)%len(p)]))
+    return pnts
+
+def test_choose_cuts():
+    poly=parallel_front.as_polygon(square_with_island())
+    cuts=parallel_front.choose_cuts(poly,3)
+    assert len(cuts)==3-1
+    regions=parallel_front.split_regions(poly,cuts,field.ConstantField(50))
+    assert len(regions)==3
+    areas=[parallel_front.geometry.Polygon(r[0][0],[ring[0] for ring in r[1:]]).area
+           for r in regions]
+    assert np.allclose(areas,poly.area/3)
+
+def test_split_seams():
+    poly=parallel_front.as_polygon(square_with_island())
+    cuts=[parallel_front.geometry.LineString([[1000,-10],[1000,1010]])]
+    regions=parallel_front.split_regions(poly,cuts,field.ConstantField(50))
+    assert len(regions)==2
+    # both sides share exactly the same seam nodes, 1000/50 segments
+    left,right=[seam_points(r) for r in regions]
+    assert left==right
+    assert len(left)==21
+    assert all(x==1000 for x,y in left)
+    # exterior is CCW
+    for rings in regions:
+        assert parallel_front.utils.signed_area(rings[0][0])>0
+
+def test_pave_merge():
+    # a few steps in each region is enough to check the plumbing
+    pf=parallel_front.ParallelFront(square_with_island(),field.ConstantField(50),
+                                    n_regions=3,processes=1,count=3)
+    g=pf.execute()
+    assert all(success for success,g_region in pf.results)
+    n_total=sum(g_region.Nnodes() for success,g_region in pf.results)
+    # each seam node is in two regions
+    n_seam=len(set.union(*[seam_points(rings) for rings in pf.regions]))
+    assert g.Nnodes()==n_total-n_seam
+    assert g.Ncells()==sum(g_region.Ncells() for success,g_region in pf.results)
+
+def pave_strip(processes):
+    pf=parallel_front.ParallelFront([np.array([[0,0],[300,0],[300,100],[0,100]])],
+                                    field.ConstantField(50),
+                                    n_regions=2,processes=processes)
+    g=pf.execute()
+    assert [success for success,g_region in pf.results]==[True,True]
+
+    # no gaps along the seam, only the outer boundary is unpaired
+    e2c=g.edge_to_cells()
+    assert np.all(e2c.max(axis=1)>=0)
+    assert np.sum(e2c.min(axis=1)<0)==800/50
+    seam=np.abs(g.edges_center()[:,0]-150)<1e-6
+    assert np.any(seam) and np.all(e2c[seam]>=0)
+    assert g.cells_area().min()>0
+    # corner nodes are free to slide, so allow a little slop
+    assert np.allclose(g.cells_area().sum(),300*100,rtol=0.05)
+    return g
+
+def test_pave_complete():
+    pave_strip(processes=1)
+
+def test_pave_complete_processes():
+    # regions, scale and grids go through pickling to the workers
+    g1=pave_strip(processes=1)
+    g2=pave_strip(processes=2)
+    assert g1.Nnodes()==g2.Nnodes() and g1.Ncells()==g2.Ncells()
+    assert np.allclose(g1.nodes['x'],g2.nodes['x'])
@@ -1,10 +1,16 @@
-import numpy as np
+from __future__ import print_function
 
-import nose2
+import numpy as np
+import nose
 
 from stompy.grid import exact_delaunay, unstructured_grid, shadow_cdt
+from stompy.spatial import robust_predicates
+
+def cgal_cdt_class():
+    if not shadow_cdt.has_CGAL:
+        raise nose.SkipTest("CGAL python bindings are not installed")
+    return shadow_cdt.ShadowCGALCDT
 
-reload(shadow_cdt)
 
 ## 
 def run_node_insertion(cdt_class):
@@ -31,9 +37,8 @@ def run_node_insertion(cdt_class):
 def test_node_insertion():
     run_node_insertion(shadow_cdt.ShadowCDT)
 def test_node_insertion_cgal():
-    run_node_insertion(shadow_cdt.ShadowCGALCDT)
+    run_node_insertion(cgal_cdt_class())
     
-test_node_insertion_cgal()
 
 ##
 
@@ -79,11 +84,43 @@ def test_add_edge():
     run_add_constraint(shadow_cdt.ShadowCDT)
     
 def test_add_edge_cgal():
-    run_add_constraint(shadow_cdt.ShadowCGALCDT)
+    run_add_constraint(cgal_cdt_class())
 
-test_add_edge_cgal()
 ##     
 
+def test_init_from_grid():
+    g=unstructured_grid.UnstructuredGrid(max_sides=4)
+    g.add_rectilinear([0,0],[10,10],11,11)
+    g.nodes['x']+=np.random.RandomState(1).uniform(-0.3,0.3,g.nodes['x'].shape)
+    g.refresh_metadata()
+    # existing grids may have deleted nodes, and edges which are not Delaunay
+    n_del=g.select_nodes_nearest([5,5])
+    for c in g.node_to_cells(n_del):
+        g.delete_cell(c)
+    for j in g.node_to_edges(n_del):
+        g.delete_edge(j)
+    g.delete_node(n_del)
+    g.add_edge(nodes=[g.select_nodes_nearest([4,4]),g.select_nodes_nearest([6,6])])
+
+    cdt=shadow_cdt.ShadowCDT(g)
+    assert len(cdt.check_orientations())==0
+    cdt.check_local_delaunay()
+    for j in g.valid_edge_iter():
+        jc=cdt.nodes_to_edge(g.edges['nodes'][j])
+        assert jc is not None and cdt.edges['constrained'][jc]
+    assert cdt.edges['constrained'].sum()==(~g.edges['deleted']).sum()
+
+    # incremental updates continue with the same node indices
+    n=g.add_node(x=[5,5.2])
+    assert cdt.nodemap_g_to_local[n]==n
+    assert np.all(cdt.nodes['x'][n]==g.nodes['x'][n])
+    g.add_edge(nodes=[n,g.select_nodes_nearest([4,4])])
+    try:
+        g.add_edge(nodes=[g.select_nodes_nearest([4,6]),g.select_nodes_nearest([6,4])])
+        assert False
+    except cdt.IntersectingConstraints:
+        pass
+
 def test_remove_constraint():
     def init():
         # inserting a constraint
@@ -113,7 +150,7 @@ def test_remove_constraint():
 
 def test_remove_constraint_cgal():
     g=unstructured_grid.UnstructuredGrid()
-    cdt=shadow_cdt.ShadowCGALCDT(g)
+    cdt=cgal_cdt_class()(g)
     
     # inserting a constraint
     pnts = [ [0,0],
@@ -135,7 +172,6 @@ def test_remove_constraint_cgal():
     g.delete_edge(j1)
     g.delete_edge(j2)
     
-test_remove_constraint_cgal()
 
 ## 
 
@@ -159,7 +195,7 @@ def test_constraints_dim1():
 
 def test_constraints_dim1_cgal():
     g = unstructured_grid.UnstructuredGrid()
-    cdt=shadow_cdt.ShadowCGALCDT(g)
+    cdt=cgal_cdt_class()(g)
     pnts = [ [0,0],
              [5,0],
              [10,0] ]
@@ -176,7 +212,6 @@ def test_constraints_dim1_cgal():
     except cdt.ConstraintCollinearNode:
         pass # 
     
-test_constraints_dim1_cgal()
 
 ## 
 # # Testing the atomic nature of modify_node()
@@ -227,7 +262,7 @@ def test_atomic_move_cgal():
     """
     # inserting a constraint
     g = unstructured_grid.UnstructuredGrid()
-    cdt=shadow_cdt.ShadowCGALCDT(g)
+    cdt=cgal_cdt_class()(g)
 
     pnts = [ [0,0],
              [5,0],
@@ -251,7 +286,6 @@ def test_atomic_move_cgal():
         # And the nodes/constraints should be where they started.
         assert np.all( g.nodes['x'][5]==[6,2] )
 
-test_atomic_move_cgal()
 
 ## 
 #-# Building up some basic tests:
@@ -287,7 +321,7 @@ def test_basic1():
 
 def test_basic1_cgal():
     g = unstructured_grid.UnstructuredGrid()
-    cdt=shadow_cdt.ShadowCGALCDT(g)
+    cdt=cgal_cdt_class()(g)
 
     pnts = [ [0,0],
              [5,0],
@@ -297,7 +331,6 @@ def test_basic1_cgal():
              [6,2]]
     nodes=[g.add_node(x=pnt) for pnt in pnts]
 
-test_basic1_cgal()
 
 def test_flip1():
     plot=False
@@ -322,7 +355,7 @@ def test_flip1():
 def test_flip1_cgal():
     plot=False
     g = unstructured_grid.UnstructuredGrid()
-    cdt=shadow_cdt.ShadowCGALCDT(g)
+    cdt=cgal_cdt_class()(g)
     
     pnts = [ [0,0],
              [8,0],
@@ -332,7 +365,6 @@ def test_flip1_cgal():
 
     [g.add_node(x=pnt) for pnt in pnts]
 
-test_flip1_cgal()    
 
 def test_flip2():
     plot=False
@@ -585,10 +617,10 @@ def test_fuzz1():
     # definitely slows down as the number of nodes gets larger.
     # starting off with <1s per 100 operations, later more like 2s
     for repeat in range(1):
-        print "Repeat: ",repeat
+        print("Repeat: ",repeat)
         for step in range(1000):
             if step%200==0:
-                print "  step: ",step
+                print("  step: ",step)
             toggle=np.random.randint(len(idxs))
             if idxs[toggle]<0:
                 idxs[toggle] = dt.add_node( x=xys[toggle] )
@@ -624,15 +656,15 @@ def test_fuzz1_cgal():
     idxs=np.zeros(len(xys),'i8')-1
 
     g = unstructured_grid.UnstructuredGrid()
-    cdt=shadow_cdt.ShadowCGALCDT(g)
+    cdt=cgal_cdt_class()(g)
 
     # definitely slows down as the number of nodes gets larger.
     # starting off with <1s per 100 operations, later more like 2s
     for repeat in range(1):
-        print "Repeat: ",repeat
+        print("Repeat: ",repeat)
         for step in range(1000):
             if step%200==0:
-                print "  step: ",step
+                print("  step: ",step)
             toggle=np.random.randint(len(idxs))
             if idxs[toggle]<0:
                 idxs[toggle] = g.add_node( x=xys[toggle] )
@@ -650,7 +682,6 @@ def test_fuzz1_cgal():
                 plt.draw()
 
 
-test_fuzz1_cgal()
                 
 def test_extra1():
     plot=False
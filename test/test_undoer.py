@@ -0,0 +1,127 @@
+import os
+import tempfile
+
+import numpy as np
+from nose.tools import assert_raises
+
+from stompy.grid import unstructured_grid
+
+
+def grid_state(g):
+    return [ (name,arr.copy())
+             for name,arr in [('nodes',g.nodes),('edges',g.edges),('cells',g.cells)] ]
+
+def assert_same_state(g,state):
+    for name,arr in state:
+        cur=getattr(g,name)
+        assert len(cur)==len(arr)
+        for field in ['deleted','x','nodes','cells']:
+            if field in arr.dtype.names:
+                assert np.all(cur[field]==arr[field]),"%s[%s] differs"%(name,field)
+
+def edit(g,rs,steps):
+    for step in range(steps):
+        n=rs.randint(g.Nnodes())
+        if g.nodes['deleted'][n]:
+            continue
+        choice=rs.randint(3)
+        if choice==0:
+            g.modify_node(n,x=g.nodes['x'][n]+rs.uniform(-0.1,0.1,2))
+        elif choice==1:
+            g.delete_node_cascade(n)
+        else:
+            n_new=g.add_node(x=g.nodes['x'][n]+[0.05,0.05])
+            g.add_edge(nodes=[n,n_new])
+
+def test_revert_typed():
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[5,5],6,6)
+    g.add_cell_field('depth',np.zeros(g.Ncells(),np.int32))
+    state=grid_state(g)
+
+    cp=g.checkpoint()
+    edit(g,np.random.RandomState(3),200)
+    # bulk adds still go through the generic path
+    g.add_nodes(x=[[10,10],[11,11]])
+    assert len(g.op_stack.generic)==1
+    assert len(g.op_stack.pools)>0
+    g.revert(cp)
+    assert_same_state(g,state)
+
+def test_coalesce():
+    g=unstructured_grid.UnstructuredGrid()
+    n=g.add_node(x=[0,0])
+    cp=g.checkpoint()
+    for i in range(10):
+        g.modify_node(n,x=[i,i])
+    assert len(g.op_stack)-cp.frame==1
+    cp2=g.checkpoint()
+    g.modify_node(n,x=[20,20])
+    g.revert(cp2)
+    assert np.all(g.nodes['x'][n]==[9,9])
+    g.revert(cp)
+    assert np.all(g.nodes['x'][n]==[0,0])
+
+def test_spill():
+    spill_dir=tempfile.mkdtemp()
+    g=unstructured_grid.UnstructuredGrid()
+    g.undo_spill_ops=20
+    g.undo_spill_dir=spill_dir
+    g.add_rectilinear([0,0],[5,5],6,6)
+    state=grid_state(g)
+
+    cp=g.checkpoint()
+    edit(g,np.random.RandomState(5),300)
+    assert len(os.listdir(spill_dir))>0
+    assert g.op_stack.count<=2*g.undo_spill_ops
+    g.revert(cp)
+    assert_same_state(g,state)
+    assert len(os.listdir(spill_dir))==0
+
+    edit(g,np.random.RandomState(6),300)
+    g.commit()
+    assert len(os.listdir(spill_dir))==0
+    os.rmdir(spill_dir)
+
+def test_release():
+    spill_dir=tempfile.mkdtemp()
+    g=unstructured_grid.UnstructuredGrid()
+    g.undo_spill_ops=20
+    g.undo_spill_dir=spill_dir
+    g.add_rectilinear([0,0],[5,5],6,6)
+    rs=np.random.RandomState(7)
+
+    cp0=g.checkpoint()
+    edit(g,rs,100)
+    cp1=g.checkpoint()
+    state=grid_state(g)
+    edit(g,rs,100)
+    cp2=g.checkpoint()
+    edit(g,rs,100)
+
+    n_spilled=len(os.listdir(spill_dir))
+    g.release(cp2)
+    assert len(os.listdir(spill_dir))<n_spilled
+    assert cp0.frame<g.op_stack.start()<=cp2.frame
+    with assert_raises(ValueError):
+        g.revert(cp0)
+    g.revert(cp2)
+
+    # releasing within the in-memory entries
+    g.release(cp2)
+    assert g.op_stack.start()<=cp2.frame
+    g.commit()
+    assert len(os.listdir(spill_dir))==0
+    os.rmdir(spill_dir)
+
+    # without spilling, everything before the release is dropped
+    g.undo_spill_ops=None
+    cp0=g.checkpoint()
+    edit(g,rs,100)
+    cp1=g.checkpoint()
+    state=grid_state(g)
+    edit(g,rs,100)
+    g.release(cp1)
+    assert g.op_stack.start()==cp1.frame
+    g.revert(cp1)
+    assert_same_state(g,state)
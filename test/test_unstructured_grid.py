@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import numpy as np
 import os
+import tempfile
 import nose
 from nose.tools import assert_raises
 
@@ -154,8 +155,11 @@ def test_pickle():
 
     j1=ug.add_edge(nodes=[n1,n2])
 
-    ug.write_pickle('blah.pkl')
-    ug2=unstructured_grid.UnstructuredGrid.from_pickle('blah.pkl')
+    fn=os.path.join(tempfile.mkdtemp(),'grid.pkl')
+    ug.write_pickle(fn)
+    ug2=unstructured_grid.UnstructuredGrid.from_pickle(fn)
+    os.unlink(fn)
+    os.rmdir(os.path.dirname(fn))
 
 
 ## 
@@ -204,6 +208,452 @@ def test_nearest_cell():
     assert hit1==hit2
 
 ## 
+
+def test_bulk_topology():
+    gt=unstructured_grid.UnstructuredGrid()
+    gt.add_rectilinear([0,0],[3,2],4,3)
+    gt.add_cell_and_edges(nodes=[gt.add_node(x=[3,3]),
+                                 gt.add_node(x=[4,3]),
+                                 gt.add_node(x=[4,4])])
+
+    g=unstructured_grid.UnstructuredGrid(points=gt.nodes['x'],
+                                         cells=gt.cells['nodes'])
+    g.make_edges_from_cells()
+    assert g.Nedges()==gt.Nedges()
+
+    for c in range(g.Ncells()):
+        nodes=g.cell_to_nodes(c)
+        for i,j in enumerate(g.cell_to_edges(c)):
+            a,b=nodes[i],nodes[(i+1)%len(nodes)]
+            assert set(g.edges['nodes'][j])==set([a,b])
+            side=0 if g.edges['nodes'][j,0]==a else 1
+            assert g.edges['cells'][j,side]==c
+
+    e2c=g.edges['cells'].copy()
+    g.edge_to_cells(recalc=True)
+    assert np.all( np.maximum(g.edges['cells'],-1)==e2c )
+
+    offsets,indices=g.node_to_edges_csr()
+    for n in range(g.Nnodes()):
+        assert list(indices[offsets[n]:offsets[n+1]])==list(g.node_to_edges(n))
+    offsets,indices=g.node_to_cells_csr()
+    for n in range(g.Nnodes()):
+        assert sorted(indices[offsets[n]:offsets[n+1]])==sorted(gt.node_to_cells(n))
+
+def test_adjacency_undo():
+    # incrementally maintained node adjacency should match a fresh
+    # build, including after reverting edits
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[3,3],4,4)
+    g.build_node_to_edges()
+    g.build_node_to_cells()
+
+    def check():
+        for n2x,build in [(g.node_to_edges_csr,g.build_node_to_edges),
+                          (g.node_to_cells_csr,g.build_node_to_cells)]:
+            o1,i1=n2x()
+            build()
+            o2,i2=n2x()
+            assert np.all(o1==o2)
+            for n in range(g.Nnodes()):
+                assert sorted(i1[o1[n]:o1[n+1]])==sorted(i2[o2[n]:o2[n+1]])
+
+    cp=g.checkpoint()
+    g.delete_node_cascade(5)
+    n_new=g.add_node(x=[1.5,1.5])
+    for n in [4,6,9]:
+        g.add_edge(nodes=[n_new,n])
+    g.add_cell(nodes=[4,8,9,n_new])
+    check()
+    g.revert(cp)
+    check()
+
+def test_cells_geometry():
+    # mixed quads, triangle and hexagon, in large coordinates
+    g=unstructured_grid.UnstructuredGrid(max_sides=6)
+    g.add_rectilinear([0,0],[3,3],4,4)
+    g.nodes['x']+=np.random.random( (g.Nnodes(),2) )*0.3 + 5e5
+    tri=[g.add_node(x=5e5+np.r_[5,0]), g.add_node(x=5e5+np.r_[7,1]), g.add_node(x=5e5+np.r_[6,3])]
+    g.add_cell_and_edges(nodes=tri)
+    hexagon=[g.add_node(x=5e5+10+np.r_[np.cos(t),np.sin(t)])
+             for t in np.linspace(0,2*np.pi,7)[:-1]]
+    g.add_cell_and_edges(nodes=hexagon)
+    g.delete_cell(2)
+
+    area,centroid,center=g.cells_geometry(mode='sequential')
+    assert np.isnan(area[2])
+    for c in g.valid_cell_iter():
+        points=g.nodes['x'][g.cell_to_nodes(c)]
+        poly=g.cell_polygon(c)
+        assert np.allclose(area[c],utils.signed_area(points-points[0]))
+        assert np.allclose(centroid[c],poly.centroid.coords[0])
+        assert np.allclose(center[c],utils.poly_circumcenter(points))
+
+    g.cells['_area']=np.nan
+    valid=~g.cells['deleted']
+    assert np.allclose(g.cells_area()[valid],area[valid])
+    assert np.allclose(g.cells_centroid()[valid],centroid[valid])
+
+    # a single cell can be refreshed
+    g.cells['_center'][3]=np.nan
+    assert np.allclose(g.cells_center(refresh=3)[3],g.cells_center(refresh=True)[3])
+
+def test_element_index():
+    # edge and cell indices should follow edits and undo, and agree with
+    # brute force distances
+    from stompy.grid import element_index
+    from shapely import geometry
+
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[3,3],4,4)
+    g.nodes['x']+=np.random.random( (g.Nnodes(),2) )*0.2
+
+    def check():
+        for xy in np.random.random( (20,2) )*5 - 1:
+            P=geometry.Point(xy)
+            dists=np.full(g.Nedges(),np.inf)
+            for j in g.valid_edge_iter():
+                dists[j]=geometry.LineString(g.nodes['x'][g.edges['nodes'][j]]).distance(P)
+            j=g.select_edges_nearest(xy)
+            assert np.allclose(dists[j],dists.min())
+
+            cdists=np.full(g.Ncells(),np.inf)
+            for c in g.valid_cell_iter():
+                cdists[c]=g.cell_polygon(c).distance(P)
+            c=g.cell_index().nearest(xy)[0]
+            assert np.allclose(cdists[c],cdists.min())
+
+    for use_rtree in [None,False]:
+        g.drop_element_indices()
+        g._edge_index=element_index.EdgeIndex(g,use_rtree=use_rtree)
+        g._cell_index=element_index.CellIndex(g,use_rtree=use_rtree)
+        check()
+        cp=g.checkpoint()
+        g.delete_node_cascade(5)
+        g.modify_node(10,x=[4,4])
+        n_new=g.add_node(x=[1.5,1.5])
+        for n in [4,6,9]:
+            g.add_edge(nodes=[n_new,n])
+        g.add_cell(nodes=[4,8,9,n_new])
+        check()
+        hits=g.cell_index().query_bbox([1.4,1.6,1.4,1.6],exact=True)
+        assert len(hits)>0
+        g.revert(cp)
+        check()
+
+def test_points_to_cells():
+    g=unstructured_grid.UnstructuredGrid(max_sides=6)
+    g.add_rectilinear([0,0],[3,3],4,4)
+    g.nodes['x']+=np.random.random( (g.Nnodes(),2) )*0.2
+    hexagon=[g.add_node(x=10+np.r_[np.cos(t),np.sin(t)])
+             for t in np.linspace(0,2*np.pi,7)[:-1]]
+    g.add_cell_and_edges(nodes=hexagon)
+    g.delete_cell(4)
+
+    xy=np.random.random( (500,2) )*13 - 1
+    # a track for the walk, including excursions outside the grid
+    track=np.c_[ np.linspace(-0.5,11,300), 1.5+np.sin(np.linspace(0,10,300)) ]
+
+    for pnts in [xy,track]:
+        expected=np.array([g.point_to_cell(p) for p in pnts])
+        expected[expected==None]=-1
+        for walk in [False,True]:
+            cells=g.points_to_cells(pnts,walk=walk)
+            assert np.all(cells==expected.astype(np.int32))
+
+    # step out of each side of an interior cell, including the closing
+    # side from the last node back to the first.  Calls the walk directly,
+    # so the containment check in points_to_cells can't mask an error.
+    c=g.select_cells_nearest([1.5,1.5])
+    nodes=g.cell_to_nodes(c)
+    center=g.nodes['x'][nodes].mean(axis=0)
+    for k in range(len(nodes)):
+        mid=g.nodes['x'][[nodes[k-1],nodes[k]]].mean(axis=0)
+        pnts=np.array([center,center+1.6*(mid-center)])
+        expected=[g.point_to_cell(p) for p in pnts]
+        expected=[-1 if e is None else e for e in expected]
+        assert list(g._walk_points(pnts))==expected
+
+def test_select_intersecting():
+    from shapely import geometry
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[10,10],11,11)
+    g.delete_cell(12)
+    corner_edges=g.cell_to_edges(0)
+    g.delete_cell(0)
+    g.delete_edge([j for j in corner_edges if np.all(g.edges['cells'][j]<0)][0])
+
+    t=np.linspace(0,2*np.pi,200)
+    poly=geometry.Polygon(np.c_[5+4*np.cos(t),5+3*np.sin(t)]).difference(geometry.Point(5,5).buffer(1))
+    for geom in [poly,geometry.LineString([[0.5,0.5],[9,3]]),geometry.box(2,2,4,4)]:
+        for invert in [False,True]:
+            sel=g.select_cells_intersecting(geom,invert=invert)
+            for c in range(g.Ncells()):
+                if g.cells['deleted'][c]:
+                    assert not sel[c]
+                else:
+                    assert sel[c]==(geom.intersects(g.cell_polygon(c))!=invert)
+            idxs=g.select_cells_intersecting(geom,invert=invert,as_type='indices')
+            assert np.all(idxs==np.nonzero(sel)[0])
+
+            sel=g.select_edges_intersecting(geom,invert=invert)
+            for j in range(g.Nedges()):
+                if g.edges['deleted'][j]:
+                    assert not sel[j]
+                else:
+                    seg=geometry.LineString(g.nodes['x'][g.edges['nodes'][j]])
+                    assert sel[j]==(geom.intersects(seg)!=invert)
+
+            sel=g.select_cells_intersecting(geom,invert=invert,by_center=True)
+            cc=g.cells_center()
+            for c in np.nonzero(~g.cells['deleted'])[0]:
+                assert sel[c]==(geom.intersects(geometry.Point(cc[c]))!=invert)
+
+    # nodes on the boundary of the box count as intersecting
+    sel=g.select_nodes_intersecting(xxyy=[2,4,2,4],as_type='indices')
+    assert len(sel)==9
+
+def test_native_format():
+    import tempfile
+    g=unstructured_grid.UnstructuredGrid(max_sides=5,extra_cell_fields=[('depth',np.float64)])
+    g.add_rectilinear([0,0],[3,3],4,4)
+    g.cells['depth']=np.arange(g.Ncells())
+    g.add_cell_and_edges(nodes=[g.add_node(x=x) for x in [[5,0],[6,0],[7,1],[6,2],[5,1]]])
+    g.delete_cell(4)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fn=os.path.join(tmp,'grid.sug')
+        g.write_native(fn,indices=True)
+
+        for mmap_mode in ['c','r',None]:
+            g2=unstructured_grid.UnstructuredGrid.from_native(fn,mmap_mode=mmap_mode)
+            assert g2.max_sides==5
+            for a,b in [(g.nodes,g2.nodes),(g.edges,g2.edges),(g.cells,g2.cells)]:
+                assert a.dtype==b.dtype
+                for fld in a.dtype.names:
+                    assert np.array_equal(a[fld],b[fld],equal_nan=a[fld].dtype.kind=='f')
+            for n in range(g.Nnodes()):
+                assert g.node_to_edges(n)==g2.node_to_edges(n)
+                assert g.node_to_cells(n)==g2.node_to_cells(n)
+            assert g2.select_edges_nearest([5.9,0.1])==g.select_edges_nearest([5.9,0.1])
+
+        # copy-on-write maps can be edited, without changing the file
+        g2=unstructured_grid.UnstructuredGrid.from_native(fn)
+        n=g2.add_node(x=[-1,-1])
+        j=g2.add_edge(nodes=[n,0])
+        assert j in g2.node_to_edges(0)
+        g2.delete_edge(j)
+        assert j not in g2.node_to_edges(0)
+        g2.modify_node(0,x=[-0.5,0])
+        g3=unstructured_grid.UnstructuredGrid.from_native(fn)
+        assert np.all(g3.nodes['x'][0]==g.nodes['x'][0])
+        del g2,g3
+
+def test_bulk_add():
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[3,3],4,4)
+    g.build_node_to_edges()
+    g.build_node_to_cells()
+
+    events=[]
+    def cb(grid,func_name,*a,**k):
+        events.append(func_name)
+    for func_name in ['add_node','add_nodes','add_edges','add_cells']:
+        g.subscribe_after(func_name,cb)
+
+    g.reserve(nodes=g.Nnodes()+10)
+    nodes_before=g.nodes
+    cp=g.checkpoint()
+    ns=g.add_nodes(x=[[4,0],[4,1],[4,2]])
+    # fits in the reserved space, so the original array is extended in place
+    assert np.shares_memory(nodes_before,g.nodes)
+    js=g.add_edges(nodes=[[12,ns[0]],[ns[0],ns[1]],[ns[1],13]],mark=1)
+    assert np.all(g.edges['mark'][js]==1)
+    cs=g.add_cells(nodes=[[12,ns[0],ns[1],13]])
+    assert events==['add_nodes','add_edges','add_cells']
+
+    assert cs[0] in g.node_to_cells(ns[0])
+    assert set(g.cell_to_edges(cs[0]))==set(list(js)+[g.nodes_to_edge(12,13)])
+    assert g.edges['cells'][js[0],0]==cs[0]
+    assert g.edges['cells'][g.nodes_to_edge(12,13),1]==cs[0]
+
+    assert_raises(unstructured_grid.GridException,g.add_edges,nodes=[[ns[1],ns[2]],[ns[2],ns[1]]])
+    assert_raises(unstructured_grid.GridException,g.add_cells,nodes=[[12,ns[0],ns[1],13]])
+
+    g.revert(cp)
+    assert g.Nnodes()==16 and g.Ncells()==9
+    assert g.edges['cells'][g.nodes_to_edge(12,13),1]<0
+
+def test_bulk_add_shadow_cdt():
+    # bulk adds must keep an attached ShadowCDT current
+    from stompy.grid import shadow_cdt, exact_delaunay
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[2,2],3,3)
+    cdt=shadow_cdt.ShadowCDT(g)
+    g.add_rectilinear([3,0],[5,2],3,3)
+
+    def n_constrained():
+        return np.sum(cdt.edges['constrained'] & ~cdt.edges['deleted'])
+    assert np.sum(~cdt.nodes['deleted'])==g.Nnodes()==18
+    assert n_constrained()==g.Nedges()
+
+    # (0,0)-(1,2) crosses an edge of the first block.  The valid edge
+    # before it in the batch is backed out of the CDT again.
+    a,b,c,d=[g.select_nodes_nearest(xy) for xy in [[2,0],[3,0],[0,0],[1,2]]]
+    n_edges=g.Nedges()
+    assert_raises(exact_delaunay.IntersectingConstraints,
+                  g.add_edges,nodes=[[a,b],[c,d]])
+    assert g.Nedges()==n_edges and n_constrained()==n_edges
+    g.add_edges(nodes=[[a,b]])
+    assert n_constrained()==n_edges+1
+
+def test_merge_grids():
+    def grid(x0):
+        g=unstructured_grid.UnstructuredGrid()
+        g.add_rectilinear([x0,0],[x0+3,3],4,4)
+        return g
+    gA=grid(0.0)
+    gB=grid(3.0)
+    # seam nodes are off by a hair
+    gB.nodes['x'][:,0]+=1e-9
+
+    def check(g):
+        assert g.Ncells()==18
+        assert g.Nnodes()==28
+        assert g.Nedges()==18+24+3 # 7 columns of 3, 4 rows of 6
+        seam=g.select_edges_nearest([3.0,1.5])
+        assert np.all(g.edges['cells'][seam]>=0)
+        assert np.all(g.cells['edges']>=0)
+
+    g=grid(0.0)
+    node_map,edge_map,cell_map=g.add_grid(gB,tolerance=1e-6)
+    assert np.all(cell_map>=0) and np.all(edge_map>=0)
+    check(g)
+
+    g=unstructured_grid.UnstructuredGrid.merge_grids([gA,gB],tolerance=1e-6)
+    check(g)
+
+    # exact matching leaves the seam disconnected
+    g=unstructured_grid.UnstructuredGrid.merge_grids([gA,gB])
+    assert g.Nnodes()==32
+
+    # adding a grid to itself maps everything to existing elements
+    g=grid(0.0)
+    node_map,edge_map,cell_map=g.add_grid(grid(0.0),tolerance=0.0)
+    assert g.Ncells()==9 and g.Nnodes()==16
+    assert np.all(cell_map==np.arange(9))
+
+    g=grid(0.0)
+    g.add_grid(grid(0.0))
+    merged=g.merge_duplicate_nodes()
+    assert len(merged)==16
+    assert all(kept<deleted for deleted,kept in merged.items())
+    g.renumber()
+    assert g.Nnodes()==16 and g.Nedges()==24 and g.Ncells()==9
+
+def test_merge_duplicate_nodes_degenerate():
+    def grid():
+        g=unstructured_grid.UnstructuredGrid()
+        g.add_rectilinear([0,0],[3,3],4,4)
+        return g
+
+    # collapsing the edge (1,0)-(1,1) leaves two triangles
+    g=grid()
+    n=g.select_nodes_nearest([1,1])
+    g.nodes['x'][n]=[1,0.01]
+    g.merge_duplicate_nodes(tolerance=0.1)
+    g.renumber()
+    assert g.Nnodes()==15 and g.Nedges()==23 and g.Ncells()==9
+    assert sorted([g.cell_Nsides(c) for c in range(g.Ncells())])==[3,3]+[4]*7
+    assert np.all(g.cells['edges'][g.cells['nodes']>=0]>=0)
+    assert np.allclose(g.cells_area().sum(),9.0,atol=0.02)
+
+    # folding (1,1) onto (0,0) pinches the corner cell, which is deleted
+    g=grid()
+    n=g.select_nodes_nearest([1,1])
+    g.nodes['x'][n]=[0,0]
+    g.merge_duplicate_nodes()
+    g.renumber()
+    assert g.Nnodes()==15 and g.Nedges()==22 and g.Ncells()==8
+
+    # the bulk path has no undo and no events, so with a checkpoint or a
+    # listener nodes are merged one at a time, here along a seam
+    def doubled():
+        g=grid()
+        right=grid()
+        right.nodes['x'][:,0]+=3
+        g.add_grid(right)
+        return g
+    g=doubled()
+    cp=g.checkpoint()
+    assert_raises(unstructured_grid.GridException,g.remap_nodes,np.arange(g.Nnodes()))
+    assert len(g.merge_duplicate_nodes())==4
+    assert np.sum(~g.nodes['deleted'])==28
+    g.revert(cp)
+    assert np.sum(~g.nodes['deleted'])==32
+    g.commit()
+
+    g=doubled()
+    deleted=[]
+    g.subscribe_after('delete_node',lambda grid,func_name,n,**k: deleted.append(n))
+    index=g.edge_index()
+    assert_raises(unstructured_grid.GridException,g.remap_nodes,np.arange(g.Nnodes()))
+    assert g.edge_index() is index # refused without dropping caches
+    merged=g.merge_duplicate_nodes()
+    assert sorted(deleted)==sorted(merged.keys()) and len(deleted)==4
+    g.renumber()
+    assert g.Nnodes()==28 and g.Nedges()==45 and g.Ncells()==18
+
+    # the grid's own indices don't count as listeners
+    g=grid()
+    g.edge_index()
+    g.node_graph()
+    g.nodes['x'][n]=[0,0]
+    g.merge_duplicate_nodes()
+    g.renumber()
+    assert g.Ncells()==8
+
+def test_graphs():
+    g=unstructured_grid.UnstructuredGrid()
+    g.add_rectilinear([0,0],[4,4],5,5)
+
+    G=g.node_graph()
+    assert G.shape==(25,25)
+    assert G.nnz==2*g.Nedges()
+    # cached until modified
+    assert g.node_graph() is G
+
+    n1=g.select_nodes_nearest([0,0])
+    n2=g.select_nodes_nearest([4,4])
+    path=g.shortest_path(n1,n2)
+    assert path[0]==n1 and path[-1]==n2
+    assert len(path)==9
+    js=g.shortest_path(n1,n2,return_type='edges')
+    assert np.allclose(g.edges_length()[js].sum(),8.0)
+
+    dist=g.node_distances([n1,n2])
+    assert np.allclose(dist.max(),4.0)
+
+    # cut the edges between x=1 and x=2, except along the top
+    xy=g.edges_center()
+    cut=(np.abs(xy[:,0]-1.5)<0.1)
+    n3=g.select_nodes_nearest([4,0])
+    path=g.shortest_path(n1,n3,edge_mask=~(cut & (xy[:,1]<3.5)))
+    assert len(path)==1+4+4+4
+
+    dist=g.cell_distances(0)
+    assert np.allclose(dist.max(),6.0)
+
+    n_comps,labels=g.nodes_connected_components(edge_mask=~cut)
+    assert n_comps==2
+    assert labels[n1]!=labels[n3]
+    assert g.shortest_path(n1,n3,edge_mask=~cut) is None
+
+    g.modify_node(n2,x=[5,4])
+    assert g._graph_cache is None
+    assert np.allclose(g.node_distances(n1)[n2],7+np.sqrt(2))
+
+## 
     
 if __name__=='__main__':
     nose.main()